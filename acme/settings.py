@@ -41,6 +41,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'api.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -81,6 +82,20 @@ DATABASES = {
     }
 }
 
+# Rendered quote responses are cached by ETag in QUOTE_RESPONSE_CACHE (see
+# api.caching). Local memory is per process, point it at a
+# django.core.cache.backends.filebased.FileBasedCache to share it between
+# workers. The same goes for the stamp other processes check to see that the
+# rate table changed (RATE_TABLE_CACHE, see api.rate_table); without it they
+# reload it every RATE_TABLE_MAX_AGE seconds.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+QUOTE_RESPONSE_CACHE = 'default'
+QUOTE_RESPONSE_CACHE_TIMEOUT = 300
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
@@ -123,6 +138,12 @@ STATIC_URL = 'static/'
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Profile this fraction of requests and keep the profiles of the slowest
+# METRICS_PROFILE_KEEP of them in METRICS_PROFILE_DIR (see api.metrics).
+METRICS_PROFILE_SAMPLE_RATE = 0.0
+METRICS_PROFILE_DIR = BASE_DIR / 'profiles'
+METRICS_PROFILE_KEEP = 10
+
 # LOGGING = {
 #     'version': 1,
 #     'disable_existing_loggers': False,
@@ -1,30 +1,197 @@
 from django.contrib import admin
-from django import forms
-from .models import Quote, VariableSpecification, Customer, QuoteVariable, PolicyVariable
+from django.contrib.admin.views.main import ChangeList
+from django.core.paginator import Paginator
+from django.db import connection, DatabaseError
+from django.utils.functional import cached_property
+from typing import Optional
+import math
+import time
+from .metrics import record_rating
+from .models import (Quote, VariableSpecification, Customer, QuoteVariable, PolicyVariable,
+                     RateTableSnapshot, RATING_ERRORS)
+from .rate_table import rate_table
+from .rating import build_batch
+from .signals import deferred_cost_refresh
+
+# The quote and variable tables are far too big for the admin's defaults:
+# changelists join what their rows print instead of querying per row, foreign
+# keys get search or raw id widgets instead of a <select> of every row and
+# the page count doesn't COUNT(*) the whole table.
+
+COUNT_LIMIT = 10000
+
+
+def estimated_rows(model) -> Optional[int]:
+    # the planner's row estimate for a table, None when there isn't one (on
+    # SQLite until ANALYZE has run)
+    table = model._meta.db_table
+    try:
+        with connection.cursor() as cursor:
+            if connection.vendor == "postgresql":
+                cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE relname = %s", [table])
+            elif connection.vendor == "sqlite":
+                cursor.execute("SELECT stat FROM sqlite_stat1 WHERE tbl = %s LIMIT 1", [table])
+            else:
+                return None
+            row = cursor.fetchone()
+    except DatabaseError:
+        return None
+    if row is None:
+        return None
+    estimate = int(str(row[0]).split()[0])
+    return estimate if estimate >= 0 else None
+
+
+class EstimatedCountPaginator(Paginator):
+    # Counts up to COUNT_LIMIT rows exactly. Past that the unfiltered table
+    # is estimated from the database statistics and filtered lists just
+    # report the limit, the last pages of those are only reachable by
+    # narrowing the filters.
+    @cached_property
+    def count(self) -> int:
+        queryset = self.object_list
+        count = queryset[:COUNT_LIMIT + 1].count()
+        if count <= COUNT_LIMIT:
+            return count
+        if not queryset.query.where:
+            estimate = estimated_rows(queryset.model)
+            if estimate is not None:
+                return max(estimate, count)
+        return count
+
+
+class ScalableAdmin(admin.ModelAdmin):
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def get_queryset(self, request):
+        # the default managers prefetch (and order by) more than a
+        # changelist shows
+        return super().get_queryset(request).prefetch_related(None)
+
+
+class RatedChangeList(ChangeList):
+    def get_results(self, request):
+        super().get_results(request)
+        # the page's quotes without current stored costs, rated in one batch
+        # from their variables' rows like api.lean does. The ones that can't
+        # be rated get the reason instead, see QuoteAdmin.cost.
+        table = rate_table.table()
+        stale = sorted((q for q in self.result_list if q.stored_cost_at(table.cost_version) is None),
+                       key=lambda q: q.pk)
+        if not stale:
+            return
+        started = time.perf_counter()
+        batch = build_batch([(q.pk, q.state, q.coverage_type) for q in stale],
+                            QuoteVariable.objects.filter(quote__in=[q.pk for q in stale]))
+        for i, (quote, rate) in enumerate(zip(stale, batch.rate(table, strict=False))):
+            if not math.isnan(rate.total):
+                quote._batch_rate = rate
+                continue
+            try:
+                batch.rate_each(table, True, i)
+            except RATING_ERRORS as e:
+                quote._rating_error = str(e)
+        record_rating(time.perf_counter() - started, len(stale))
+
+
+class QuoteVariableInline(admin.TabularInline):
+    model = QuoteVariable
+    fields = ('spec', 'value', 'notes')
+    autocomplete_fields = ('spec',)
+    extra = 1
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('spec')
 
 
 @admin.register(Quote)
-class QuoteAdmin(admin.ModelAdmin):
+class QuoteAdmin(ScalableAdmin):
+    list_display = ('description', 'customer', 'state', 'coverage_type', 'cost', 'rate_version')
+    list_select_related = ('customer',)
+    list_filter = ('state', 'coverage_type')
+    search_fields = ('description',)
+    autocomplete_fields = ('customer',)
+    ordering = ('-id',)
+    inlines = [QuoteVariableInline]
+    actions = ['refresh_costs']
 
     def get_readonly_fields(self, request, obj=None):
-        return ('created_at', 'updated_at')
+        return ('created_at', 'updated_at', 'subtotal', 'taxes', 'total', 'rate_version')
+
+    def get_changelist(self, request, **kwargs):
+        return RatedChangeList
+
+    @admin.display(description="Cost")
+    def cost(self, obj: Quote) -> str:
+        # the current total, see RatedChangeList
+        error = getattr(obj, "_rating_error", None)
+        if error is not None:
+            return error
+        try:
+            return "{:.2f}".format(obj.cost.total)
+        except RATING_ERRORS as e:
+            return str(e)
+
+    def save_formset(self, request, form, formset, change):
+        # the variables are written in bulk and the quote is re-rated once
+        # for all of them rather than after each one
+        if formset.model is not QuoteVariable:
+            return super().save_formset(request, form, formset, change)
+        with deferred_cost_refresh() as pending:
+            formset.save(commit=False)
+            QuoteVariable.objects.bulk_create(formset.new_objects)
+            changed = [variable for variable, _ in formset.changed_objects]
+            if changed:
+                QuoteVariable.objects.bulk_update(changed, ['spec', 'value', 'notes'])
+            for variable in formset.deleted_objects:
+                variable.delete()
+            pending.add(form.instance.pk)
+
+    @admin.action(description="Re-rate and store costs")
+    def refresh_costs(self, request, queryset):
+        count = queryset.refresh_costs()
+        self.message_user(request, "Refreshed costs of {} quotes.".format(count))
 
 
 @admin.register(QuoteVariable)
-class QuoteVariableAdmin(admin.ModelAdmin):
-    pass
+class QuoteVariableAdmin(ScalableAdmin):
+    list_display = ('quote', 'spec', 'value')
+    list_select_related = ('quote__customer', 'spec')
+    list_filter = ('spec',)
+    raw_id_fields = ('quote',)
+    autocomplete_fields = ('spec',)
+    ordering = ('-id',)
 
 
 @admin.register(VariableSpecification)
 class VariableSpecificationAdmin(admin.ModelAdmin):
-    pass
+    list_display = ('code', 'type', 'application', 'priority', 'lookup_key')
+    list_filter = ('type', 'application')
+    search_fields = ('code', 'description')
 
 
 @admin.register(Customer)
-class CustomerAdmin(admin.ModelAdmin):
-    pass
+class CustomerAdmin(ScalableAdmin):
+    search_fields = ('name',)
+    ordering = ('-id',)
 
 
 @admin.register(PolicyVariable)
 class PolicyVariableAdmin(admin.ModelAdmin):
-    pass
+    list_display = ('scope', 'key', 'value')
+    list_filter = ('scope',)
+    search_fields = ('key',)
+
+
+@admin.register(RateTableSnapshot)
+class RateTableSnapshotAdmin(admin.ModelAdmin):
+    # snapshots are published with the publish_rates command and never change
+    list_display = ('effective_at', 'version', 'description', 'published_at')
+    readonly_fields = ('effective_at', 'version', 'description', 'published_at', 'values')
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
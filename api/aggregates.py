@@ -0,0 +1,212 @@
+from typing import Dict, List, Sequence
+import math
+import numpy as np
+import time
+
+from .lean import chunked
+from .metrics import record_rating
+from .models import QuoteVariable
+from .rate_table import RateTable, rate_table
+from .rating import build_batch
+from .simulation import COST_COLUMNS, PERCENTILES
+
+# Sums, counts and percentiles of quote costs per group (the whole queryset,
+# or per state, coverage type and/or customer) for the portfolio and
+# aggregate endpoints. The quotes are read as value rows a chunk at a time
+# and rated like the lean read path does (stored costs while they are
+# current, the rest in one batch per chunk), and every chunk is folded into
+# per group totals with numpy. Percentiles come from a log bucketed
+# histogram per group instead of the costs themselves, so memory grows with
+# the number of groups and not with the number of quotes:
+#
+# - a cost x != 0 falls in bucket ceil(log|x| / log(gamma)), signed, with
+#   gamma = (1 + a) / (1 - a) for a = PERCENTILE_ACCURACY, and a percentile
+#   is read off the bucket its rank falls in as 2 gamma^i / (gamma + 1).
+#   That is within a (relative) of the exact lower percentile of the costs.
+#   Zero costs have a bucket of their own.
+# - sums, counts, minimums and maximums are exact.
+
+AGGREGATE_CHUNK_SIZE = 20000
+PERCENTILE_ACCURACY = 0.001
+GAMMA = (1 + PERCENTILE_ACCURACY) / (1 - PERCENTILE_ACCURACY)
+LOG_GAMMA = math.log(GAMMA)
+# keeps the signed bucket keys of nonzero costs away from zero's, the key of
+# a bucket orders it among the others like its costs
+BUCKET_OFFSET = 1 << 30
+BUCKET_SPAN = 1 << 32
+GROUP_BY_CHOICES = ("state", "coverage_type", "customer")
+AGGREGATE_COLUMNS = ("pk", "customer_id", "state", "coverage_type",
+                     "subtotal", "taxes", "total", "rate_version")
+
+
+def bucket_keys(costs: np.ndarray) -> np.ndarray:
+    magnitude = np.abs(costs)
+    with np.errstate(divide="ignore"):
+        index = np.ceil(np.log(np.where(magnitude > 0, magnitude, 1.0)) / LOG_GAMMA)
+    return (np.sign(costs) * (index + BUCKET_OFFSET)).astype(np.int64)
+
+
+def bucket_values(keys: np.ndarray) -> np.ndarray:
+    index = np.abs(keys) - BUCKET_OFFSET
+    return np.where(keys == 0, 0.0, np.sign(keys) * 2 * GAMMA ** index.astype(float) / (GAMMA + 1))
+
+
+class Grouping:
+    # The quotes' counts and costs per distinct value of the group columns
+    # (one group for no columns).
+    def __init__(self, columns: Sequence[str] = ()):
+        self.columns = tuple(columns)
+        self.groups: Dict[tuple, int] = {}
+        self.quotes = np.zeros(0, dtype=np.int64)
+        self.unrated = np.zeros(0, dtype=np.int64)
+        self.sums = np.zeros((0, len(COST_COLUMNS)))
+        self.minimums = np.zeros((0, len(COST_COLUMNS)))
+        self.maximums = np.zeros((0, len(COST_COLUMNS)))
+        # per cost column the distinct (group, bucket key) pairs packed into
+        # int64s, in order, and their quotes
+        self.buckets = [np.zeros(0, dtype=np.int64) for _ in COST_COLUMNS]
+        self.counts = [np.zeros(0, dtype=np.int64) for _ in COST_COLUMNS]
+        if not self.columns:
+            # the one group is there even without quotes
+            self.groups[()] = 0
+            self.grow(1)
+
+    def add(self, columns: Dict[str, Sequence], costs: np.ndarray):
+        # a chunk of quotes: their values of the group columns and their
+        # costs, one column per COST_COLUMNS entry with nan for quotes that
+        # can't be rated
+        groups = self.groups
+        if self.columns:
+            keys = zip(*(columns[column] for column in self.columns))
+            index = np.fromiter((groups.setdefault(key, len(groups)) for key in keys),
+                                dtype=np.int64, count=len(costs))
+        else:
+            index = np.zeros(len(costs), dtype=np.int64)
+        self.grow(len(groups))
+        n = len(groups)
+        rated = ~np.isnan(costs).any(axis=1)
+        self.quotes += np.bincount(index, minlength=n)
+        self.unrated += np.bincount(index[~rated], minlength=n)
+        index, costs = index[rated], costs[rated]
+        if not len(index):
+            return
+        # the chunk a group at a time, for the extremes
+        order = np.argsort(index, kind="stable")
+        present, starts = np.unique(index[order], return_index=True)
+        for c in range(len(COST_COLUMNS)):
+            column = costs[:, c]
+            self.sums[:, c] += np.bincount(index, weights=column, minlength=n)
+            self.minimums[present, c] = np.minimum(
+                self.minimums[present, c], np.minimum.reduceat(column[order], starts))
+            self.maximums[present, c] = np.maximum(
+                self.maximums[present, c], np.maximum.reduceat(column[order], starts))
+            pairs, counts = np.unique(pack(index, bucket_keys(column)), return_counts=True)
+            self.buckets[c], self.counts[c] = merge(self.buckets[c], self.counts[c], pairs, counts)
+
+    def grow(self, n: int):
+        added = n - len(self.quotes)
+        if added <= 0:
+            return
+        self.quotes = np.concatenate([self.quotes, np.zeros(added, dtype=np.int64)])
+        self.unrated = np.concatenate([self.unrated, np.zeros(added, dtype=np.int64)])
+        self.sums = np.concatenate([self.sums, np.zeros((added, len(COST_COLUMNS)))])
+        self.minimums = np.concatenate([self.minimums, np.full((added, len(COST_COLUMNS)), np.inf)])
+        self.maximums = np.concatenate([self.maximums, np.full((added, len(COST_COLUMNS)), -np.inf)])
+
+    def summaries(self) -> List[dict]:
+        # one dict per group, ordered by its values: the group columns'
+        # values, quotes, unrated and per cost column the sum, min, max and
+        # percentiles of the rated quotes' costs
+        rated = self.quotes - self.unrated
+        described = [self.describe(c, rated) for c in range(len(COST_COLUMNS))]
+        summaries = []
+        for key, g in sorted(self.groups.items()):
+            summary = dict(zip(self.columns, key))
+            summary.update(quotes=int(self.quotes[g]), unrated=int(self.unrated[g]))
+            for column, columns in zip(COST_COLUMNS, described):
+                if not rated[g]:
+                    summary[column] = dict(sum=0.0)
+                else:
+                    summary[column] = {name: values[g] for name, values in columns.items()}
+            summaries.append(summary)
+        return summaries
+
+    def describe(self, c: int, rated: np.ndarray) -> Dict[str, list]:
+        # sums, extremes and percentiles of cost column c, a list of every
+        # group's each
+        n = len(rated)
+        groups = pack(np.arange(n), 0)
+        buckets, seen = self.buckets[c], np.cumsum(self.counts[c])
+        # every group's pairs are a run of the sorted pairs, the quotes
+        # before it are before its run
+        before = np.concatenate([[0], seen])[np.searchsorted(buckets, groups)]
+        minimums, maximums = self.minimums[:, c], self.maximums[:, c]
+        described = dict(sum=np.round(self.sums[:, c], 2).tolist(),
+                         min=minimums.tolist(), max=maximums.tolist())
+        for p in PERCENTILES:
+            # the lower percentile, the cost at floor(p% of (rated - 1)) in order
+            rank = np.floor(p / 100 * np.maximum(rated - 1, 0)).astype(np.int64)
+            found = np.searchsorted(seen, before + rank, side="right")
+            values = np.zeros(n)
+            # groups without rated quotes have no run, their rank lands in
+            # another group's or past the end
+            inside = (rated > 0) & (found < len(buckets))
+            values[inside] = bucket_values(buckets[found[inside]] - groups[inside])
+            described["p{}".format(p)] = np.round(np.clip(values, minimums, maximums), 2).tolist()
+        return described
+
+
+def pack(groups, keys):
+    # (group, bucket key) pairs as int64s that sort like the pairs
+    return groups * BUCKET_SPAN + keys + BUCKET_SPAN // 2
+
+
+def merge(pairs: np.ndarray, counts: np.ndarray, more: np.ndarray, more_counts: np.ndarray):
+    # two sorted sets of distinct pairs and their counts as one, a stable
+    # sort of two sorted runs is a merge
+    combined = np.concatenate([pairs, more])
+    order = np.argsort(combined, kind="stable")
+    combined = combined[order]
+    starts = np.flatnonzero(np.concatenate([[True], combined[1:] != combined[:-1]]))
+    return combined[starts], np.add.reduceat(np.concatenate([counts, more_counts])[order], starts)
+
+
+def chunk_costs(pks, states, coverage_types, costs: np.ndarray, versions,
+                table: RateTable) -> np.ndarray:
+    # the stored costs of a chunk with the stale ones replaced by ratings
+    # from one batch, like lean.rate_rows but in arrays
+    current = table.cost_version
+    stale = [i for i, version in enumerate(versions) if version != current]
+    stale.extend(np.flatnonzero(np.isnan(costs[:, 2])).tolist())
+    if not stale:
+        return costs
+    stale = sorted(set(stale), key=lambda i: pks[i])
+    started = time.perf_counter()
+    batch = build_batch([(pks[i], states[i], coverage_types[i]) for i in stale],
+                        QuoteVariable.objects.filter(quote__in=[pks[i] for i in stale]))
+    costs[stale] = np.column_stack(batch.rate_arrays(table, strict=False))
+    record_rating(time.perf_counter() - started, len(stale))
+    return costs
+
+
+def aggregate_quotes(queryset, groupings: Sequence[Sequence[str]] = ((),), table: RateTable = None,
+                     chunk_size: int = AGGREGATE_CHUNK_SIZE) -> List[Grouping]:
+    # every quote in the queryset folded into each of the groupings in one
+    # pass, against one rate table
+    if table is None:
+        table = rate_table.table()
+    groupings = [Grouping(columns) for columns in groupings]
+    rows = (queryset.
+            prefetch_related(None).
+            order_by().
+            values_list(*AGGREGATE_COLUMNS).
+            iterator(chunk_size=chunk_size))
+    for chunk in chunked(rows, chunk_size):
+        pks, customers, states, coverage_types, subtotals, taxes, totals, versions = zip(*chunk)
+        # missing stored costs come out as nan
+        costs = np.array([subtotals, taxes, totals], dtype=float).T.copy()
+        costs = chunk_costs(pks, states, coverage_types, costs, versions, table)
+        columns = {"state": states, "coverage_type": coverage_types, "customer": customers}
+        for grouping in groupings:
+            grouping.add(columns, costs)
+    return groupings
@@ -0,0 +1,186 @@
+from django.conf import settings
+from django.db import connection, transaction
+from django.test import RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
+from typing import Callable, List
+import json
+import platform
+import random
+import statistics
+import subprocess
+import time
+import django
+
+from .caching import response_cache
+from .lean import render_quotes
+from .models import Customer, Quote, PolicyRater, VariableSpecification, VARIABLE_TYPE_SIMPLE
+from .pagination import KeysetPagination
+from .rate_table import rate_table
+from .rating import plan_cache, rating_memo
+from .serializers import QuoteSerializer
+from .synthetic import SIMPLE_VALUES, STATES, COVERAGE_TYPES, SYNTHETIC_PREFIX, generate
+from .views import QuoteViewSet
+
+DEFAULT_SIZES = [1000, 10000]
+DETAIL_SAMPLE = 100
+RATER_SAMPLE = 1000
+BULK_SAMPLE = 1000
+
+
+class Benchmark:
+    # Times fn over `items` things `repeat` times and checks how many queries
+    # the first run issued against the budget (None for unchecked).
+    def __init__(self, name: str, fn: Callable, items: int, budget: int = None, setup: Callable = None):
+        self.name = name
+        self.fn = fn
+        self.items = items
+        self.budget = budget
+        self.setup = setup
+
+    def run(self, size: int, repeat: int) -> dict:
+        timings = []
+        queries = None
+        for i in range(repeat):
+            if self.setup:
+                self.setup()
+            with CaptureQueriesContext(connection) as captured:
+                started = time.perf_counter()
+                self.fn()
+                timings.append(time.perf_counter() - started)
+            if queries is None:
+                queries = len(captured)
+        best = min(timings)
+        return dict(benchmark=self.name, size=size, items=self.items,
+                    repeat=repeat, best=best, median=statistics.median(timings),
+                    per_item_us=best / self.items * 1e6 if self.items else None,
+                    queries=queries, query_budget=self.budget,
+                    within_budget=self.budget is None or queries <= self.budget)
+
+
+def benchmarks(size: int, seed: int) -> List[Benchmark]:
+    rng = random.Random(seed)
+    pks = list(Quote.objects.values_list("pk", flat=True))
+    quotes = list(Quote.objects.filter(pk__in=rng.sample(pks, min(RATER_SAMPLE, len(pks)))))
+    detail_pks = rng.sample(pks, min(DETAIL_SAMPLE, len(pks)))
+    factory = RequestFactory()
+    list_view = QuoteViewSet.as_view({"get": "list"})
+    detail_view = QuoteViewSet.as_view({"get": "retrieve"})
+    bulk_view = QuoteViewSet.as_view({"post": "bulk"})
+    bulk_payload = json.dumps(bulk_quotes(rng, min(size, BULK_SAMPLE)))
+
+    def calculate_quote_rate():
+        for quote in quotes:
+            PolicyRater(quote).calculate_quote_rate()
+
+    def rate_many():
+        PolicyRater.rate_many(Quote.objects.all())
+
+    def serializer():
+        for quote in quotes:
+            quote.__dict__.pop("_batch_rate", None)
+        QuoteSerializer(quotes, many=True).data
+
+    def lean():
+        # the same quotes as serializer, read, rated and rendered from rows
+        render_quotes(Quote.objects.filter(pk__in=[q.pk for q in quotes]))
+
+    def get(view, path, headers=None, **kwargs):
+        response = view(factory.get(path, **(headers or {})), **kwargs)
+        # responses from the response cache come already rendered
+        if hasattr(response, "render"):
+            response.render()
+        return response
+
+    def list_endpoint():
+        get(list_view, "/api/v1/quotes/")
+
+    def detail_endpoint():
+        for pk in detail_pks:
+            get(detail_view, "/api/v1/quotes/{}/".format(pk), pk=pk)
+
+    etags = {}
+
+    def collect_etags():
+        for pk in detail_pks:
+            etags[pk] = get(detail_view, "/api/v1/quotes/{}/".format(pk), pk=pk)["ETag"]
+
+    def detail_not_modified():
+        for pk in detail_pks:
+            get(detail_view, "/api/v1/quotes/{}/".format(pk),
+                dict(HTTP_IF_NONE_MATCH=etags[pk]), pk=pk)
+
+    def refresh_costs():
+        Quote.objects.all().refresh_costs()
+
+    def bulk_create():
+        response = bulk_view(factory.post("/api/v1/quotes/bulk/", bulk_payload,
+                                          content_type="application/json"))
+        assert response.status_code == 201, response.data
+
+    # budgets assume a warm rate table: quotes, customers, variables and specs
+    # plus one for the ETag on the endpoints, whose response cache is
+    # emptied first unless it is what's being measured.
+    clear = response_cache().clear
+    # the list endpoint renders its first page, not all of them
+    page = min(size, KeysetPagination.page_size)
+    return [Benchmark("calculate_quote_rate", calculate_quote_rate, len(quotes), 0),
+            Benchmark("rate_many", rate_many, size, 4),
+            Benchmark("serializer", serializer, len(quotes), 0),
+            Benchmark("lean", lean, len(quotes), 3),
+            Benchmark("list_endpoint", list_endpoint, page, 4, clear),
+            Benchmark("detail_endpoint", detail_endpoint, len(detail_pks), 4 * len(detail_pks), clear),
+            Benchmark("refresh_costs", refresh_costs, size),
+            # the inserts are batched by the database's parameter limit
+            Benchmark("bulk_create", bulk_create, min(size, BULK_SAMPLE)),
+            Benchmark("lean_materialized", lean, len(quotes), 1),
+            Benchmark("list_endpoint_materialized", list_endpoint, page, 2, clear),
+            Benchmark("detail_endpoint_cached", detail_endpoint, len(detail_pks), len(detail_pks),
+                      detail_endpoint),
+            Benchmark("detail_endpoint_not_modified", detail_not_modified, len(detail_pks),
+                      len(detail_pks), collect_etags)]
+
+
+def bulk_quotes(rng: random.Random, count: int) -> List[dict]:
+    # POST quotes/bulk data shaped like the synthetic quotes
+    customers = list(Customer.objects.values_list("pk", flat=True)[:1000])
+    specs = list(VariableSpecification.objects.filter(code__startswith=SYNTHETIC_PREFIX))
+    return [{"customer": rng.choice(customers),
+             "state": rng.choice(STATES),
+             "coverage_type": rng.choice(COVERAGE_TYPES),
+             "variables": [{"code": spec.code,
+                            "value": rng.choice(SIMPLE_VALUES) if spec.type == VARIABLE_TYPE_SIMPLE else None}
+                           for spec in rng.sample(specs, rng.randint(0, 5))]}
+            for _ in range(count)]
+
+
+def run(sizes: List[int] = None, repeat: int = 3, seed: int = 0) -> dict:
+    # Generates a synthetic book of each size and runs every benchmark on it.
+    # Each size is generated and measured inside a transaction that is rolled
+    # back afterwards, so the database is left as it was.
+    results = []
+    for size in sizes or DEFAULT_SIZES:
+        # the request factory's host, as under the test runner
+        with transaction.atomic(), override_settings(
+                ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, "testserver"]):
+            generated = generate(size, seed=seed)
+            rate_table.table()
+            for benchmark in benchmarks(size, seed):
+                result = benchmark.run(size, repeat)
+                result["generated"] = generated
+                results.append(result)
+            transaction.set_rollback(True)
+        rate_table.invalidate()
+        plan_cache.clear()
+        rating_memo.clear()
+    return dict(environment=environment(), seed=seed, results=results)
+
+
+def environment() -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return dict(commit=commit, python=platform.python_version(),
+                django=django.get_version(), database=connection.vendor,
+                machine=platform.machine(), timestamp=time.time())
@@ -0,0 +1,96 @@
+from django.db import transaction
+from typing import Dict, List, Tuple
+import math
+import time
+
+from .dependencies import rating_dependencies
+from .metrics import record_rating
+from .models import (Customer, Quote, QuoteDependency, QuoteVariable, RATING_ERRORS,
+                     RatingResult, VariableSpecification)
+from .rate_table import RateTable, rate_table
+from .rating import QuoteBatch, rate_unsaved, spec_signature
+
+# Creating quotes with their variables in bulk, for POST quotes/bulk. Every
+# quote is checked and rated before anything is written: customers and specs
+# are read once into dicts and the quotes are rated together from their
+# descriptions, so the costs go in with the quote rows. The rows are then
+# written with bulk_create a chunk at a time in one transaction, which skips
+# the signals in api.signals; their dependency index rows are written here.
+
+BULK_CHUNK_SIZE = 1000
+MAX_BULK_QUOTES = 10000
+
+
+def create_quotes(descriptions: List[dict], table: RateTable = None
+                  ) -> Tuple[List[Tuple[Quote, RatingResult]], Dict[int, dict]]:
+    # Creates the quotes described by validated BulkQuoteSerializer data.
+    # Returns the (quote, cost) pairs in order, or nothing and the errors
+    # by index when any of them can't be created.
+    if table is None:
+        table = rate_table.table()
+    customers = set(Customer.objects.filter(
+        pk__in={d["customer"] for d in descriptions}).values_list("pk", flat=True))
+    specs = VariableSpecification.objects.in_bulk(
+        {v["code"] for d in descriptions for v in d["variables"]})
+
+    errors = {}
+    ordered = []
+    for i, description in enumerate(descriptions):
+        problems = {}
+        if description["customer"] not in customers:
+            problems["customer"] = ["Customer {} does not exist.".format(description["customer"])]
+        unknown = [v["code"] for v in description["variables"] if v["code"] not in specs]
+        if unknown:
+            problems["variables"] = ["Unknown variable specification {}.".format(code)
+                                     for code in unknown]
+        if problems:
+            errors[i] = problems
+        # in priority order, like QuoteVariablesManager
+        ordered.append(sorted(description["variables"], key=lambda v: specs[v["code"]].priority)
+                       if not problems else None)
+    if errors:
+        return [], errors
+
+    started = time.perf_counter()
+    batch = QuoteBatch()
+    for description, variables in zip(descriptions, ordered):
+        batch.add(description["state"], description["coverage_type"],
+                  tuple(spec_signature(specs[v["code"]]) for v in variables),
+                  [v["value"] for v in variables])
+    costs = batch.rate(table, strict=False)
+    record_rating(time.perf_counter() - started, len(descriptions))
+    for i, cost in enumerate(costs):
+        if math.isnan(cost.total):
+            errors[i] = {"non_field_errors": [unratable(descriptions[i], ordered[i], specs, table)]}
+    if errors:
+        return [], errors
+
+    quotes = [Quote(customer_id=d["customer"], description=d["description"], state=d["state"],
+                    coverage_type=d["coverage_type"], subtotal=cost.subtotal, taxes=cost.taxes,
+                    total=cost.total, rate_version=table.cost_version)
+              for d, cost in zip(descriptions, costs)]
+    with transaction.atomic():
+        for start in range(0, len(quotes), BULK_CHUNK_SIZE):
+            chunk = quotes[start:start + BULK_CHUNK_SIZE]
+            Quote.objects.bulk_create(chunk)
+            chunk_variables = ordered[start:start + BULK_CHUNK_SIZE]
+            QuoteVariable.objects.bulk_create(
+                QuoteVariable(quote_id=quote.pk, spec_id=v["code"], value=v["value"],
+                              notes=v["notes"])
+                for quote, variables in zip(chunk, chunk_variables) for v in variables)
+            QuoteDependency.objects.bulk_create(
+                QuoteDependency(quote_id=quote.pk, scope=scope, key=key)
+                for quote, variables in zip(chunk, chunk_variables)
+                for scope, key in rating_dependencies(quote.state, quote.coverage_type,
+                                                      [specs[v["code"]] for v in variables]))
+    return list(zip(quotes, costs)), {}
+
+
+def unratable(description: dict, variables: List[dict], specs, table: RateTable) -> str:
+    # why a quote the batch couldn't rate can't be rated
+    try:
+        rate_unsaved(description["state"], description["coverage_type"],
+                     [(specs[v["code"]], v["value"]) for v in variables], table)
+    except RATING_ERRORS as e:
+        return str(e)
+    return "The quote can't be rated."
@@ -0,0 +1,86 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from typing import Callable, Optional
+import hashlib
+
+from .models import Quote
+from .rate_table import rate_table
+
+# Conditional GET and a server side cache of rendered responses for the quote
+# endpoints. A quote's representation only depends on its own row, its
+# customer's name, its variables (and their specs) and the rate table (and
+# arithmetic, see RateTable.cost_version), so an
+# ETag derived from those can be checked without rating or serializing
+# anything, and the rendered JSON can be cached under it: a new version of
+# any of them is a new key and the old entries just expire.
+# There is no Last-Modified: a customer rename, a spec edit or a quote
+# dropping out of a list page changes the representation without moving any
+# quote's updated_at, so only the ETag can tell.
+
+DEFAULT_RESPONSE_CACHE_TIMEOUT = 300
+
+
+def quote_validators(quotes, *extra: str) -> Optional[str]:
+    # strong ETag of a queryset of quotes, in one query that reads each quote
+    # with its customer's name and its variables. None when there are no
+    # quotes.
+    rows = (Quote.objects.
+            prefetch_related(None).
+            filter(pk__in=quotes.values("pk")).
+            order_by("pk", "variables__spec_id").
+            values_list("pk", "updated_at", "customer__name",
+                        "variables__spec_id", "variables__value", "variables__spec__priority",
+                        "variables__spec__type", "variables__spec__application",
+                        "variables__spec__lookup_key", "variables__spec__formula"))
+    version = rate_table.cost_version
+    digest = hashlib.sha1(version.encode())
+    for value in extra:
+        digest.update(value.encode())
+    found = False
+    for pk, updated_at, *rest in rows:
+        digest.update(repr((pk, updated_at.isoformat(), *rest)).encode())
+        found = True
+    if not found:
+        return None
+    return '"{}"'.format(digest.hexdigest())
+
+
+def response_cache():
+    return caches[getattr(settings, "QUOTE_RESPONSE_CACHE", "default")]
+
+
+def cached_response(request, etag: str, respond: Callable[[], HttpResponse]) -> HttpResponse:
+    # 304 when the client already has this version, the rendered response
+    # from the cache when there is one, otherwise whatever respond() returns,
+    # which gets cached once it has been rendered (or right away when it
+    # already is).
+    # the JSON and the browsable API's HTML of the same quotes are different
+    # representations, with ETags of their own
+    media_type = getattr(request, "accepted_media_type", "")
+    etag = '"{}"'.format(hashlib.sha1("{}\0{}".format(etag, media_type).encode()).hexdigest())
+    response = get_conditional_response(request, etag=etag)
+    if response is None and not media_type.startswith("application/json"):
+        # the browsable API's HTML is per user, only JSON is cached
+        response = respond()
+    elif response is None:
+        cache = response_cache()
+        key = "quote-response:{}:{}".format(media_type.replace(" ", ""), etag.strip('"'))
+        cached = cache.get(key)
+        if cached is not None:
+            content, content_type = cached
+            response = HttpResponse(content, content_type=content_type)
+        else:
+            response = respond()
+            if response.status_code == 200:
+                timeout = getattr(settings, "QUOTE_RESPONSE_CACHE_TIMEOUT",
+                                  DEFAULT_RESPONSE_CACHE_TIMEOUT)
+                store = lambda r: cache.set(key, (r.content, r["Content-Type"]), timeout)
+                if getattr(response, "is_rendered", True):
+                    store(response)
+                else:
+                    response.add_post_render_callback(store)
+    response["ETag"] = etag
+    patch_vary_headers(response, ["Accept"])
+    return response
@@ -0,0 +1,90 @@
+from django.db import models, transaction
+from typing import Iterable, Set
+import logging
+
+from .models import (Quote, QuoteDependency, GLOBAL_SCOPE, STATE_TAX_RATE_KEY,
+                     VARIABLE_TYPE_STATE_LOOKUP, VARIABLE_TYPE_GLOBAL_LOOKUP,
+                     VARIABLE_TYPE_FORMULA, RATING_ERRORS, base_rate_key)
+from .formulas import FormulaError, formula_cache
+from .rate_table import RateKey, rate_table
+
+logger = logging.getLogger(__name__)
+
+
+def quote_dependencies(quote: Quote) -> Set[RateKey]:
+    # every (scope, key) the rater reads for this quote: the base rate for its
+    # coverage, its state's tax and the lookups of its variables.
+    return rating_dependencies(quote.state, quote.coverage_type,
+                               [var.spec for var in quote.variables.all()])
+
+
+def rating_dependencies(state: str, coverage_type: str, specs: Iterable) -> Set[RateKey]:
+    # quote_dependencies of a quote with those VariableSpecifications
+    deps = {(GLOBAL_SCOPE, base_rate_key(coverage_type)),
+            (state, STATE_TAX_RATE_KEY)}
+    for spec in specs:
+        if spec.type == VARIABLE_TYPE_STATE_LOOKUP:
+            deps.add((state, spec.lookup_key))
+        elif spec.type == VARIABLE_TYPE_GLOBAL_LOOKUP:
+            deps.add((GLOBAL_SCOPE, spec.lookup_key))
+        elif spec.type == VARIABLE_TYPE_FORMULA and spec.formula:
+            try:
+                rates = formula_cache.get(spec.code, spec.formula).rates
+            except FormulaError:
+                # the quote can't be rated until the formula is fixed, which
+                # re-rates and re-indexes it
+                continue
+            for scope, key in rates:
+                deps.add((state if scope == "state" else GLOBAL_SCOPE, key))
+    return deps
+
+
+def index_quotes(quotes: Iterable[Quote]):
+    # replaces the index rows of the quotes (with their variables loaded)
+    quotes = list(quotes)
+    if not quotes:
+        return
+    with transaction.atomic():
+        QuoteDependency.objects.filter(quote__in=[q.pk for q in quotes]).delete()
+        QuoteDependency.objects.bulk_create(
+            QuoteDependency(quote_id=quote.pk, scope=scope, key=key)
+            for quote in quotes
+            for scope, key in quote_dependencies(quote))
+
+
+def dependent_quotes(scope_keys: Iterable[RateKey]):
+    match = models.Q(pk__in=[])
+    for scope, key in set(scope_keys):
+        match |= models.Q(scope=scope, key=key)
+    pks = QuoteDependency.objects.filter(match).values("quote_id")
+    return Quote.objects.filter(pk__in=pks)
+
+
+def rerate_dependents(scope_keys: Iterable[RateKey], previous_version: str) -> int:
+    # Re-rates just the quotes that read one of the changed rate table
+    # entries. Everything else that was current under the previous table is
+    # still correct, so it only gets its rate_version moved forward. That is
+    # one UPDATE of the rate_version column (under a second for a million
+    # quotes on SQLite, next to minutes for re-rating the dependents of a
+    # commonly used entry), and it has to happen in this transaction: a
+    # process still rating against the previous table writes costs stamped
+    # with its version, which must come out stale rather than be carried
+    # forward with the rest.
+    scope_keys = set(scope_keys)
+    dependents = dependent_quotes(scope_keys)
+    with transaction.atomic():
+        try:
+            with transaction.atomic():
+                count = dependents.refresh_costs()
+        except RATING_ERRORS as e:
+            # a row some quotes still read went away, they can't be rated
+            # until it is back so just leave them stale.
+            logger.warning("can't re-rate quotes: %s", e)
+            count = dependents.update(rate_version=None)
+        if previous_version is not None:
+            (Quote.objects.
+             filter(rate_version=previous_version).
+             update(rate_version=rate_table.cost_version))
+    logger.info("re-rated %d quotes after a change to %s", count,
+                ", ".join("{}/{}".format(*sk) for sk in sorted(scope_keys)))
+    return count
@@ -0,0 +1,184 @@
+from datetime import datetime, timedelta, timezone as dt_timezone
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from io import StringIO
+from typing import Iterator, List, Optional, Sequence, Tuple
+import csv
+import json
+import math
+import numpy as np
+import os
+
+from .lean import chunked, rate_rows
+from .models import Quote, RatingResult, QUOTE_STATE_CHOICES, COVERAGE_TYPE_CHOICES
+from .rate_table import RateTable, rate_table
+
+# Dumps of every quote with its costs for reporting. Quotes are read as value
+# rows in pk order from a cursor, a chunk at a time, and rated like the lean
+# read path does (stored costs while they are current, the rest in one
+# batch), so memory stays flat whatever the size of the book. Quotes that
+# can't be rated are exported without costs rather than failing the dump.
+
+EXPORT_CHUNK_SIZE = 5000
+EXPORT_FORMATS = ("csv", "ndjson", "npy")
+EXPORT_COLUMNS = ("id", "customer_id", "customer_name", "description", "state", "coverage_type",
+                  "created_at", "updated_at", "subtotal", "taxes", "total")
+ROW_COLUMNS = ("pk", "customer_id", "customer__name", "description", "state", "coverage_type",
+               "created_at", "updated_at", "subtotal", "taxes", "total", "rate_version")
+
+# the columnar files leave out the free text columns, customer_id joins
+# against a customer dump
+NPY_COLUMNS = (
+    ("id", "<i8"),
+    ("customer_id", "<i8"),
+    ("state", "<U{}".format(max(len(c) for c, _ in QUOTE_STATE_CHOICES))),
+    ("coverage_type", "<U{}".format(max(len(c) for c, _ in COVERAGE_TYPE_CHOICES))),
+    ("created_at", "<M8[us]"),
+    ("updated_at", "<M8[us]"),
+    ("subtotal", "<f8"),
+    ("taxes", "<f8"),
+    ("total", "<f8"),
+)
+
+
+def parse_when(value: str, end: bool = False) -> datetime:
+    # an ISO date or datetime, dates are taken as midnight (the next one for
+    # the end of a range) in the current time zone. Raises ValueError.
+    # dates first, parse_datetime takes a bare date as midnight on 3.11
+    day = parse_date(value)
+    if day is not None:
+        when = datetime.combine(day, datetime.min.time())
+        if end:
+            when += timedelta(days=1)
+    else:
+        when = parse_datetime(value)
+        if when is None:
+            raise ValueError("not a date or datetime: {!r}".format(value))
+    if timezone.is_naive(when):
+        when = timezone.make_aware(when)
+    return when
+
+
+def export_queryset(states: Sequence[str] = None, coverage_types: Sequence[str] = None,
+                    created_after: datetime = None, created_before: datetime = None):
+    queryset = Quote.objects.all()
+    if states:
+        queryset = queryset.filter(state__in=states)
+    if coverage_types:
+        queryset = queryset.filter(coverage_type__in=coverage_types)
+    if created_after is not None:
+        queryset = queryset.filter(created_at__gte=created_after)
+    if created_before is not None:
+        queryset = queryset.filter(created_at__lt=created_before)
+    return queryset
+
+
+def rated_rows(queryset, table: RateTable = None,
+               chunk_size: int = EXPORT_CHUNK_SIZE) -> Iterator[Tuple[List[tuple], List[RatingResult]]]:
+    # (rows, costs) a chunk at a time, every chunk rated against the same table
+    if table is None:
+        table = rate_table.table()
+    rows = (queryset.
+            prefetch_related(None).
+            order_by("pk").
+            values_list(*ROW_COLUMNS, named=True).
+            iterator(chunk_size=chunk_size))
+    for chunk in chunked(rows, chunk_size):
+        yield chunk, rate_rows(chunk, table, strict=False)
+
+
+def cost(value: float) -> Optional[float]:
+    return None if math.isnan(value) else value
+
+
+def record(row, rate: RatingResult) -> tuple:
+    # a row in EXPORT_COLUMNS order
+    return (row.pk, row.customer_id, row.customer__name, row.description, row.state,
+            row.coverage_type, row.created_at.isoformat(), row.updated_at.isoformat(),
+            cost(rate.subtotal), cost(rate.taxes), cost(rate.total))
+
+
+def csv_header() -> str:
+    return ",".join(EXPORT_COLUMNS) + "\r\n"
+
+
+def csv_chunk(rows: List[tuple], costs: List[RatingResult]) -> str:
+    out = StringIO()
+    csv.writer(out).writerows(record(row, rate) for row, rate in zip(rows, costs))
+    return out.getvalue()
+
+
+def ndjson_chunk(rows: List[tuple], costs: List[RatingResult]) -> str:
+    return "".join(json.dumps(dict(zip(EXPORT_COLUMNS, record(row, rate))), ensure_ascii=False) + "\n"
+                   for row, rate in zip(rows, costs))
+
+
+ENCODERS = {"csv": csv_chunk, "ndjson": ndjson_chunk}
+
+
+def text_export(format: str, queryset, table: RateTable = None,
+                chunk_size: int = EXPORT_CHUNK_SIZE) -> Iterator[str]:
+    # the CSV (with a header line) or NDJSON export of the queryset in pieces
+    if format == "csv":
+        yield csv_header()
+    for rows, costs in rated_rows(queryset, table, chunk_size):
+        yield ENCODERS[format](rows, costs)
+
+
+class NpyExport:
+    # One .npy file per NPY_COLUMNS entry in a directory plus manifest.json,
+    # for np.load(path, mmap_mode="r"). The files are written a chunk at a
+    # time with a placeholder length in their headers that is filled in by
+    # close(); numpy leaves room in the header for exactly that.
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.rows = 0
+        self.files = {}
+        for name, dtype in NPY_COLUMNS:
+            f = open(os.path.join(directory, name + ".npy"), "wb")
+            self.header(f, dtype, 0)
+            self.files[name] = f
+
+    @staticmethod
+    def header(f, dtype: str, rows: int):
+        np.lib.format.write_array_header_1_0(f, {
+            "descr": np.lib.format.dtype_to_descr(np.dtype(dtype)),
+            "fortran_order": False,
+            "shape": (rows,)})
+
+    def write(self, rows: List[tuple], costs: List[RatingResult]):
+        columns = {
+            "id": [row.pk for row in rows],
+            "customer_id": [row.customer_id for row in rows],
+            "state": [row.state for row in rows],
+            "coverage_type": [row.coverage_type for row in rows],
+            "created_at": [utc(row.created_at) for row in rows],
+            "updated_at": [utc(row.updated_at) for row in rows],
+            "subtotal": [rate.subtotal for rate in costs],
+            "taxes": [rate.taxes for rate in costs],
+            "total": [rate.total for rate in costs],
+        }
+        for name, dtype in NPY_COLUMNS:
+            self.files[name].write(np.array(columns[name], dtype=dtype).tobytes())
+        self.rows += len(rows)
+
+    def close(self, **manifest):
+        for name, dtype in NPY_COLUMNS:
+            f = self.files[name]
+            f.seek(0)
+            self.header(f, dtype, self.rows)
+            f.close()
+        manifest = dict(
+            format="npy",
+            rows=self.rows,
+            columns=[dict(name=name, dtype=dtype, file=name + ".npy") for name, dtype in NPY_COLUMNS],
+            **manifest)
+        with open(os.path.join(self.directory, "manifest.json"), "w") as f:
+            json.dump(manifest, f, indent=2)
+        return manifest
+
+
+def utc(when: datetime) -> datetime:
+    # datetime64 has no time zone, the columns are in UTC
+    return when.astimezone(dt_timezone.utc).replace(tzinfo=None)
@@ -0,0 +1,47 @@
+from datetime import datetime
+from django.db.models.functions import Lower
+from typing import Sequence
+
+# Server side filters of the quotes list. Each of them is shaped to one of the
+# indexes in Quote.Meta and Customer.Meta (see 0007_filter_indexes), with the
+# list ordered by (created_at, id) for KeysetPagination:
+#
+# - state and coverage_type: (state, coverage_type, created_at, id)
+# - customer: (customer, created_at, id)
+# - created_after / created_before: (created_at, id)
+# - updated_after / updated_before: (updated_at)
+# - customer_name, a case insensitive prefix: lower(customer.name)
+
+
+def prefix_end(prefix: str) -> str:
+    # the smallest string after every string starting with prefix, so that
+    # a prefix match is a range an index can seek to
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def filter_quotes(queryset, state: Sequence[str] = (), coverage_type: Sequence[str] = (),
+                  customer: Sequence[int] = (), created_after: datetime = None,
+                  created_before: datetime = None, updated_after: datetime = None,
+                  updated_before: datetime = None, customer_name: str = None):
+    if state:
+        queryset = queryset.filter(state__in=state)
+    if coverage_type:
+        queryset = queryset.filter(coverage_type__in=coverage_type)
+    if customer:
+        queryset = queryset.filter(customer__in=customer)
+    if created_after is not None:
+        queryset = queryset.filter(created_at__gte=created_after)
+    if created_before is not None:
+        queryset = queryset.filter(created_at__lt=created_before)
+    if updated_after is not None:
+        queryset = queryset.filter(updated_at__gte=updated_after)
+    if updated_before is not None:
+        queryset = queryset.filter(updated_at__lt=updated_before)
+    if customer_name:
+        # the range on the indexed expression finds the customers, the
+        # istartswith keeps the match exact whatever the collation
+        prefix = customer_name.lower()
+        queryset = queryset.alias(customer_name_lower=Lower("customer__name")).filter(
+            customer_name_lower__gte=prefix, customer_name_lower__lt=prefix_end(prefix),
+            customer__name__istartswith=customer_name)
+    return queryset
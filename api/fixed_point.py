@@ -0,0 +1,113 @@
+from decimal import Decimal, ROUND_HALF_EVEN
+from typing import Tuple
+import numpy as np
+
+from .models import RatingResult
+
+# Integer arithmetic for the rating plans, selected with
+# settings.RATING_ARITHMETIC = "fixed" (see api.rating). Rates and values are
+# taken at their decimal value rather than their binary one and every step
+# rounds explicitly, so results don't depend on how a float happens to land
+# next to a cent:
+#
+# - amounts (base rates, additive values) are held in micros, millionths of a
+#   dollar, and percentages in basis points. Both are converted from the
+#   shortest decimal repr of the float, rounding half to even.
+# - a multiplier step adds sub * bp / 10000, rounded half to even to a micro.
+#   An additive step adds the amount, a simple variable without a value
+#   doubles the subtotal.
+# - the subtotal is rounded half to even to a cent. Taxes are the unrounded
+#   subtotal times the tax rate and the total is the rounded subtotal plus
+#   those, both floored to a cent.
+#
+# Running subtotals are kept to a ten-thousandth of a cent so that a chain of
+# multipliers doesn't drift by a cent a step. The results are the float
+# core's except where the exact amount is on a rounding boundary, which a
+# float lands either side of.
+
+MICROS = 10 ** 6  # per dollar
+MICROS_PER_CENT = 10 ** 4
+BASIS_POINTS = 10 ** 4  # per 1, 100 per percent
+# products past this fall back from int64 arrays to python ints
+INT64_LIMIT = 2 ** 62
+
+
+def scaled(value: float, scale: int) -> int:
+    # value * scale as an integer, rounded half to even
+    return int((Decimal(repr(value)) * scale).to_integral_value(ROUND_HALF_EVEN))
+
+
+def amount(value: float) -> int:
+    return scaled(value, MICROS)
+
+
+def basis_points(percent: float) -> int:
+    return scaled(percent, BASIS_POINTS // 100)
+
+
+def step_units(value: float, multiplier: bool) -> int:
+    # a step's value in the units it is applied in
+    return basis_points(value) if multiplier else amount(value)
+
+
+def div_round(n: int, d: int) -> int:
+    # n / d rounded half to even, d > 0
+    q, r = divmod(n, d)
+    if 2 * r > d or (2 * r == d and q % 2):
+        q += 1
+    return q
+
+
+def apply(sub: int, value: int, multiplier: bool) -> int:
+    if multiplier:
+        return sub + div_round(sub * value, BASIS_POINTS)
+    return sub + value
+
+
+def finish(sub: int, tax_rate: int) -> RatingResult:
+    # the rounded subtotal, taxes and total of a subtotal in micros and a tax
+    # rate in basis points
+    subtotal = div_round(sub, MICROS_PER_CENT)
+    tax = sub * tax_rate
+    scale = MICROS_PER_CENT * BASIS_POINTS
+    return RatingResult(subtotal=subtotal / 100,
+                        taxes=tax // scale / 100,
+                        total=(subtotal * scale + tax) // scale / 100)
+
+
+# The same in int64 arrays, for QuoteBatch. The callers check overflows() and
+# fall back to the python ints above.
+
+def scaled_array(values: np.ndarray, scales: Tuple[int, ...]) -> Tuple[np.ndarray, ...]:
+    # values (nan for missing) converted with scaled() at each of the scales,
+    # once per distinct value. Missing values come out as 0.
+    missing = np.isnan(values)
+    distinct, inverse = np.unique(np.where(missing, 0.0, values), return_inverse=True)
+    inverse = inverse.reshape(values.shape)
+    return tuple(np.array([scaled(v, scale) for v in distinct.tolist()], dtype=np.int64)[inverse]
+                 for scale in scales)
+
+
+def div_round_array(n: np.ndarray, d: int) -> np.ndarray:
+    q, r = np.divmod(n, d)
+    return q + ((2 * r > d) | ((2 * r == d) & (q % 2 == 1)))
+
+
+def apply_array(sub: np.ndarray, value: np.ndarray, multiplier: np.ndarray) -> np.ndarray:
+    return np.where(multiplier, sub + div_round_array(sub * value, BASIS_POINTS), sub + value)
+
+
+def finish_arrays(sub: np.ndarray, tax_rate: np.ndarray) -> Tuple[np.ndarray, ...]:
+    # finish() as float subtotals, taxes and totals
+    subtotal = div_round_array(sub, MICROS_PER_CENT)
+    tax = sub * tax_rate
+    scale = MICROS_PER_CENT * BASIS_POINTS
+    return subtotal / 100, tax // scale / 100, (subtotal * scale + tax) // scale / 100
+
+
+def overflows(sub: np.ndarray, value) -> bool:
+    # whether sub * value (or sub + sub) could leave int64
+    if not sub.size:
+        return False
+    largest = float(np.abs(sub).max())
+    return largest * max(float(np.abs(value).max(initial=0)), 2.0) >= INT64_LIMIT
@@ -0,0 +1,304 @@
+from collections import OrderedDict
+from django.core.exceptions import ValidationError
+from typing import Dict, FrozenSet, Mapping, Tuple
+import ast
+import hashlib
+import threading
+import numpy as np
+
+# Formula variables work out their value from an expression instead of a
+# lookup or the quote, e.g. a surcharge tiered on the running subtotal:
+#
+#     25 if subtotal > 1000 else 10 if subtotal > 500 else 0
+#
+# which is then applied like any other value of the spec's application (a
+# percentage for multipliers, an amount for additives). An expression can use
+#
+# - subtotal, the running subtotal when the step is applied, and value, the
+#   quote variable's own value (0 when it has none)
+# - state and coverage_type, compared with == / != / in against strings
+# - the value of any other variable on the quote by its spec code, 0 when
+#   the quote doesn't have it
+# - state_rate("key") and global_rate("key"), rate table entries for the
+#   quote's state and the global scope
+# - numbers, + - * / (anything / 0 is 0), comparisons, and / or / not,
+#   x if condition else y, min(), max() and abs()
+#
+# Expressions are parsed and checked once, nothing outside that list gets
+# through, and rewritten into a lambda over numpy functions. The same
+# callable evaluates a single quote (python scalars) or a whole column of
+# them (arrays) in QuoteBatch.
+
+MAX_FORMULA_LENGTH = 1000
+DEFAULT_FORMULA_CACHE_SIZE = 1024
+
+NUMBER = "number"
+TEXT = "text"
+BOOLEAN = "boolean"
+TEXT_NAMES = ("state", "coverage_type")
+NUMBER_NAMES = ("subtotal", "value")
+RATE_FUNCTIONS = {"state_rate": "state", "global_rate": "global"}
+
+# (scope, key) of a rate an expression reads, the scope being "state" or
+# "global"
+RateRef = Tuple[str, str]
+
+
+class FormulaError(ValueError):
+    pass
+
+
+def divide(a, b):
+    # x / 0 is 0 rather than an error, so that a formula can't fail a quote
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(np.equal(b, 0), 0.0, np.true_divide(a, np.where(np.equal(b, 0), 1.0, b)))
+
+
+HELPERS = {
+    "_divide": divide,
+    "_and": np.logical_and,
+    "_or": np.logical_or,
+    "_not": np.logical_not,
+    "_where": np.where,
+    "_isin": np.isin,
+    "_min": np.minimum,
+    "_max": np.maximum,
+    "_abs": np.abs,
+}
+FUNCTIONS = {"min": "_min", "max": "_max", "abs": "_abs"}
+COMPARISONS = (ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE, ast.In, ast.NotIn)
+ARITHMETIC = {ast.Add: None, ast.Sub: None, ast.Mult: None, ast.Div: "_divide"}
+
+
+def helper(name: str, *args: ast.expr) -> ast.Call:
+    return ast.Call(func=ast.Name(id=name, ctx=ast.Load()), args=list(args), keywords=[])
+
+
+def variable(name) -> ast.Subscript:
+    # v[name], the lambda's single argument holds everything an expression reads
+    return ast.Subscript(value=ast.Name(id="v", ctx=ast.Load()),
+                         slice=ast.Constant(value=name), ctx=ast.Load())
+
+
+class Checker:
+    # Walks a parsed expression, checking every node against the grammar
+    # above and the types of its operands, and builds the rewritten tree.
+    def __init__(self):
+        self.names = set()
+        self.rates = set()
+
+    def check(self, node: ast.AST) -> Tuple[str, ast.expr]:
+        method = getattr(self, "check_" + type(node).__name__, None)
+        if method is None:
+            raise FormulaError("{} is not allowed".format(describe(node)))
+        return method(node)
+
+    def expect(self, node: ast.AST, kind: str) -> ast.expr:
+        found, rewritten = self.check(node)
+        if found != kind:
+            raise FormulaError("expected a {}, not a {}: {}".format(kind, found, ast.unparse(node)))
+        return rewritten
+
+    def check_Constant(self, node: ast.Constant):
+        if isinstance(node.value, bool):
+            return BOOLEAN, node
+        if isinstance(node.value, (int, float)):
+            try:
+                return NUMBER, ast.Constant(value=float(node.value))
+            except OverflowError:
+                raise FormulaError("a number is too large")
+        if isinstance(node.value, str):
+            return TEXT, node
+        raise FormulaError("{!r} is not allowed".format(node.value))
+
+    def check_Name(self, node: ast.Name):
+        if node.id in TEXT_NAMES:
+            return TEXT, variable(node.id)
+        if node.id in NUMBER_NAMES:
+            return NUMBER, variable(node.id)
+        if node.id in FUNCTIONS or node.id in RATE_FUNCTIONS:
+            raise FormulaError("{} has to be called".format(node.id))
+        self.names.add(node.id)
+        return NUMBER, variable(node.id)
+
+    def check_BinOp(self, node: ast.BinOp):
+        if type(node.op) not in ARITHMETIC:
+            raise FormulaError("{} is not allowed".format(describe(node.op)))
+        left, right = self.expect(node.left, NUMBER), self.expect(node.right, NUMBER)
+        name = ARITHMETIC[type(node.op)]
+        if name is not None:
+            return NUMBER, helper(name, left, right)
+        return NUMBER, ast.BinOp(left=left, op=node.op, right=right)
+
+    def check_UnaryOp(self, node: ast.UnaryOp):
+        if isinstance(node.op, ast.Not):
+            return BOOLEAN, helper("_not", self.expect(node.operand, BOOLEAN))
+        if isinstance(node.op, (ast.USub, ast.UAdd)):
+            return NUMBER, ast.UnaryOp(op=node.op, operand=self.expect(node.operand, NUMBER))
+        raise FormulaError("{} is not allowed".format(describe(node.op)))
+
+    def check_BoolOp(self, node: ast.BoolOp):
+        name = "_and" if isinstance(node.op, ast.And) else "_or"
+        values = [self.expect(value, BOOLEAN) for value in node.values]
+        result = values[0]
+        for value in values[1:]:
+            result = helper(name, result, value)
+        return BOOLEAN, result
+
+    def check_Compare(self, node: ast.Compare):
+        # a < b < c is a < b and b < c
+        result = None
+        left_kind, left = self.check(node.left)
+        for op, comparator in zip(node.ops, node.comparators):
+            if not isinstance(op, COMPARISONS):
+                raise FormulaError("{} is not allowed".format(describe(op)))
+            if isinstance(op, (ast.In, ast.NotIn)):
+                if len(node.ops) > 1:
+                    raise FormulaError("in can't be chained")
+                if not isinstance(comparator, (ast.Tuple, ast.List)):
+                    raise FormulaError("in needs a list of constants")
+                options = [self.check(element) for element in comparator.elts]
+                if any(kind != left_kind or not isinstance(option, ast.Constant)
+                       for kind, option in options):
+                    raise FormulaError("in needs a list of {} constants".format(left_kind))
+                test = helper("_isin", left, ast.Tuple(elts=[option for _, option in options],
+                                                       ctx=ast.Load()))
+                if isinstance(op, ast.NotIn):
+                    test = helper("_not", test)
+                right_kind = right = None
+            else:
+                right_kind, right = self.check(comparator)
+                if left_kind != right_kind or left_kind == BOOLEAN:
+                    raise FormulaError("can't compare a {} with a {}".format(left_kind, right_kind))
+                if left_kind == TEXT and not isinstance(op, (ast.Eq, ast.NotEq)):
+                    raise FormulaError("text can only be compared with == and !=")
+                test = ast.Compare(left=left, ops=[op], comparators=[right])
+            result = test if result is None else helper("_and", result, test)
+            left_kind, left = right_kind, right
+        return BOOLEAN, result
+
+    def check_IfExp(self, node: ast.IfExp):
+        return NUMBER, helper("_where", self.expect(node.test, BOOLEAN),
+                              self.expect(node.body, NUMBER), self.expect(node.orelse, NUMBER))
+
+    def check_Call(self, node: ast.Call):
+        if not isinstance(node.func, ast.Name) or node.keywords:
+            raise FormulaError("only {} can be called".format(
+                ", ".join(sorted([*FUNCTIONS, *RATE_FUNCTIONS]))))
+        name = node.func.id
+        if name in RATE_FUNCTIONS:
+            if len(node.args) != 1 or not isinstance(node.args[0], ast.Constant) \
+                    or not isinstance(node.args[0].value, str):
+                raise FormulaError("{} takes a rate table key".format(name))
+            ref = (RATE_FUNCTIONS[name], node.args[0].value)
+            self.rates.add(ref)
+            return NUMBER, variable(ref)
+        if name not in FUNCTIONS:
+            raise FormulaError("{} is not a function".format(name))
+        args = [self.expect(arg, NUMBER) for arg in node.args]
+        if name == "abs" and len(args) != 1:
+            raise FormulaError("abs takes one number")
+        if name != "abs" and len(args) < 2:
+            raise FormulaError("{} takes two or more numbers".format(name))
+        result = args[0] if name != "abs" else helper(FUNCTIONS[name], args[0])
+        for arg in args[1:]:
+            result = helper(FUNCTIONS[name], result, arg)
+        return NUMBER, result
+
+
+def describe(node: ast.AST) -> str:
+    return type(node).__name__
+
+
+class Formula:
+    # A checked and compiled expression. names are the variable codes it
+    # reads and rates the rate table entries.
+    def __init__(self, text: str):
+        if len(text) > MAX_FORMULA_LENGTH:
+            raise FormulaError("formulas are limited to {} characters".format(MAX_FORMULA_LENGTH))
+        try:
+            tree = ast.parse(text.strip(), mode="eval")
+        except (SyntaxError, ValueError) as e:
+            raise FormulaError("not an expression: {}".format(e))
+        checker = Checker()
+        try:
+            kind, body = checker.check(tree.body)
+        except RecursionError:
+            raise FormulaError("too deeply nested")
+        if kind != NUMBER:
+            raise FormulaError("a formula has to give a number, not a {}".format(kind))
+        self.text = text
+        self.names: FrozenSet[str] = frozenset(checker.names)
+        self.rates: FrozenSet[RateRef] = frozenset(checker.rates)
+        function = ast.Expression(body=ast.Lambda(
+            args=ast.arguments(posonlyargs=[], args=[ast.arg(arg="v")], kwonlyargs=[],
+                               kw_defaults=[], defaults=[]),
+            body=body))
+        code = compile(ast.fix_missing_locations(function), "<formula>", "eval")
+        self.function = eval(code, {"__builtins__": {}, **HELPERS})
+
+    def evaluate(self, subtotal, value, state, coverage_type,
+                 variables: Mapping[str, object], rates: Mapping[RateRef, object]):
+        # the formula's value for one quote (python scalars, returns a float)
+        # or many (arrays, returns an array of the subtotal's shape). Missing
+        # values of variables are nan or None, which read as 0.
+        v = {"subtotal": subtotal, "value": zero_missing(value),
+             "state": state, "coverage_type": coverage_type}
+        for name in self.names:
+            v[name] = zero_missing(variables.get(name))
+        for ref in self.rates:
+            v[ref] = rates[ref]
+        result = self.function(v)
+        if isinstance(subtotal, np.ndarray):
+            return np.broadcast_to(np.asarray(result, dtype=float), subtotal.shape)
+        return float(result)
+
+
+def zero_missing(value):
+    if value is None:
+        return 0.0
+    if isinstance(value, np.ndarray):
+        return np.where(np.isnan(value), 0.0, value)
+    return 0.0 if value != value else value
+
+
+def formula_stamp(text: str) -> str:
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+
+class FormulaCache:
+    # Compiled formulas keyed by spec code and a stamp of the expression, so
+    # an edited spec compiles afresh and the old entry ages out.
+    def __init__(self, maxsize: int = DEFAULT_FORMULA_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._formulas: Dict[Tuple[str, str], Formula] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, code: str, text: str) -> Formula:
+        key = (code, formula_stamp(text))
+        with self._lock:
+            formula = self._formulas.get(key)
+            if formula is not None:
+                self._formulas.move_to_end(key)
+                return formula
+        formula = Formula(text)
+        with self._lock:
+            self._formulas[key] = formula
+            while len(self._formulas) > self.maxsize:
+                self._formulas.popitem(last=False)
+        return formula
+
+    def clear(self):
+        with self._lock:
+            self._formulas.clear()
+
+
+formula_cache = FormulaCache()
+
+
+def validate_formula(text: str):
+    # VariableSpecification.formula's validator
+    try:
+        Formula(text)
+    except FormulaError as e:
+        raise ValidationError(str(e))
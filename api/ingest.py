@@ -0,0 +1,353 @@
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.utils import timezone
+from typing import Dict, Iterable, Iterator, List, Set, Tuple
+import csv
+import json
+import logging
+import time
+
+from .dependencies import dependent_quotes, rerate_dependents
+from .models import (Customer, PolicyVariable, Quote, QuoteVariable, VariableSpecification,
+                     RATING_ERRORS)
+from .rate_table import rate_table
+
+logger = logging.getLogger(__name__)
+
+# Bulk loading of CSV or NDJSON files a chunk of rows at a time. Rows are
+# checked against the model fields (choices included) in Python, references
+# are resolved a chunk at a time or from memory and every chunk is written
+# with bulk_create, as an upsert on the model's unique fields, in its own
+# transaction. bulk_create skips the signals in api.signals, so each target
+# does what they would have: the quotes a chunk touches are re-rated (or
+# left stale with defer_costs, for rerate_quotes --stale) and rate table
+# changes re-rate their dependents at the end.
+
+INGEST_BATCH_SIZE = 5000
+FORMATS = ("csv", "ndjson")
+
+
+def read_rows(f, format: str) -> Iterator[Tuple[int, dict]]:
+    # (line number, row) pairs, CSV needs a header line
+    if format == "csv":
+        reader = csv.DictReader(f)
+        for row in reader:
+            yield reader.line_num, row
+    else:
+        for line, text in enumerate(f, 1):
+            if text.strip():
+                try:
+                    row = json.loads(text)
+                except ValueError as e:
+                    row = e
+                yield line, row
+
+
+def chunked(rows: Iterable, size: int) -> Iterator[list]:
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class Target:
+    # How the rows of one model are checked and written. `fields` are the
+    # columns a file may have, `unique_fields` what an upsert matches on.
+    model = None
+    fields: Tuple[str, ...] = ()
+    required: Tuple[str, ...] = ()
+    unique_fields: Tuple[str, ...] = ()
+
+    def __init__(self, defer_costs: bool = False):
+        self.defer_costs = defer_costs
+        self.refreshed = 0
+        self.stale = 0
+
+    def clean(self, row: dict) -> dict:
+        # the row's values converted and validated by their model fields,
+        # keyed by attname. Raises ValidationError.
+        if not isinstance(row, dict):
+            raise ValidationError("expected an object")
+        if None in row:
+            raise ValidationError("more values than columns")
+        unknown = set(row) - set(self.fields)
+        if unknown:
+            raise ValidationError("unknown columns: {}".format(", ".join(sorted(unknown))))
+        missing = set(self.required) - set(row)
+        if missing:
+            raise ValidationError("missing columns: {}".format(", ".join(sorted(missing))))
+        values, errors = {}, {}
+        for name, value in row.items():
+            field = self.model._meta.get_field(name)
+            if value == "" and (field.null or field.is_relation or field.primary_key):
+                value = None
+            try:
+                if value is None and field.primary_key:
+                    # a new row
+                    values[field.attname] = None
+                elif field.is_relation:
+                    if value is None:
+                        raise ValidationError(field.error_messages["null"], code="null")
+                    values[field.attname] = field.target_field.to_python(value)
+                else:
+                    values[field.attname] = field.clean(value, None)
+            except ValidationError as e:
+                errors[name] = e.messages
+        if errors:
+            raise ValidationError(errors)
+        return values
+
+    def missing_references(self, rows: List[dict]) -> Dict[int, str]:
+        # row index -> error for rows that point at something that isn't there
+        return {}
+
+    def write(self, rows: List[dict], columns: Set[str]) -> list:
+        # rows without a primary key are inserted, the rest are upserted.
+        # Returns the inserted objects, with their pks.
+        pk = self.model._meta.pk
+        new = [self.model(**row) for row in rows
+               if pk.name in self.fields and row.get(pk.attname) is None]
+        if new:
+            self.model.objects.bulk_create(new)
+        keyed = [self.model(**row) for row in rows
+                 if pk.name not in self.fields or row.get(pk.attname) is not None]
+        update_fields = self.update_fields(columns)
+        if keyed and update_fields:
+            self.model.objects.bulk_create(keyed, update_conflicts=True,
+                                           unique_fields=list(self.unique_fields),
+                                           update_fields=update_fields)
+        elif keyed:
+            self.model.objects.bulk_create(keyed, ignore_conflicts=True)
+        return new
+
+    def update_fields(self, columns: Set[str]) -> List[str]:
+        # only what the file has, missing columns keep their stored values
+        return [f for f in self.fields if f in columns and f not in self.unique_fields]
+
+    def refresh(self, quotes):
+        # brings the costs of a queryset of quotes back in line with what was
+        # just written, or marks them stale
+        if self.defer_costs:
+            self.stale += quotes.update(rate_version=None, updated_at=timezone.now())
+            return
+        try:
+            with transaction.atomic():
+                self.refreshed += quotes.refresh_costs()
+        except RATING_ERRORS as e:
+            # a rate they read isn't there (yet), leave them stale
+            logger.warning("can't rate ingested quotes: %s", e)
+            self.stale += quotes.update(rate_version=None, updated_at=timezone.now())
+
+    def finish(self):
+        pass
+
+
+def existing(model, pks: Iterable) -> Set:
+    return set(model.objects.prefetch_related(None).filter(pk__in=set(pks)).values_list(
+        "pk", flat=True))
+
+
+class CustomerTarget(Target):
+    model = Customer
+    fields = ("id", "name")
+    required = ("name",)
+    unique_fields = ("id",)
+
+
+class QuoteTarget(Target):
+    model = Quote
+    fields = ("id", "customer", "description", "state", "coverage_type")
+    required = ("customer", "state")
+    unique_fields = ("id",)
+
+    def missing_references(self, rows: List[dict]) -> Dict[int, str]:
+        customers = existing(Customer, (row["customer_id"] for row in rows))
+        return {i: "customer {} does not exist".format(row["customer_id"])
+                for i, row in enumerate(rows) if row["customer_id"] not in customers}
+
+    def write(self, rows: List[dict], columns: Set[str]) -> list:
+        new = super().write(rows, columns)
+        self.refresh(Quote.objects.filter(
+            pk__in=[q.pk for q in new] + [row["id"] for row in rows if row.get("id") is not None]))
+        return new
+
+    def update_fields(self, columns: Set[str]) -> List[str]:
+        return super().update_fields(columns) + ["updated_at"]
+
+
+class QuoteVariableTarget(Target):
+    model = QuoteVariable
+    fields = ("quote", "spec", "value", "notes")
+    required = ("quote", "spec")
+    unique_fields = ("quote", "spec")
+
+    def __init__(self, defer_costs: bool = False):
+        super().__init__(defer_costs)
+        self.specs = set(VariableSpecification.objects.values_list("code", flat=True))
+
+    def missing_references(self, rows: List[dict]) -> Dict[int, str]:
+        quotes = existing(Quote, (row["quote_id"] for row in rows))
+        missing = {}
+        for i, row in enumerate(rows):
+            if row["quote_id"] not in quotes:
+                missing[i] = "quote {} does not exist".format(row["quote_id"])
+            elif row["spec_id"] not in self.specs:
+                missing[i] = "variable specification {} does not exist".format(row["spec_id"])
+        return missing
+
+    def write(self, rows: List[dict], columns: Set[str]) -> list:
+        new = super().write(rows, columns)
+        self.refresh(Quote.objects.filter(pk__in={row["quote_id"] for row in rows}))
+        return new
+
+
+class VariableSpecificationTarget(Target):
+    model = VariableSpecification
+    fields = ("code", "type", "application", "description", "default_value", "priority",
+              "lookup_key", "formula")
+    required = ("code", "type", "application")
+    unique_fields = ("code",)
+
+    def clean(self, row: dict) -> dict:
+        values = super().clean(row)
+        VariableSpecification(**values).clean()
+        return values
+
+    def write(self, rows: List[dict], columns: Set[str]) -> list:
+        # the quotes that already use a spec are rated differently now
+        changed = existing(VariableSpecification, (row["code"] for row in rows))
+        new = super().write(rows, columns)
+        if changed:
+            self.refresh(Quote.objects.filter(
+                pk__in=QuoteVariable.objects.filter(spec__in=changed).values("quote_id")))
+        return new
+
+
+class PolicyVariableTarget(Target):
+    model = PolicyVariable
+    fields = ("scope", "key", "value")
+    required = ("key", "value")
+    unique_fields = ("key", "scope")
+
+    def __init__(self, defer_costs: bool = False):
+        super().__init__(defer_costs)
+        table = rate_table.table()
+        self.version = table.cost_version
+        self.values = table.values
+        self.changed = set()
+
+    def write(self, rows: List[dict], columns: Set[str]) -> list:
+        new = super().write(rows, columns)
+        for row in rows:
+            scope_key = (row.get("scope", "global"), row["key"])
+            if self.values.get(scope_key) != row["value"]:
+                self.changed.add(scope_key)
+        rate_table.invalidate()
+        transaction.on_commit(rate_table.invalidate)
+        return new
+
+    def update_fields(self, columns: Set[str]) -> List[str]:
+        return ["value"]
+
+    def finish(self):
+        # what the signals do for one row, once for the whole file
+        if not self.changed:
+            return
+        if not self.defer_costs:
+            self.refreshed += rerate_dependents(self.changed, self.version)
+            return
+        with transaction.atomic():
+            self.stale += dependent_quotes(self.changed).update(rate_version=None)
+            # the rest moves forward in the same transaction, see rerate_dependents
+            (Quote.objects.
+             filter(rate_version=self.version).
+             update(rate_version=rate_table.cost_version))
+
+
+TARGETS = {
+    "customer": CustomerTarget,
+    "quote": QuoteTarget,
+    "quote_variable": QuoteVariableTarget,
+    "variable_specification": VariableSpecificationTarget,
+    "policy_variable": PolicyVariableTarget,
+}
+
+
+class Ingest:
+    # Loads (line, row) pairs into one of the TARGETS, batch_size rows per
+    # transaction. Invalid rows are skipped and recorded in errors; more than
+    # max_errors of them stops the load with a ValueError, the chunks
+    # written until then stay.
+    def __init__(self, target: str, defer_costs: bool = False,
+                 batch_size: int = INGEST_BATCH_SIZE, max_errors: int = 0):
+        self.target = TARGETS[target](defer_costs)
+        self.batch_size = batch_size
+        self.max_errors = max_errors
+        self.rows = 0
+        self.written = 0
+        self.errors: List[Tuple[int, str]] = []
+        self.seconds = 0.0
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.seconds if self.seconds else 0.0
+
+    def load(self, rows: Iterable[Tuple[int, dict]], progress=None):
+        started = time.perf_counter()
+        try:
+            for chunk in chunked(rows, self.batch_size):
+                self.load_chunk(chunk)
+                self.seconds = time.perf_counter() - started
+                if progress is not None:
+                    progress(self)
+            self.target.finish()
+        finally:
+            self.seconds = time.perf_counter() - started
+
+    def load_chunk(self, chunk: List[Tuple[int, dict]]):
+        self.rows += len(chunk)
+        lines, rows, columns = [], [], []
+        for line, row in chunk:
+            try:
+                if isinstance(row, Exception):
+                    raise ValidationError("not JSON: {}".format(row))
+                rows.append(self.target.clean(row))
+                lines.append(line)
+                columns.append(frozenset(row))
+            except ValidationError as e:
+                self.error(line, e)
+        missing = self.target.missing_references(rows)
+        for i, message in sorted(missing.items()):
+            self.error(lines[i], ValidationError(message))
+        # rows are upserted with the columns they have, NDJSON rows may differ
+        groups = {}
+        for i, row in enumerate(rows):
+            if i not in missing:
+                groups.setdefault(columns[i], []).append(row)
+        with transaction.atomic():
+            for group_columns, group in groups.items():
+                self.target.write(group, group_columns)
+                self.written += len(group)
+
+    def error(self, line: int, error: ValidationError):
+        if hasattr(error, "error_dict"):
+            message = "; ".join("{}: {}".format(field, " ".join(messages))
+                                for field, messages in error.message_dict.items())
+        else:
+            message = " ".join(error.messages)
+        self.errors.append((line, message))
+        if len(self.errors) > self.max_errors:
+            raise ValueError("line {}: {} (stopping after {} invalid rows)".format(
+                line, message, len(self.errors)))
+
+    @property
+    def refreshed(self) -> int:
+        return self.target.refreshed
+
+    @property
+    def stale(self) -> int:
+        return self.target.stale
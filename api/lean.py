@@ -0,0 +1,96 @@
+from django.http import HttpResponse
+from rest_framework.renderers import JSONRenderer
+from typing import Iterable, Iterator, List
+import time
+
+from .metrics import record_rating, serialization
+from .models import QuoteVariable, RatingResult
+from .rate_table import RateTable, rate_table
+from .rating import build_batch
+
+# The read path of the quote endpoints without models or serializers: the
+# columns QuoteSerializer shows are read as value rows, the quotes whose
+# stored costs are stale are rated together from their variables' rows and
+# plain dicts are rendered straight to bytes. The JSON is byte for byte what
+# QuoteSerializer and JSONRenderer produce, which is still what writes and
+# the browsable API go through.
+
+QUOTE_COLUMNS = ("pk", "created_at", "customer__name", "description", "state", "coverage_type",
+                 "subtotal", "taxes", "total", "rate_version")
+
+renderer = JSONRenderer()
+
+
+def quote_rows(queryset) -> List[tuple]:
+    # named rows, so that they have the created_at and pk KeysetPagination
+    # keys pages on
+    return list(queryset.prefetch_related(None).values_list(*QUOTE_COLUMNS, named=True))
+
+
+def rate_rows(rows: List[tuple], table: RateTable = None, strict: bool = True) -> List[RatingResult]:
+    # the costs of the rows: their stored costs while those are current, the
+    # rest rated in one batch (two queries). Unless strict, quotes that can't
+    # be rated get nan costs.
+    if table is None:
+        table = rate_table.table()
+    costs = [None] * len(rows)
+    stale = []
+    version = table.cost_version
+    for i, row in enumerate(rows):
+        if row.total is None or row.rate_version != version:
+            stale.append(i)
+        else:
+            costs[i] = RatingResult(row.subtotal, row.taxes, row.total)
+    if stale:
+        stale.sort(key=lambda i: rows[i].pk)
+        started = time.perf_counter()
+        batch = build_batch([(rows[i].pk, rows[i].state, rows[i].coverage_type) for i in stale],
+                            QuoteVariable.objects.filter(quote__in=[rows[i].pk for i in stale]))
+        for i, rate in zip(stale, batch.rate(table, strict)):
+            costs[i] = rate
+        record_rating(time.perf_counter() - started, len(stale))
+    return costs
+
+
+def quote_data(rows: List[tuple], costs: List[RatingResult]) -> List[dict]:
+    # what QuoteSerializer(many=True).data holds, in the same key order
+    with serialization():
+        return [{"customer_name": row.customer__name,
+                 "description": row.description,
+                 "state": row.state,
+                 "coverage_type": row.coverage_type,
+                 "cost": {"subtotal": cost.subtotal, "taxes": cost.taxes, "total": cost.total}}
+                for row, cost in zip(rows, costs)]
+
+
+def render(data) -> bytes:
+    with serialization():
+        return renderer.render(data)
+
+
+def render_quotes(queryset) -> bytes:
+    # the JSON array of every quote in the queryset
+    rows = quote_rows(queryset)
+    return render(quote_data(rows, rate_rows(rows)))
+
+
+def chunked(rows: Iterable[tuple], size: int) -> Iterator[List[tuple]]:
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def json_response(content: bytes) -> HttpResponse:
+    return HttpResponse(content, content_type=renderer.media_type)
+
+
+def accepts_lean(request) -> bool:
+    # plain JSON only, the browsable API and indented JSON go through the
+    # serializer and the renderer as usual
+    media_type = getattr(request, "accepted_media_type", "")
+    return media_type.startswith(renderer.media_type) and "indent" not in media_type
@@ -0,0 +1,288 @@
+from django.db import connections
+from io import BytesIO
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+from urllib.parse import urlsplit
+import asyncio
+import http.client
+import random
+import re
+import sys
+import threading
+import time
+import numpy as np
+
+from .synthetic import STATES
+
+# Concurrent load against the quote endpoints, for the load_test command.
+# A seeded plan of requests (a mix of list, filtered list and detail reads of
+# the synthetic book) is worked through by `concurrency` clients that each
+# send their next request as soon as the last one is answered, either
+# in-process through the WSGI or ASGI application or over HTTP against a
+# running server. Every request's latency is kept, along with the SQL queries
+# it made as reported in its Server-Timing header (see api.metrics).
+
+LOAD_TEST_MIX = "list=1,detail=8,filtered=1"
+LIST_PAGE_SIZE = 100
+LATENCY_PERCENTILES = (50, 95, 99)
+HOST = "testserver"
+
+# kind: (path, query string) of a request for a random quote pk and state
+REQUEST_KINDS = {
+    "list": lambda pk, state: ("/api/v1/quotes/", "page_size={}".format(LIST_PAGE_SIZE)),
+    "filtered": lambda pk, state: ("/api/v1/quotes/",
+                                   "state={}&page_size={}".format(state, LIST_PAGE_SIZE)),
+    "detail": lambda pk, state: ("/api/v1/quotes/{}/".format(pk), ""),
+    "async_list": lambda pk, state: ("/api/v1/async/quotes/", "page_size={}".format(LIST_PAGE_SIZE)),
+    "async_detail": lambda pk, state: ("/api/v1/async/quotes/{}/".format(pk), ""),
+}
+
+# MetricsMiddleware's query count
+SERVER_TIMING_QUERIES = re.compile(r'db;[^,]*desc="(\d+) queries"')
+
+
+class Sample(NamedTuple):
+    kind: str
+    # 0 when the request failed without a response
+    status: int
+    seconds: float
+    # None without a Server-Timing header
+    queries: Optional[int]
+
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    # "list=1,detail=8" as {kind: weight}. Raises ValueError.
+    weights = {}
+    for part in mix.split(","):
+        kind, _, weight = part.strip().partition("=")
+        if kind not in REQUEST_KINDS:
+            raise ValueError("unknown request kind {!r}, expected one of {}".format(
+                kind, ", ".join(REQUEST_KINDS)))
+        weights[kind] = float(weight or 1)
+        if weights[kind] < 0:
+            raise ValueError("negative weight for {}".format(kind))
+    if not sum(weights.values()):
+        raise ValueError("the mix has no weight")
+    return weights
+
+
+def request_plan(mix: Dict[str, float], pks: Sequence[int], count: int,
+                 seed: int = 0) -> List[Tuple[str, str, str]]:
+    # count (kind, path, query string) requests, the same ones for the same
+    # mix, quotes and seed
+    rng = random.Random(seed)
+    kinds = rng.choices(list(mix), weights=list(mix.values()), k=count)
+    return [(kind, *REQUEST_KINDS[kind](rng.choice(pks), rng.choice(STATES))) for kind in kinds]
+
+
+def server_timing_queries(header: Optional[str]) -> Optional[int]:
+    match = SERVER_TIMING_QUERIES.search(header or "")
+    return int(match.group(1)) if match else None
+
+
+class Target:
+    # Sends the plan's requests from `concurrency` threads.
+    def request(self, path: str, query: str) -> Tuple[int, Optional[str]]:
+        # the status and Server-Timing header of the response
+        raise NotImplementedError
+
+    def timed(self, kind: str, path: str, query: str) -> Sample:
+        started = time.perf_counter()
+        try:
+            status, server_timing = self.request(path, query)
+        except Exception:
+            status, server_timing = 0, None
+        return Sample(kind, status, time.perf_counter() - started,
+                      server_timing_queries(server_timing))
+
+    def run(self, plan: List[Tuple[str, str, str]], concurrency: int) -> Tuple[List[Sample], float]:
+        # the samples in the order they finished and the seconds it took
+        pending = iter(plan)
+        lock = threading.Lock()
+        samples = []
+
+        def client():
+            try:
+                while True:
+                    with lock:
+                        request = next(pending, None)
+                    if request is None:
+                        return
+                    samples.append(self.timed(*request))
+            finally:
+                connections.close_all()
+
+        clients = [threading.Thread(target=client) for _ in range(concurrency)]
+        started = time.perf_counter()
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+        return samples, time.perf_counter() - started
+
+
+class WsgiTarget(Target):
+    def __init__(self, application):
+        self.application = application
+
+    def request(self, path: str, query: str) -> Tuple[int, Optional[str]]:
+        environ = {
+            "REQUEST_METHOD": "GET",
+            "SCRIPT_NAME": "",
+            "PATH_INFO": path,
+            "QUERY_STRING": query,
+            "SERVER_NAME": HOST,
+            "SERVER_PORT": "80",
+            "SERVER_PROTOCOL": "HTTP/1.1",
+            "HTTP_HOST": HOST,
+            "HTTP_ACCEPT": "application/json",
+            "REMOTE_ADDR": "127.0.0.1",
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": "http",
+            "wsgi.input": BytesIO(),
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+        }
+        started = []
+
+        def start_response(status, headers, exc_info=None):
+            started.append((int(status.split()[0]), dict(headers).get("Server-Timing")))
+
+        body = self.application(environ, start_response)
+        try:
+            for _ in body:
+                pass
+        finally:
+            if hasattr(body, "close"):
+                body.close()
+        return started[0]
+
+
+class AsgiTarget(Target):
+    # the clients are tasks on one event loop, like connections on one
+    # ASGI worker
+    def __init__(self, application):
+        self.application = application
+
+    async def arequest(self, path: str, query: str) -> Tuple[int, Optional[str]]:
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": "GET",
+            "scheme": "http",
+            "path": path,
+            "raw_path": path.encode(),
+            "query_string": query.encode(),
+            "root_path": "",
+            "headers": [(b"host", HOST.encode()), (b"accept", b"application/json")],
+            "client": ("127.0.0.1", 0),
+            "server": (HOST, 80),
+        }
+        responses = []
+
+        async def receive():
+            return {"type": "http.request", "body": b"", "more_body": False}
+
+        async def send(message):
+            if message["type"] == "http.response.start":
+                headers = {k.decode().lower(): v.decode() for k, v in message["headers"]}
+                responses.append((message["status"], headers.get("server-timing")))
+
+        await self.application(scope, receive, send)
+        return responses[0]
+
+    async def atimed(self, kind: str, path: str, query: str) -> Sample:
+        started = time.perf_counter()
+        try:
+            status, server_timing = await self.arequest(path, query)
+        except Exception:
+            status, server_timing = 0, None
+        return Sample(kind, status, time.perf_counter() - started,
+                      server_timing_queries(server_timing))
+
+    def run(self, plan, concurrency):
+        pending = iter(plan)
+        samples = []
+
+        async def client():
+            for request in pending:
+                samples.append(await self.atimed(*request))
+
+        async def clients():
+            await asyncio.gather(*(client() for _ in range(concurrency)))
+
+        started = time.perf_counter()
+        asyncio.run(clients())
+        return samples, time.perf_counter() - started
+
+
+class HttpTarget(Target):
+    # A running server at url, one keep-alive connection per client
+    def __init__(self, url: str):
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            raise ValueError("not an http(s) url: {!r}".format(url))
+        self.https = parts.scheme == "https"
+        self.host, self.port = parts.hostname, parts.port
+        self.prefix = parts.path.rstrip("/")
+        self.local = threading.local()
+
+    def connection(self) -> http.client.HTTPConnection:
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            cls = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+            connection = self.local.connection = cls(self.host, self.port, timeout=60)
+        return connection
+
+    def request(self, path: str, query: str) -> Tuple[int, Optional[str]]:
+        url = self.prefix + path + ("?" + query if query else "")
+        for attempt in range(2):
+            connection = self.connection()
+            try:
+                connection.request("GET", url, headers={"Accept": "application/json"})
+                response = connection.getresponse()
+                response.read()
+                return response.status, response.getheader("Server-Timing")
+            except (http.client.HTTPException, ConnectionError):
+                # the server closed the kept alive connection, reconnect once
+                connection.close()
+                self.local.connection = None
+                if attempt:
+                    raise
+
+
+def describe(samples: List[Sample], seconds: float) -> dict:
+    latencies = np.array([s.seconds for s in samples]) * 1000
+    summary = dict(requests=len(samples),
+                   errors=sum(1 for s in samples if not 200 <= s.status < 400),
+                   throughput=round(len(samples) / seconds, 1) if seconds else None)
+    if not samples:
+        return summary
+    summary["latency_ms"] = dict(
+        mean=round(float(latencies.mean()), 3),
+        max=round(float(latencies.max()), 3),
+        **{"p{}".format(p): round(float(v), 3)
+           for p, v in zip(LATENCY_PERCENTILES, np.percentile(latencies, LATENCY_PERCENTILES))})
+    queries = [s.queries for s in samples if s.queries is not None]
+    if queries:
+        summary["queries_per_request"] = dict(mean=round(sum(queries) / len(queries), 2),
+                                              max=max(queries))
+    return summary
+
+
+def run(target: Target, plan: List[Tuple[str, str, str]], concurrency: int,
+        warmup: int = 0) -> dict:
+    # Sends the first `warmup` requests of the plan unmeasured, then the
+    # rest. Throughput is over the whole run, per kind it is that kind's
+    # share of it.
+    if warmup:
+        target.run(plan[:warmup], concurrency)
+    samples, seconds = target.run(plan[warmup:], concurrency)
+    by_kind = {}
+    for sample in samples:
+        by_kind.setdefault(sample.kind, []).append(sample)
+    return dict(seconds=round(seconds, 3),
+                **describe(samples, seconds),
+                by_kind={kind: describe(by_kind[kind], seconds) for kind in sorted(by_kind)})
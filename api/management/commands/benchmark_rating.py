@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+import json
+
+from api import benchmarks
+
+
+class Command(BaseCommand):
+    help = "Benchmarks the rating path on seeded synthetic data and writes " \
+           "the results as JSON."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", type=int, nargs="+", default=benchmarks.DEFAULT_SIZES,
+                            help="numbers of quotes to generate, one run each")
+        parser.add_argument("--repeat", type=int, default=3)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--output", help="write the JSON here instead of stdout")
+        parser.add_argument("--current-db", action="store_true",
+                            help="run against the configured database (rolled back "
+                                 "afterwards) instead of a scratch test database")
+
+    def handle(self, *args, **options):
+        if options["current_db"]:
+            report = benchmarks.run(options["sizes"], options["repeat"], options["seed"])
+        else:
+            old_name = connection.settings_dict["NAME"]
+            connection.creation.create_test_db(verbosity=0, autoclobber=True)
+            try:
+                report = benchmarks.run(options["sizes"], options["repeat"], options["seed"])
+            finally:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        for result in report["results"]:
+            self.stderr.write("{size:>8} {benchmark:<28} {best:9.4f}s "
+                              "{per_item:>10} {queries:>4} queries".format(
+                                  per_item="{:.1f}us".format(result["per_item_us"])
+                                  if result["per_item_us"] is not None else "",
+                                  **result))
+        output = json.dumps(report, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(output)
+        else:
+            self.stdout.write(output)
+
+        over = [r for r in report["results"] if not r["within_budget"]]
+        if over:
+            raise CommandError("over the query budget: " + ", ".join(
+                "{benchmark} at {size} ({queries} > {query_budget})".format(**r) for r in over))
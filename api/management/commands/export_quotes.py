@@ -0,0 +1,68 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+import sys
+import time
+
+from api.export import (ENCODERS, EXPORT_CHUNK_SIZE, EXPORT_FORMATS, NpyExport, csv_header,
+                        export_queryset, parse_when, rated_rows)
+from api.models import QUOTE_STATE_CHOICES, COVERAGE_TYPE_CHOICES
+from api.rate_table import rate_table
+
+
+class Command(BaseCommand):
+    help = "Exports quotes with their costs as CSV, NDJSON or a directory of " \
+           ".npy columns, a chunk at a time."
+
+    def add_arguments(self, parser):
+        parser.add_argument("output", help="file to write (- for stdout), a directory for npy")
+        parser.add_argument("--format", choices=EXPORT_FORMATS, default="csv")
+        parser.add_argument("--state", action="append",
+                            choices=[c for c, _ in QUOTE_STATE_CHOICES])
+        parser.add_argument("--coverage-type", action="append",
+                            choices=[c for c, _ in COVERAGE_TYPE_CHOICES])
+        parser.add_argument("--created-after", help="ISO date or datetime, inclusive")
+        parser.add_argument("--created-before", help="ISO date or datetime, a date includes "
+                                                     "that whole day")
+        parser.add_argument("--chunk-size", type=int, default=EXPORT_CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        if options["chunk_size"] < 1:
+            raise CommandError("--chunk-size must be positive")
+        try:
+            created_after = options["created_after"] and parse_when(options["created_after"])
+            created_before = options["created_before"] and parse_when(options["created_before"],
+                                                                      end=True)
+        except ValueError as e:
+            raise CommandError(e)
+        queryset = export_queryset(options["state"], options["coverage_type"],
+                                   created_after or None, created_before or None)
+        table = rate_table.table()
+        output, format = options["output"], options["format"]
+
+        started = time.perf_counter()
+        if format == "npy":
+            if output == "-":
+                raise CommandError("npy exports are written to a directory")
+            export = NpyExport(output)
+            for rows, costs in rated_rows(queryset, table, options["chunk_size"]):
+                export.write(rows, costs)
+            count = export.close(
+                rate_version=table.cost_version,
+                exported_at=timezone.now().isoformat(),
+                filters={k: options[k] for k in ("state", "coverage_type", "created_after",
+                                                 "created_before")})["rows"]
+        else:
+            f = sys.stdout if output == "-" else open(output, "w", newline="", encoding="utf-8")
+            count = 0
+            try:
+                if format == "csv":
+                    f.write(csv_header())
+                for rows, costs in rated_rows(queryset, table, options["chunk_size"]):
+                    f.write(ENCODERS[format](rows, costs))
+                    count += len(rows)
+            finally:
+                if f is not sys.stdout:
+                    f.close()
+        seconds = time.perf_counter() - started
+        self.stderr.write("exported {} quotes in {:.2f}s ({:.0f} quotes/s)".format(
+            count, seconds, count / seconds if seconds else 0))
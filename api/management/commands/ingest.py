@@ -0,0 +1,66 @@
+from django.core.management.base import BaseCommand, CommandError
+import os
+import sys
+
+from api.ingest import FORMATS, INGEST_BATCH_SIZE, TARGETS, Ingest, read_rows
+from api.models import Quote
+
+
+def guess_format(path: str) -> str:
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".csv":
+        return "csv"
+    if extension in (".ndjson", ".jsonl"):
+        return "ndjson"
+    raise CommandError("can't tell the format of {}, pass --format".format(path))
+
+
+class Command(BaseCommand):
+    help = "Streams quotes, variables, customers, specifications or rate table " \
+           "rows from a CSV or NDJSON file into the database in bulk."
+
+    def add_arguments(self, parser):
+        parser.add_argument("model", choices=sorted(TARGETS))
+        parser.add_argument("path", help="file to load, - for stdin")
+        parser.add_argument("--format", choices=FORMATS,
+                            help="by default taken from the file's extension")
+        parser.add_argument("--batch-size", type=int, default=INGEST_BATCH_SIZE,
+                            help="rows written per transaction")
+        parser.add_argument("--max-errors", type=int, default=0,
+                            help="invalid rows to skip before giving up")
+        parser.add_argument("--defer-costs", action="store_true",
+                            help="leave the quotes a load affects stale instead of "
+                                 "re-rating them, for rerate_quotes --stale")
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        format = options["format"] or (path != "-" and guess_format(path))
+        if not format:
+            raise CommandError("pass --format when reading stdin")
+        if options["batch_size"] < 1:
+            raise CommandError("--batch-size must be positive")
+
+        ingest = Ingest(options["model"], options["defer_costs"], options["batch_size"],
+                        options["max_errors"])
+        f = sys.stdin if path == "-" else open(path, newline="", encoding="utf-8")
+        try:
+            ingest.load(read_rows(f, format), self.progress if options["verbosity"] > 1 else None)
+        except ValueError as e:
+            raise CommandError("{} (wrote {} rows)".format(e, ingest.written))
+        finally:
+            if f is not sys.stdin:
+                f.close()
+
+        for line, message in sorted(ingest.errors):
+            self.stderr.write("line {}: {}".format(line, message))
+        self.stdout.write("{} rows read, {} written, {} invalid in {:.2f}s ({:.0f} rows/s)".format(
+            ingest.rows, ingest.written, len(ingest.errors), ingest.seconds,
+            ingest.rows_per_second))
+        if ingest.refreshed:
+            self.stdout.write("re-rated {} quotes".format(ingest.refreshed))
+        if ingest.stale:
+            self.stdout.write("{} quotes have stale costs, run rerate_quotes --stale".format(
+                Quote.objects.stale().count()))
+
+    def progress(self, ingest: Ingest):
+        self.stderr.write("{} rows, {:.0f} rows/s".format(ingest.rows, ingest.rows_per_second))
@@ -0,0 +1,104 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import override_settings
+import json
+
+from api import loadtest
+from api.benchmarks import environment
+from api.models import Quote
+from api.synthetic import generate
+
+
+class Command(BaseCommand):
+    help = "Sends a seeded mix of concurrent requests to the quote endpoints, in-process " \
+           "through the WSGI or ASGI application or to a running server, and writes " \
+           "throughput, latency percentiles and queries per request as JSON."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--target", choices=["wsgi", "asgi", "http"], default="wsgi")
+        parser.add_argument("--url", default="http://127.0.0.1:8000",
+                            help="the server for --target http, which has to use the "
+                                 "configured database")
+        parser.add_argument("--concurrency", type=int, default=8)
+        parser.add_argument("--requests", type=int, default=2000)
+        parser.add_argument("--warmup", type=int, default=100,
+                            help="requests sent first and not measured")
+        parser.add_argument("--mix", default=loadtest.LOAD_TEST_MIX,
+                            help="weights of the request kinds: {}".format(
+                                ", ".join(loadtest.REQUEST_KINDS)))
+        parser.add_argument("--quotes", type=int, default=10000,
+                            help="size of the synthetic book generated in the scratch database")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--refresh-costs", action="store_true",
+                            help="store the generated quotes' costs first")
+        parser.add_argument("--output", help="write the JSON here instead of stdout")
+        parser.add_argument("--current-db", action="store_true",
+                            help="send requests about the quotes in the configured database "
+                                 "(e.g. from seed_synthetic) instead of generating them in a "
+                                 "scratch test database; implied by --target http")
+
+    def handle(self, *args, **options):
+        try:
+            mix = loadtest.parse_mix(options["mix"])
+        except ValueError as e:
+            raise CommandError(e)
+        if options["concurrency"] < 1 or options["requests"] < 1 or options["warmup"] < 0:
+            raise CommandError("--concurrency and --requests must be positive")
+
+        if options["target"] == "http" or options["current_db"]:
+            report = self.run(mix, options, generated=None)
+        else:
+            old_name = connection.settings_dict["NAME"]
+            connection.creation.create_test_db(verbosity=0, autoclobber=True)
+            try:
+                generated = generate(options["quotes"], seed=options["seed"])
+                if options["refresh_costs"]:
+                    Quote.objects.stale().refresh_costs()
+                report = self.run(mix, options, generated)
+            finally:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        for kind, summary in [("all", report), *report["by_kind"].items()]:
+            self.stderr.write("{kind:<14} {requests:>7} requests {throughput:>9.1f}/s "
+                              "p50 {p50:8.2f}ms p95 {p95:8.2f}ms p99 {p99:8.2f}ms "
+                              "{queries:>6} queries {errors} errors".format(
+                                  kind=kind, queries=summary.get("queries_per_request", {}).get(
+                                      "mean", "-"), **summary, **summary["latency_ms"]))
+        output = json.dumps(report, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(output)
+        else:
+            self.stdout.write(output)
+
+    def run(self, mix, options, generated) -> dict:
+        pks = list(Quote.objects.order_by("pk").values_list("pk", flat=True))
+        if not pks:
+            raise CommandError("there are no quotes, generate some with seed_synthetic")
+        plan = loadtest.request_plan(mix, pks, options["warmup"] + options["requests"],
+                                     options["seed"])
+        if options["target"] == "http":
+            try:
+                target = loadtest.HttpTarget(options["url"])
+            except ValueError as e:
+                raise CommandError(e)
+        elif options["target"] == "asgi":
+            from acme.asgi import application
+            target = loadtest.AsgiTarget(application)
+        else:
+            from acme.wsgi import application
+            target = loadtest.WsgiTarget(application)
+
+        # the in-process requests' host
+        with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, loadtest.HOST]):
+            results = loadtest.run(target, plan, options["concurrency"], options["warmup"])
+        return dict(environment=environment(),
+                    config=dict(target=options["target"],
+                                url=options["url"] if options["target"] == "http" else None,
+                                concurrency=options["concurrency"],
+                                requests=options["requests"], warmup=options["warmup"],
+                                mix=mix, seed=options["seed"],
+                                quotes=len(pks), refresh_costs=options["refresh_costs"]),
+                    generated=generated,
+                    **results)
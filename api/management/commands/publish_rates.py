@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.db import IntegrityError
+
+from api.models import RateTableSnapshot
+
+
+class Command(BaseCommand):
+    help = "Publishes the current rate table as an immutable snapshot that " \
+           "quotes can be rated against as of a date."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--effective-at",
+                            help="ISO 8601 date and time the snapshot applies from, "
+                                 "defaults to now")
+        parser.add_argument("--description", default="")
+
+    def handle(self, *args, **options):
+        effective_at = None
+        if options["effective_at"]:
+            effective_at = parse_datetime(options["effective_at"])
+            if effective_at is None:
+                raise CommandError("can't parse --effective-at {!r}".format(options["effective_at"]))
+            if timezone.is_naive(effective_at):
+                effective_at = timezone.make_aware(effective_at)
+        try:
+            snapshot = RateTableSnapshot.objects.publish(effective_at, options["description"])
+        except IntegrityError:
+            raise CommandError("a snapshot is already effective at {}".format(effective_at))
+        self.stdout.write("published rate table {} with {} values, effective at {}".format(
+            snapshot.version, len(snapshot.values), snapshot.effective_at.isoformat()))
@@ -0,0 +1,168 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.models import Min, Max
+from collections import defaultdict
+import django
+import json
+import math
+import os
+import time
+
+from api.models import Quote, QUOTE_STATE_CHOICES, COVERAGE_TYPE_CHOICES
+from api.rate_table import rate_table
+from api.rating import rate_many, refresh_costs
+
+
+def init_worker():
+    # forked workers must not share the parent's connection, spawned ones
+    # need django set up first. Either way every worker opens exactly one
+    # connection of its own and loads the rate table once.
+    django.setup()
+    connections.close_all()
+
+
+def rerate_chunk(lo: int, hi: int, filters: dict, stale: bool, dry_run: bool) -> dict:
+    started = time.perf_counter()
+    table = rate_table.table()
+    queryset = Quote.objects.filter(pk__gte=lo, pk__lt=hi, **filters)
+    if stale:
+        queryset = queryset.stale(table.cost_version)
+    quotes = list(queryset.order_by("pk"))
+    diffs = []
+    # quotes reading a rate table entry that isn't there are left stale and
+    # counted, they don't stop the run
+    unrated = 0
+    if dry_run:
+        for quote, rate in zip(quotes, rate_many(quotes, table, strict=False)):
+            old = (quote.subtotal, quote.taxes, quote.total)
+            if math.isnan(rate.total):
+                unrated += 1
+            elif old != tuple(rate):
+                diffs.append([quote.pk, *old, *rate])
+    else:
+        refresh_costs(quotes, table, strict=False)
+        unrated = sum(1 for quote in quotes if quote.rate_version is None)
+    return dict(lo=lo, hi=hi, count=len(quotes), unrated=unrated, diffs=diffs,
+                worker=os.getpid(), seconds=time.perf_counter() - started)
+
+
+class Command(BaseCommand):
+    help = "Re-rates quotes in pk chunks across a pool of worker processes " \
+           "and stores the materialized costs."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                            help="worker processes, 1 rates in this process")
+        parser.add_argument("--chunk-size", type=int, default=5000,
+                            help="width of each chunk of the pk space")
+        parser.add_argument("--state", action="append",
+                            choices=[c for c, _ in QUOTE_STATE_CHOICES])
+        parser.add_argument("--coverage-type", action="append",
+                            choices=[c for c, _ in COVERAGE_TYPE_CHOICES])
+        parser.add_argument("--stale", action="store_true",
+                            help="only quotes whose costs are stale")
+        parser.add_argument("--checkpoint",
+                            help="file recording finished chunks, an interrupted "
+                                 "run started again with it picks up where it stopped")
+        parser.add_argument("--dry-run", action="store_true",
+                            help="don't write anything, print the quotes whose "
+                                 "costs would change as CSV")
+
+    def handle(self, *args, **options):
+        filters = {}
+        if options["state"]:
+            filters["state__in"] = options["state"]
+        if options["coverage_type"]:
+            filters["coverage_type__in"] = options["coverage_type"]
+        queryset = Quote.objects.filter(**filters)
+        if options["stale"]:
+            queryset = queryset.stale()
+
+        chunk_size = options["chunk_size"]
+        if chunk_size < 1:
+            raise CommandError("--chunk-size must be positive")
+        # chunks sit on multiples of the chunk size so that a resumed run
+        # lines up with its checkpoint even after the filtered pk range moved.
+        bounds = queryset.prefetch_related(None).aggregate(lo=Min("pk"), hi=Max("pk"))
+        chunks = []
+        if bounds["lo"] is not None:
+            first = bounds["lo"] - bounds["lo"] % chunk_size
+            chunks = [(lo, lo + chunk_size)
+                      for lo in range(first, bounds["hi"] + 1, chunk_size)]
+
+        checkpoint = Checkpoint(options["checkpoint"], dict(
+            state=options["state"], coverage_type=options["coverage_type"],
+            stale=options["stale"], chunk_size=chunk_size,
+            dry_run=options["dry_run"]))
+        pending = [c for c in chunks if c not in checkpoint.done]
+        # keep the report out of the way of the dry run's diff on stdout
+        out = self.stderr if options["dry_run"] else self.stdout
+        out.write("{} chunks to rate, {} already done".format(
+            len(pending), len(chunks) - len(pending)))
+
+        if options["dry_run"]:
+            self.stdout.write("quote,old_subtotal,old_taxes,old_total,"
+                              "subtotal,taxes,total")
+        totals = defaultdict(lambda: [0, 0.0, 0])
+        started = time.perf_counter()
+        for result in self.run(pending, filters, options):
+            checkpoint.finish((result["lo"], result["hi"]))
+            worker = totals[result["worker"]]
+            worker[0] += result["count"]
+            worker[1] += result["seconds"]
+            worker[2] += result["unrated"]
+            for diff in result["diffs"]:
+                self.stdout.write(",".join(str(v) for v in diff))
+        elapsed = time.perf_counter() - started
+
+        count = sum(c for c, _, _ in totals.values())
+        unrated = sum(u for _, _, u in totals.values())
+        for worker, (quotes, seconds, worker_unrated) in sorted(totals.items()):
+            out.write("worker {}: {} quotes, {} unrated, {:.0f} quotes/sec".format(
+                worker, quotes, worker_unrated, quotes / seconds if seconds else 0))
+        out.write("{} {} quotes in {:.2f}s, {:.0f} quotes/sec".format(
+            "rated" if options["dry_run"] else "re-rated", count, elapsed,
+            count / elapsed if elapsed else 0))
+        if unrated:
+            out.write("{} quotes can't be rated, a rate table entry they read is "
+                      "missing; they are left stale".format(unrated))
+
+    def run(self, chunks, filters, options):
+        if options["workers"] <= 1:
+            for lo, hi in chunks:
+                yield rerate_chunk(lo, hi, filters, options["stale"], options["dry_run"])
+            return
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=options["workers"],
+                                 initializer=init_worker) as pool:
+            futures = [pool.submit(rerate_chunk, lo, hi, filters,
+                                   options["stale"], options["dry_run"])
+                       for lo, hi in chunks]
+            for future in as_completed(futures):
+                yield future.result()
+
+
+class Checkpoint:
+    # finished chunks, saved after each one so a restarted run can skip them.
+    # A checkpoint only applies to a run with the same options.
+    def __init__(self, path: str, options: dict):
+        self.path = path
+        self.options = options
+        self.done = set()
+        if path and os.path.exists(path):
+            with open(path) as f:
+                saved = json.load(f)
+            if saved["options"] != options:
+                raise CommandError(
+                    "checkpoint {} was written with different options".format(path))
+            self.done = {tuple(c) for c in saved["done"]}
+
+    def finish(self, chunk):
+        self.done.add(chunk)
+        if not self.path:
+            return
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(dict(options=self.options, done=sorted(self.done)), f)
+        os.replace(tmp, self.path)
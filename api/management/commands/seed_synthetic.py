@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+import time
+
+from api.models import Quote
+from api.synthetic import generate
+
+
+class Command(BaseCommand):
+    help = "Fills the database with a seeded synthetic book of business."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--quotes", type=int, default=1000)
+        parser.add_argument("--customers", type=int,
+                            help="defaults to one customer per ten quotes")
+        parser.add_argument("--max-variables", type=int, default=5)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--refresh-costs", action="store_true",
+                            help="store the costs of the new quotes as well")
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        generated = generate(options["quotes"], customers=options["customers"],
+                             max_variables=options["max_variables"], seed=options["seed"])
+        if options["refresh_costs"]:
+            Quote.objects.stale().refresh_costs()
+        self.stdout.write("generated {customers} customers, {quotes} quotes with "
+                          "{variables} variables and {specs} specs in {seconds:.2f}s".format(
+                              seconds=time.perf_counter() - started, **generated))
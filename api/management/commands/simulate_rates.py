@@ -0,0 +1,94 @@
+from concurrent.futures import ProcessPoolExecutor
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+import csv
+import json
+import os
+import time
+
+from api.models import Quote, QUOTE_STATE_CHOICES, COVERAGE_TYPE_CHOICES
+from api.rate_table import rate_table
+from api.simulation import Simulation, chunks, rate_range, SIMULATION_CHUNK_SIZE
+from .rerate_quotes import init_worker
+
+
+def parse_override(override: str):
+    # scope/key=value
+    try:
+        scope_key, value = override.rsplit("=", 1)
+        scope, key = scope_key.split("/", 1)
+        return (scope, key), float(value)
+    except ValueError:
+        raise CommandError("expected scope/key=value, got {!r}".format(override))
+
+
+class Command(BaseCommand):
+    help = "Shows how quote costs would move if some rate table values were " \
+           "changed, without changing anything."
+
+    def add_arguments(self, parser):
+        parser.add_argument("overrides", nargs="*", metavar="scope/key=value",
+                            help="proposed rate table values, e.g. CA/state_tax_rate=2.5")
+        parser.add_argument("--overrides-file",
+                            help="JSON list of {scope, key, value} objects")
+        parser.add_argument("--all", action="store_true",
+                            help="rate every quote instead of only the ones the "
+                                 "overrides affect")
+        parser.add_argument("--state", action="append",
+                            choices=[c for c, _ in QUOTE_STATE_CHOICES])
+        parser.add_argument("--coverage-type", action="append",
+                            choices=[c for c, _ in COVERAGE_TYPE_CHOICES])
+        parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                            help="worker processes, 1 rates in this process")
+        parser.add_argument("--chunk-size", type=int, default=SIMULATION_CHUNK_SIZE)
+        parser.add_argument("--diff", help="write the quotes whose costs would change "
+                                           "to this CSV file")
+
+    def handle(self, *args, **options):
+        overrides = dict(parse_override(o) for o in options["overrides"])
+        if options["overrides_file"]:
+            with open(options["overrides_file"]) as f:
+                try:
+                    overrides.update({(o["scope"], o["key"]): float(o["value"])
+                                      for o in json.load(f)})
+                except (KeyError, TypeError, ValueError) as e:
+                    raise CommandError("bad overrides file: {}".format(e))
+        if not overrides:
+            raise CommandError("nothing to simulate, give at least one override")
+        if options["chunk_size"] < 1:
+            raise CommandError("--chunk-size must be positive")
+
+        queryset = Quote.objects.all()
+        if options["state"]:
+            queryset = queryset.filter(state__in=options["state"])
+        if options["coverage_type"]:
+            queryset = queryset.filter(coverage_type__in=options["coverage_type"])
+
+        started = time.perf_counter()
+        simulation = Simulation(overrides, rate_table.table())
+        for result in self.run(simulation, chunks(queryset, overrides, not options["all"],
+                                                  options["chunk_size"]),
+                               queryset.query, options["workers"]):
+            simulation.add(*result)
+        simulation.seconds = time.perf_counter() - started
+        summary = simulation.summary()
+        self.stdout.write(json.dumps(summary, indent=2))
+        if options["diff"]:
+            with open(options["diff"], "w", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow(["quote", "state", "coverage_type", "subtotal", "taxes", "total",
+                                 "new_subtotal", "new_taxes", "new_total"])
+                writer.writerows(simulation.diff())
+        self.stderr.write("simulated {} quotes in {:.2f}s".format(
+            summary["quotes"], time.perf_counter() - started))
+
+    def run(self, simulation, ranges, query, workers):
+        args = [(query, lo, hi, pks, simulation.table, simulation.proposed)
+                for lo, hi, pks in ranges]
+        if workers <= 1 or len(args) <= 1:
+            for arg in args:
+                yield rate_range(*arg)
+            return
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as pool:
+            yield from pool.map(rate_range, *zip(*args))
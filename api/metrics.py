@@ -0,0 +1,290 @@
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from django.conf import settings
+from django.http import HttpResponse
+from typing import Dict, Optional, Tuple
+import cProfile
+import heapq
+import logging
+import os
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Per request performance numbers: SQL queries issued, time spent in them, in
+# rating and in serialization. They end up in a Server-Timing header on the
+# response and in the histograms served by the /metrics endpoint. Streaming
+# responses do most of their work after the headers are sent, so theirs only
+# go to the histograms, once the stream is done.
+
+DEFAULT_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100, 250, 1000)
+
+
+class RequestMetrics:
+    def __init__(self):
+        self.queries = 0
+        self.sql_time = 0.0
+        self.rating_time = 0.0
+        self.rated = 0
+        self.serialization_time = 0.0
+        self._serializing = 0
+
+
+current_request: ContextVar[Optional[RequestMetrics]] = ContextVar(
+    "current_request", default=None)
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # labels -> [bucket counts..., +Inf count], sum
+        self._series: Dict[Tuple, list] = {}
+
+    def observe(self, value: float, count: int = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += count
+            series[1] += value * count
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+
+    def expose(self) -> str:
+        lines = ["# HELP {} {}".format(self.name, self.help),
+                 "# TYPE {} histogram".format(self.name)]
+        with self._lock:
+            series = sorted((k, list(counts), total) for k, (counts, total) in self._series.items())
+        for labels, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append("{}_bucket{} {}".format(
+                    self.name, format_labels(labels + (("le", str(bound)),)), cumulative))
+            lines.append("{}_sum{} {}".format(self.name, format_labels(labels), total))
+            lines.append("{}_count{} {}".format(self.name, format_labels(labels), cumulative))
+        return "\n".join(lines)
+
+
+def format_labels(labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+                          for k, v in labels) + "}"
+
+
+request_duration = Histogram(
+    "acme_request_duration_seconds", "Time to produce a response.")
+request_queries = Histogram(
+    "acme_request_sql_queries", "SQL queries issued per request.", QUERY_BUCKETS)
+request_sql_duration = Histogram(
+    "acme_request_sql_duration_seconds", "Time spent in SQL per request.")
+request_serialization_duration = Histogram(
+    "acme_request_serialization_duration_seconds", "Time spent serializing quotes per request.")
+quote_rating_duration = Histogram(
+    "acme_quote_rating_duration_seconds", "Time to rate one quote.",
+    (.000005, .00001, .000025, .00005, .0001, .00025, .0005, .001, .0025, .01))
+HISTOGRAMS = [request_duration, request_queries, request_sql_duration,
+              request_serialization_duration, quote_rating_duration]
+
+
+def record_rating(seconds: float, quotes: int):
+    # hook for the rater, a batch counts as `quotes` ratings of the average
+    if not quotes:
+        return
+    quote_rating_duration.observe(seconds / quotes, quotes)
+    metrics = current_request.get()
+    if metrics is not None:
+        metrics.rating_time += seconds
+        metrics.rated += quotes
+
+
+@contextmanager
+def serialization():
+    # hook for the serializers, nested serializers only count once
+    metrics = current_request.get()
+    if metrics is None or metrics._serializing:
+        yield
+        return
+    metrics._serializing += 1
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics._serializing -= 1
+        metrics.serialization_time += time.perf_counter() - started
+
+
+def count_queries(execute, sql, params, many, context):
+    # installed on every database connection, see install_query_counter
+    metrics = current_request.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics.queries += 1
+        metrics.sql_time += time.perf_counter() - started
+
+
+def install_query_counter(sender, connection, **kwargs):
+    if count_queries not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_queries)
+
+
+class SlowRequestProfiler:
+    # Profiles a sample of requests and keeps the profiles of the slowest
+    # METRICS_PROFILE_KEEP of them in METRICS_PROFILE_DIR. Off unless
+    # METRICS_PROFILE_SAMPLE_RATE is set. Only the request's own thread is
+    # profiled.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._kept = []
+
+    @property
+    def sample_rate(self) -> float:
+        return getattr(settings, "METRICS_PROFILE_SAMPLE_RATE", 0.0)
+
+    def start(self) -> Optional[cProfile.Profile]:
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # another profiler is already running on this thread
+            return None
+        return profile
+
+    def finish(self, profile: cProfile.Profile, request, duration: float):
+        profile.disable()
+        directory = getattr(settings, "METRICS_PROFILE_DIR", "profiles")
+        keep = getattr(settings, "METRICS_PROFILE_KEEP", 10)
+        with self._lock:
+            if len(self._kept) >= keep and duration <= self._kept[0][0]:
+                return
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, "{:.6f}s-{}-{}.prof".format(
+                duration, request.method, request.path.strip("/").replace("/", "_") or "root"))
+            profile.dump_stats(path)
+            heapq.heappush(self._kept, (duration, path))
+            while len(self._kept) > keep:
+                _, evicted = heapq.heappop(self._kept)
+                try:
+                    os.remove(evicted)
+                except OSError:
+                    pass
+
+
+profiler = SlowRequestProfiler()
+
+
+class MetricsMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        metrics, token, started, profile = self.start()
+        try:
+            response = self.get_response(request)
+        finally:
+            current_request.reset(token)
+        return self.finish(request, response, metrics, started, profile)
+
+    async def __acall__(self, request):
+        metrics, token, started, profile = self.start()
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_request.reset(token)
+        return self.finish(request, response, metrics, started, profile)
+
+    def start(self):
+        metrics = RequestMetrics()
+        token = current_request.set(metrics)
+        profile = profiler.start()
+        return metrics, token, time.perf_counter(), profile
+
+    def finish(self, request, response, metrics: RequestMetrics, started: float, profile):
+        duration = time.perf_counter() - started
+        if profile is not None:
+            profiler.finish(profile, request, duration)
+        if response.streaming:
+            response.streaming_content = self.streamed(
+                response.streaming_content, request, metrics, started)
+            return response
+        self.observe(request, metrics, duration)
+        response["Server-Timing"] = ", ".join([
+            'db;dur={:.3f};desc="{} queries"'.format(metrics.sql_time * 1000, metrics.queries),
+            'rating;dur={:.3f};desc="{} quotes"'.format(metrics.rating_time * 1000, metrics.rated),
+            "serialize;dur={:.3f}".format(metrics.serialization_time * 1000),
+            "total;dur={:.3f}".format(duration * 1000),
+        ])
+        return response
+
+    def streamed(self, content, request, metrics: RequestMetrics, started: float):
+        # the streaming content with the request's metrics counting while
+        # each chunk is produced, observed when the stream ends
+        chunks = iter(content)
+        try:
+            while True:
+                token = current_request.set(metrics)
+                try:
+                    chunk = next(chunks)
+                except StopIteration:
+                    return
+                finally:
+                    current_request.reset(token)
+                yield chunk
+        finally:
+            self.observe(request, metrics, time.perf_counter() - started)
+
+    def observe(self, request, metrics: RequestMetrics, duration: float):
+        match = getattr(request, "resolver_match", None)
+        view = match.view_name if match is not None else "unresolved"
+        request_duration.observe(duration, view=view)
+        request_queries.observe(metrics.queries, view=view)
+        request_sql_duration.observe(metrics.sql_time, view=view)
+        if metrics.serialization_time:
+            request_serialization_duration.observe(metrics.serialization_time, view=view)
+
+
+def expose_memo(stats: dict) -> str:
+    # the rating memo's counters, see api.rating.RatingMemo
+    return "\n".join([
+        "# HELP acme_rating_memo_lookups_total Quote shapes looked up in the rating memo.",
+        "# TYPE acme_rating_memo_lookups_total counter",
+        "acme_rating_memo_lookups_total{} {}".format(format_labels((("result", "hit"),)), stats["hits"]),
+        "acme_rating_memo_lookups_total{} {}".format(format_labels((("result", "miss"),)),
+                                                     stats["misses"]),
+        "# HELP acme_rating_memo_size Quote shapes in the rating memo.",
+        "# TYPE acme_rating_memo_size gauge",
+        "acme_rating_memo_size {}".format(stats["size"]),
+    ])
+
+
+def metrics_view(request):
+    # Prometheus text exposition of the histograms above and the rating memo
+    from .rating import rating_memo
+    body = "\n".join([*(h.expose() for h in HISTOGRAMS), expose_memo(rating_memo.stats())]) + "\n"
+    return HttpResponse(body, content_type="text/plain; version=0.0.4; charset=utf-8")
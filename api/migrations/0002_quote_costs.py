@@ -0,0 +1,33 @@
+# Generated by Django 4.1.5 on 2026-10-17 12:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='quote',
+            name='rate_version',
+            field=models.CharField(blank=True, editable=False, max_length=16, null=True),
+        ),
+        migrations.AddField(
+            model_name='quote',
+            name='subtotal',
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='quote',
+            name='taxes',
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='quote',
+            name='total',
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.1.5 on 2026-10-17 12:29
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_quote_costs'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QuoteDependency',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('scope', models.CharField(max_length=64)),
+                ('key', models.CharField(max_length=64)),
+                ('quote', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='dependencies', to='api.quote')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='quotedependency',
+            index=models.Index(fields=['scope', 'key'], name='api_quotede_scope_65a519_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='quotedependency',
+            unique_together={('quote', 'scope', 'key')},
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 4.1.5 on 2026-10-17 13:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_quote_dependency'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RateTableSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('effective_at', models.DateTimeField(unique=True)),
+                ('published_at', models.DateTimeField(auto_now_add=True)),
+                ('description', models.CharField(blank=True, default='', max_length=255)),
+                ('version', models.CharField(editable=False, max_length=16)),
+                ('values', models.JSONField(editable=False)),
+            ],
+        ),
+    ]
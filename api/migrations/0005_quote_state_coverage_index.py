@@ -0,0 +1,17 @@
+# Generated by Django 4.1.5 on 2026-10-17 13:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_rate_table_snapshot'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='quote',
+            index=models.Index(fields=['state', 'coverage_type'], name='api_quote_state_coverage_idx'),
+        ),
+    ]
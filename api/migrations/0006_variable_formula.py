@@ -0,0 +1,24 @@
+# Generated by Django 4.1.5 on 2026-10-17 13:41
+
+import api.formulas
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_quote_state_coverage_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='variablespecification',
+            name='formula',
+            field=models.TextField(blank=True, max_length=1000, null=True, validators=[api.formulas.validate_formula]),
+        ),
+        migrations.AlterField(
+            model_name='variablespecification',
+            name='type',
+            field=models.CharField(choices=[('state_lookup', 'State Policy Lookup'), ('global_lookup', 'Global Policy Lookup'), ('simple', 'Simple Value'), ('formula', 'Formula')], max_length=16),
+        ),
+    ]
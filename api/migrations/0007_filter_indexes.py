@@ -0,0 +1,49 @@
+# Generated by Django 4.1.5 on 2026-10-17 13:48
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.db.models.functions.text
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_variable_formula'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='quote',
+            name='api_quote_state_coverage_idx',
+        ),
+        migrations.AlterField(
+            model_name='quote',
+            name='customer',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.DO_NOTHING, to='api.customer'),
+        ),
+        migrations.AlterField(
+            model_name='quotevariable',
+            name='quote',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='variables', to='api.quote'),
+        ),
+        migrations.AddIndex(
+            model_name='customer',
+            index=models.Index(django.db.models.functions.text.Lower('name'), name='api_customer_name_lower_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='quote',
+            index=models.Index(fields=['state', 'coverage_type', 'created_at', 'id'], name='api_quote_state_coverage_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='quote',
+            index=models.Index(fields=['customer', 'created_at', 'id'], name='api_quote_customer_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='quote',
+            index=models.Index(fields=['created_at', 'id'], name='api_quote_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='quote',
+            index=models.Index(fields=['updated_at'], name='api_quote_updated_idx'),
+        ),
+    ]
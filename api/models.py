@@ -1,11 +1,17 @@
 from django.db import models
+from django.db.models.functions import Lower
 from natural_keys import NaturalKeyModel
 from collections import namedtuple
-from typing import Union, List
+from django.utils import timezone
+from datetime import datetime
+from typing import Union, List, Iterable
 from functools import reduce
 from math import floor
 from decimal import Decimal, ROUND_DOWN, ROUND_FLOOR
 from collections.abc import Mapping
+from django.core.exceptions import ValidationError
+from .formulas import FormulaError, validate_formula
+from .rate_table import rate_table, rate_table_snapshots, RateTable
 import logging
 
 BASIC_POLICY_BASE_KEY = "basic_policy_base"
@@ -22,11 +28,13 @@ GLOBAL_SCOPE = "global"
 VARIABLE_TYPE_STATE_LOOKUP = "state_lookup"
 VARIABLE_TYPE_GLOBAL_LOOKUP = "global_lookup"
 VARIABLE_TYPE_SIMPLE = "simple"
+VARIABLE_TYPE_FORMULA = "formula"
 
 VARIABLE_TYPE_CHOICES = (
     (VARIABLE_TYPE_STATE_LOOKUP, "State Policy Lookup"),
     (VARIABLE_TYPE_GLOBAL_LOOKUP, "Global Policy Lookup"),
     (VARIABLE_TYPE_SIMPLE, "Simple Value"),
+    (VARIABLE_TYPE_FORMULA, "Formula"),
 )
 QUOTE_STATE_CHOICES = (
     ("NY", "New York"),
@@ -61,12 +69,22 @@ class PolicyVariable(models.Model):
         unique_together = (("key", "scope"),)
 
 
+# what rating raises for a quote that can't be rated: a rate table entry it
+# reads is missing, or one of its specs has a stored formula that doesn't
+# compile (bulk_create, update() and ingest skip validate_formula)
+RATING_ERRORS = (PolicyVariable.DoesNotExist, FormulaError)
+
+
 class Customer(models.Model):
     name = models.CharField(max_length=255)
 
     def __str__(self) -> str:
         return self.name
 
+    class Meta:
+        # the quotes list's customer_name prefix search, see api.filters
+        indexes = [models.Index(Lower("name"), name="api_customer_name_lower_idx")]
+
 
 class VariableSpecification(models.Model):
     code = models.CharField(max_length=32, primary_key=True)
@@ -80,15 +98,68 @@ class VariableSpecification(models.Model):
     default_value = models.FloatField(null=True, blank=True)
     priority = models.IntegerField(null=False, default=10)
     lookup_key = models.CharField(max_length=64, null=True, blank=True)
+    # the expression of formula variables, see api.formulas
+    formula = models.TextField(max_length=1000, null=True, blank=True,
+                               validators=[validate_formula])
 
     def __str__(self) -> str:
         return "{} - {}".format(self.code, self.type)
 
+    def clean(self):
+        if self.type == VARIABLE_TYPE_FORMULA and not self.formula:
+            raise ValidationError({"formula": "Formula variables need a formula."})
+
     def natural_key(self):
         return (self.code, )
 
 
-class QuotesManager(models.Manager):
+class QuoteQuerySet(models.QuerySet):
+    _with_rates = False
+
+    def with_rates(self):
+        # rates every quote the queryset returns in one batch when it is
+        # evaluated, so reading .rate on the results costs nothing.
+        clone = self._chain()
+        clone._with_rates = True
+        return clone
+
+    def _clone(self):
+        clone = super()._clone()
+        clone._with_rates = self._with_rates
+        return clone
+
+    def _fetch_all(self):
+        fresh = self._result_cache is None
+        super()._fetch_all()
+        if fresh and self._with_rates:
+            # quotes with up to date materialized costs don't need rating
+            quotes = [q for q in self._result_cache
+                      if isinstance(q, Quote) and q.stored_cost is None]
+            for quote, rate in zip(quotes, PolicyRater.rate_many(quotes)):
+                quote._batch_rate = rate
+
+    def stale(self, version: str = None):
+        # quotes whose materialized costs weren't computed against the given
+        # (by default the current) rate table.
+        if version is None:
+            version = rate_table.cost_version
+        return self.filter(models.Q(rate_version__isnull=True) |
+                           ~models.Q(rate_version=version))
+
+    def refresh_costs(self, chunk_size: int = 2000) -> int:
+        # re-rates and stores the costs of every quote in the queryset. The
+        # pks are read up front so that rows dropping out of a filter like
+        # stale() while we write don't upset the scan.
+        from .rating import refresh_costs
+        pks = list(self.order_by("pk").values_list("pk", flat=True))
+        count = 0
+        for start in range(0, len(pks), chunk_size):
+            chunk = pks[start:start + chunk_size]
+            count += refresh_costs(Quote.objects.filter(pk__in=chunk))
+        return count
+
+
+class QuotesManager(models.Manager.from_queryset(QuoteQuerySet)):
     def get_queryset(self):
         return (super().
                 get_queryset().
@@ -106,8 +177,9 @@ class QuoteVariablesManager(models.Manager):
 class QuoteVariable(models.Model):
     objects = QuoteVariablesManager()
 
+    # unique_together's (quote, spec) index serves the lookups by quote
     quote = models.ForeignKey(
-        "Quote", related_name="variables", on_delete=models.CASCADE)
+        "Quote", related_name="variables", on_delete=models.CASCADE, db_index=False)
     spec = models.ForeignKey(VariableSpecification, on_delete=models.CASCADE)
     notes = models.TextField(max_length=1024, null=True, blank=True)
     value = models.FloatField(null=True, blank=True)
@@ -122,7 +194,8 @@ class QuoteVariable(models.Model):
 class Quote(models.Model):
     objects = QuotesManager()
 
-    customer = models.ForeignKey(Customer, on_delete=models.DO_NOTHING)
+    # indexed with created_at in Meta.indexes
+    customer = models.ForeignKey(Customer, on_delete=models.DO_NOTHING, db_index=False)
     description = models.CharField(max_length=50, null=True, blank=True)
     state = models.CharField(
         choices=QUOTE_STATE_CHOICES, max_length=2, null=False, blank=False)
@@ -130,58 +203,154 @@ class Quote(models.Model):
         choices=COVERAGE_TYPE_CHOICES, null=False, default="basic", max_length=16)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # materialized rating, kept up to date by api.signals and only trusted
+    # while rate_version matches the current rate table's cost_version.
+    subtotal = models.FloatField(null=True, blank=True, editable=False)
+    taxes = models.FloatField(null=True, blank=True, editable=False)
+    total = models.FloatField(null=True, blank=True, editable=False)
+    rate_version = models.CharField(
+        max_length=16, null=True, blank=True, editable=False)
 
     def __str__(self) -> str:
         return "{} - {} - {}".format(self.description, self.customer.name, self.coverage_type)
 
+    @property
+    def stored_cost(self) -> RatingResult:
+        return self.stored_cost_at(rate_table.cost_version)
+
+    def stored_cost_at(self, version: str) -> RatingResult:
+        if self.total is None or self.rate_version != version:
+            return None
+        return RatingResult(subtotal=self.subtotal, taxes=self.taxes, total=self.total)
+
+    @property
+    def cost(self) -> RatingResult:
+        # a batch rating from this request, the materialized cost when it is
+        # current, otherwise a live rating
+        batch_rate = getattr(self, "_batch_rate", None)
+        if batch_rate is not None:
+            return batch_rate
+        stored = self.stored_cost
+        if stored is not None:
+            return stored
+        return self.rate
+
     @property
     def rate(self) -> RatingResult:
-        #needs to be memoized probably
+        # quotes loaded through QuoteQuerySet.with_rates() were already rated
+        # in a batch.
+        batch_rate = getattr(self, "_batch_rate", None)
+        if batch_rate is not None:
+            return batch_rate
         pr = PolicyRater(self)
         return pr.calculate_quote_rate()
 
+    def rate_as_of(self, when: datetime = None) -> RatingResult:
+        # the cost under the rate table snapshot that was in effect at `when`,
+        # by default when the quote was created. Raises
+        # RateTableSnapshot.DoesNotExist when none was.
+        from .rating import rate_quote
+        return rate_quote(self, rate_table_snapshots.as_of(when or self.created_at))
+
     @property
     def customer_name(self) -> str:
         return self.customer.name
 
+    class Meta:
+        # the quotes list's filters in KeysetPagination order (see
+        # api.filters) and the admin's state and coverage type filters
+        indexes = [
+            models.Index(fields=["state", "coverage_type", "created_at", "id"],
+                         name="api_quote_state_coverage_idx"),
+            models.Index(fields=["customer", "created_at", "id"], name="api_quote_customer_idx"),
+            models.Index(fields=["created_at", "id"], name="api_quote_created_idx"),
+            models.Index(fields=["updated_at"], name="api_quote_updated_idx"),
+        ]
+
+
+class QuoteDependency(models.Model):
+    # reverse index of which PolicyVariables a quote's rating reads, so that a
+    # rate change only has to re-rate the quotes that depend on it. Rows are
+    # rewritten whenever a quote's costs are (see api.dependencies).
+    quote = models.ForeignKey(
+        Quote, related_name="dependencies", on_delete=models.CASCADE)
+    scope = models.CharField(max_length=64)
+    key = models.CharField(max_length=64)
+
+    def __str__(self) -> str:
+        return "{} -> {}/{}".format(self.quote_id, self.scope, self.key)
+
+    class Meta:
+        unique_together = (("quote", "scope", "key"),)
+        indexes = [models.Index(fields=["scope", "key"])]
+
+
+class RateTableSnapshotManager(models.Manager):
+    def publish(self, effective_at: datetime = None, description: str = "") -> "RateTableSnapshot":
+        # snapshots the current rate table, effective from now by default
+        table = rate_table.table()
+        return self.create(effective_at=effective_at or timezone.now(),
+                           description=description,
+                           version=table.version,
+                           values=[[scope, key, value]
+                                   for (scope, key), value in sorted(table.values.items())])
+
+
+class RateTableSnapshot(models.Model):
+    # A published copy of the whole rate table that applies to quotes from
+    # effective_at until the next snapshot takes over. The rows are stored
+    # as one JSON list of [scope, key, value] so that a snapshot loads in a
+    # single query. Snapshots can't be changed once published.
+    objects = RateTableSnapshotManager()
+
+    effective_at = models.DateTimeField(unique=True)
+    published_at = models.DateTimeField(auto_now_add=True)
+    description = models.CharField(max_length=255, blank=True, default="")
+    version = models.CharField(max_length=16, editable=False)
+    values = models.JSONField(editable=False)
+
+    def __str__(self) -> str:
+        return "{} - {}".format(self.effective_at.isoformat(), self.version)
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            raise ValueError("Rate table snapshots can't be changed once published.")
+        super().save(*args, **kwargs)
+
+    def table(self) -> RateTable:
+        return RateTable({(scope, key): value for scope, key, value in self.values}, self.version)
+
 
 class PolicyRater:
-    def __init__(self, quote: Quote):
+    def __init__(self, quote: Quote, table: RateTable = None):
         self.quote = quote
-        self.vars = vars
-
-    def calculate_quote_rate(self) -> float:
-        base_key = BASIC_POLICY_BASE_KEY
-        if self.quote.coverage_type == COVERAGE_TYPE_PREMIUM:
-            base_key = PREMIUM_POLICY_BASE_KEY
-        base_pv = PolicyVariable.objects.get(scope=GLOBAL_SCOPE, key=base_key)
-        base_cost = base_pv.value
-        sub = reduce(lambda acc, var: acc + self.variable_value(acc, var),
-                     self.quote.variables.all(),
-                     base_cost)
-        # we call out tax separately here because we have to report it as a separate line item. It
-        # should be possible to mark variables as taxes and lower their priority so that we could
-        # remove this and automatically accumulate all applicable taxes. Then taxes would be calculated
-        # with the rest of the variables.
-        state_tax_var = PolicyVariable.objects.get(
-            scope=self.quote.state, key=STATE_TAX_RATE_KEY)
-        tax = sub * normalized_percent(state_tax_var.value)
-        sub = round(sub, 2)
-        return RatingResult(subtotal=(sub),
-                            taxes=trunc(tax),
-                            total=trunc(sub+tax))
+        # all of the PolicyVariable reads go through the process wide rate
+        # table cache unless a specific table is handed in.
+        self.table = table if table is not None else rate_table.table()
+
+    @staticmethod
+    def rate_many(quotes: Iterable[Quote], table: RateTable = None) -> List[RatingResult]:
+        from .rating import rate_many
+        return rate_many(quotes, table)
+
+    def calculate_quote_rate(self) -> RatingResult:
+        # the variables are compiled into a cached rating plan (see
+        # api.rating) that does the same reduction as variable_value below.
+        # We call out tax separately there because we have to report it as a
+        # separate line item. It should be possible to mark variables as taxes
+        # and lower their priority so that we could remove this and
+        # automatically accumulate all applicable taxes. Then taxes would be
+        # calculated with the rest of the variables.
+        from .rating import rate_quote
+        return rate_quote(self.quote, self.table)
 
     def variable_value(self, base_value: float, var: QuoteVariable) -> float:
         var_value = None
         type = var.spec.type
         if type == VARIABLE_TYPE_STATE_LOOKUP:
-            pv = PolicyVariable.objects.get(
-                scope=self.quote.state, key=var.spec.lookup_key)
-            var_value = pv.value
+            var_value = self.table.get(self.quote.state, var.spec.lookup_key)
         elif type == VARIABLE_TYPE_GLOBAL_LOOKUP:
-            pv = PolicyVariable.objects.get(
-                scope=GLOBAL_SCOPE, key=var.spec.lookup_key)
-            var_value = pv.value
+            var_value = self.table.get(GLOBAL_SCOPE, var.spec.lookup_key)
         elif type == VARIABLE_TYPE_SIMPLE:
             var_value = var.value
 
@@ -206,6 +375,12 @@ class PolicyRater:
 IntOrFloat = Union[int, float]
 
 
+def base_rate_key(coverage_type: str) -> str:
+    if coverage_type == COVERAGE_TYPE_PREMIUM:
+        return PREMIUM_POLICY_BASE_KEY
+    return BASIC_POLICY_BASE_KEY
+
+
 def normalized_percent(n: IntOrFloat) -> float:
     return float(n) / 100.0
 
@@ -0,0 +1,116 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+import json
+
+
+class KeysetPagination(BasePagination):
+    # Cursor pagination on (created_at, id). Unlike an offset the cursor is
+    # the last row's key, so every page is a range scan no matter how deep it
+    # is and rows inserted while paging don't shift anything.
+    cursor_query_param = "cursor"
+    page_size_query_param = "page_size"
+    page_size = 100
+    max_page_size = 1000
+    ordering = ("created_at", "id")
+    invalid_cursor_message = "Invalid cursor"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        return self.finish_page(list(self.page_queryset(queryset, request)))
+
+    def page_queryset(self, queryset, request):
+        # the (lazy) queryset for the requested page plus one row to tell
+        # whether there is more, which finish_page then trims off.
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.position, self.forward = self.decode_cursor(request)
+        if self.forward:
+            queryset = queryset.order_by(*self.ordering)
+            if self.position is not None:
+                queryset = queryset.filter(self.after(*self.position))
+        else:
+            queryset = queryset.order_by(*("-" + f for f in self.ordering))
+            queryset = queryset.filter(self.before(*self.position))
+        return queryset[:self.page_size + 1]
+
+    def finish_page(self, page):
+        forward = self.forward
+        has_more = len(page) > self.page_size
+        page = page[:self.page_size]
+        if not forward:
+            page.reverse()
+
+        self.next_position = self.previous_position = None
+        if page and (has_more or not forward):
+            self.next_position = self.key(page[-1])
+        if page and (self.position is not None and forward or has_more and not forward):
+            self.previous_position = self.key(page[0])
+        return page
+
+    def get_paginated_data(self, data):
+        return OrderedDict([
+            ("next", self.get_link(self.next_position, True)),
+            ("previous", self.get_link(self.previous_position, False)),
+            ("results", data),
+        ])
+
+    def get_paginated_response(self, data):
+        return Response(self.get_paginated_data(data))
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            "type": "object",
+            "properties": {
+                "next": {"type": "string", "nullable": True},
+                "previous": {"type": "string", "nullable": True},
+                "results": schema,
+            },
+        }
+
+    def get_page_size(self, request) -> int:
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if page_size < 1:
+            return self.page_size
+        return min(page_size, self.max_page_size)
+
+    @staticmethod
+    def key(obj):
+        return (obj.created_at, obj.pk)
+
+    @staticmethod
+    def after(created_at, pk) -> Q:
+        return Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=pk)
+
+    @staticmethod
+    def before(created_at, pk) -> Q:
+        return Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk)
+
+    def get_link(self, position, forward: bool):
+        if position is None:
+            return None
+        url = self.request.build_absolute_uri()
+        created_at, pk = position
+        cursor = json.dumps([created_at.isoformat(), pk, forward]).encode()
+        return replace_query_param(url, self.cursor_query_param,
+                                   urlsafe_b64encode(cursor).decode())
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None, True
+        try:
+            created_at, pk, forward = json.loads(urlsafe_b64decode(encoded.encode()))
+            created_at = parse_datetime(created_at)
+            if created_at is None or not isinstance(pk, int):
+                raise ValueError(encoded)
+            return (created_at, pk), bool(forward)
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
@@ -0,0 +1,303 @@
+from asgiref.sync import sync_to_async
+from bisect import bisect_right
+from collections import OrderedDict
+from datetime import datetime
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import caches
+from typing import Dict, Tuple, Optional
+import hashlib
+import numpy as np
+import threading
+import time
+import uuid
+
+RateKey = Tuple[str, str]
+DEFAULT_SNAPSHOT_CACHE_SIZE = 32
+# seconds between checks of the shared stamp, and before a table is reloaded
+# even though the stamp didn't change
+DEFAULT_RATE_TABLE_CHECK_INTERVAL = 1.0
+DEFAULT_RATE_TABLE_MAX_AGE = 30.0
+RATE_TABLE_STAMP_KEY = "api:rate_table:stamp"
+RATE_SNAPSHOT_STAMP_KEY = "api:rate_table_snapshots:stamp"
+
+
+class RateTable:
+    # An immutable view of every PolicyVariable keyed by (scope, key). The
+    # version is a digest of the contents so that two processes that loaded
+    # the same rows agree on it and so it can be persisted next to anything
+    # that was computed from this table. Scopes and keys are interned to
+    # small ints and the values kept in one scope x key array (nan where
+    # there is no row), which keeps the many tables that snapshots put in
+    # memory compact.
+    def __init__(self, values: Dict[RateKey, float], version: str = None):
+        self.scopes = {scope: i for i, scope in enumerate(sorted({s for s, _ in values}))}
+        self.keys = {key: i for i, key in enumerate(sorted({k for _, k in values}))}
+        self.array = np.full((len(self.scopes), len(self.keys)), np.nan)
+        for (scope, key), value in values.items():
+            self.array[self.scopes[scope], self.keys[key]] = value
+        self.array.flags.writeable = False
+        self._len = len(values)
+        self.version = version if version is not None else table_version(values)
+
+    def __len__(self) -> int:
+        return self._len
+
+    @property
+    def cost_version(self) -> str:
+        # what costs rated against this table are stamped with (see
+        # Quote.rate_version): the version under the default float
+        # arithmetic, a digest of it and the arithmetic otherwise, so that
+        # switching RATING_ARITHMETIC makes every stored cost stale
+        from .rating import ARITHMETIC_FLOAT, arithmetic
+        mode = arithmetic()
+        if mode == ARITHMETIC_FLOAT:
+            return self.version
+        return hashlib.sha1("{}\0{}".format(self.version, mode).encode()).hexdigest()[:16]
+
+    def __contains__(self, scope_key: RateKey) -> bool:
+        return self.lookup(*scope_key) is not None
+
+    @property
+    def values(self) -> Dict[RateKey, float]:
+        scopes, keys = list(self.scopes), list(self.keys)
+        return {(scopes[i], keys[j]): float(self.array[i, j])
+                for i, j in zip(*np.nonzero(~np.isnan(self.array)))}
+
+    def lookup(self, scope: str, key: str) -> Optional[float]:
+        i = self.scopes.get(scope)
+        j = self.keys.get(key)
+        if i is None or j is None:
+            return None
+        value = self.array[i, j]
+        # a python float, numpy's rounds differently
+        return None if value != value else float(value)
+
+    def get(self, scope: str, key: str) -> float:
+        value = self.lookup(scope, key)
+        if value is None:
+            policy_variable = apps.get_model("api", "PolicyVariable")
+            raise policy_variable.DoesNotExist(
+                "PolicyVariable {}/{} does not exist.".format(scope, key))
+        return value
+
+
+def table_version(values: Dict[RateKey, float]) -> str:
+    digest = hashlib.sha1()
+    for (scope, key), value in sorted(values.items()):
+        digest.update("{}\0{}\0{!r}\n".format(scope, key, value).encode())
+    return digest.hexdigest()[:16]
+
+
+class SharedStamp:
+    # What is loaded under a stamp kept in the RATE_TABLE_CACHE cache, which
+    # invalidate() in any process replaces: a copy loaded under another stamp
+    # is stale, checked at most every RATE_TABLE_CHECK_INTERVAL seconds. That
+    # only reaches processes sharing the cache, so a copy older than
+    # RATE_TABLE_MAX_AGE seconds is stale whatever the stamp says.
+    stamp_key: str
+
+    def __init__(self):
+        self._stamp = None
+        self._loaded_at = 0.0
+        self._checked_at = 0.0
+
+    @property
+    def check_interval(self) -> float:
+        return getattr(settings, "RATE_TABLE_CHECK_INTERVAL", DEFAULT_RATE_TABLE_CHECK_INTERVAL)
+
+    def shared(self):
+        return caches[getattr(settings, "RATE_TABLE_CACHE", "default")]
+
+    def checked_recently(self) -> bool:
+        return time.monotonic() - self._checked_at < self.check_interval
+
+    def changed(self) -> bool:
+        # whether what was loaded has to be reloaded, when it is time for a
+        # check
+        now = time.monotonic()
+        if now - self._checked_at < self.check_interval:
+            return False
+        self._checked_at = now
+        max_age = getattr(settings, "RATE_TABLE_MAX_AGE", DEFAULT_RATE_TABLE_MAX_AGE)
+        return (now - self._loaded_at >= max_age or
+                self.shared().get(self.stamp_key) != self._stamp)
+
+    def current_stamp(self):
+        # read before loading, a change while loading is seen next time
+        return self.shared().get(self.stamp_key)
+
+    def loaded(self, stamp):
+        self._stamp = stamp
+        self._loaded_at = self._checked_at = time.monotonic()
+
+    def bump(self):
+        self.shared().set(self.stamp_key, uuid.uuid4().hex, None)
+
+
+class RateTableCache(SharedStamp):
+    # Process-wide cache of the rate table. The whole table is loaded with a
+    # single query the first time it is needed and dropped again whenever a
+    # PolicyVariable is saved or deleted (see api.signals). Other processes
+    # (web workers, management commands) learn about it through the shared
+    # stamp.
+    stamp_key = RATE_TABLE_STAMP_KEY
+
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.Lock()
+        self._table: Optional[RateTable] = None
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.invalidations = 0
+
+    def table(self) -> RateTable:
+        table = self._table
+        if table is not None and self.checked_recently():
+            self.hits += 1
+            return table
+        with self._lock:
+            if self._table is not None and not self.changed():
+                self.hits += 1
+                return self._table
+            self.misses += 1
+            stamp = self.current_stamp()
+            self._table = self.load()
+            self.loaded(stamp)
+            self.loads += 1
+            return self._table
+
+    async def atable(self) -> RateTable:
+        # table() for async code, the rare check or load runs in a worker
+        # thread
+        table = self._table
+        if table is not None and self.checked_recently():
+            self.hits += 1
+            return table
+        return await sync_to_async(self.table)()
+
+    def load(self) -> RateTable:
+        policy_variable = apps.get_model("api", "PolicyVariable")
+        rows = policy_variable.objects.values_list("scope", "key", "value")
+        return RateTable({(scope, key): value for scope, key, value in rows})
+
+    def get(self, scope: str, key: str) -> float:
+        return self.table().get(scope, key)
+
+    @property
+    def version(self) -> str:
+        return self.table().version
+
+    @property
+    def cost_version(self) -> str:
+        return self.table().cost_version
+
+    @property
+    def is_warm(self) -> bool:
+        return self._table is not None
+
+    def invalidate(self):
+        # here and, through the stamp, in every process sharing the cache
+        with self._lock:
+            self._table = None
+            self.invalidations += 1
+        self.bump()
+
+    def reset_stats(self):
+        self.hits = self.misses = self.loads = self.invalidations = 0
+
+    def stats(self) -> dict:
+        table = self._table
+        return dict(hits=self.hits,
+                    misses=self.misses,
+                    loads=self.loads,
+                    invalidations=self.invalidations,
+                    size=len(table) if table is not None else 0,
+                    version=table.version if table is not None else None)
+
+
+rate_table = RateTableCache()
+
+
+class RateTableSnapshots(SharedStamp):
+    # Process-wide cache of the published RateTableSnapshots. The index of
+    # effective dates is loaded with one query and replaced as a whole when a
+    # snapshot is published, here and through the shared stamp in every other
+    # process (publish_rates runs in one of its own), so a reader always sees
+    # either the old or the new one. Snapshots never change, so their tables
+    # are kept (up to RATE_SNAPSHOT_CACHE_SIZE of them) until they age out.
+    stamp_key = RATE_SNAPSHOT_STAMP_KEY
+
+    def __init__(self, maxsize: int = None):
+        super().__init__()
+        self._maxsize = maxsize
+        self._lock = threading.Lock()
+        # (effective dates, snapshot pks) in effective date order
+        self._index: Optional[Tuple[list, list]] = None
+        self._tables = OrderedDict()
+        self.loads = 0
+
+    @property
+    def maxsize(self) -> int:
+        if self._maxsize is not None:
+            return self._maxsize
+        return getattr(settings, "RATE_SNAPSHOT_CACHE_SIZE", DEFAULT_SNAPSHOT_CACHE_SIZE)
+
+    def index(self) -> Tuple[list, list]:
+        index = self._index
+        if index is not None and self.checked_recently():
+            return index
+        with self._lock:
+            if self._index is not None and not self.changed():
+                return self._index
+            stamp = self.current_stamp()
+            snapshot = apps.get_model("api", "RateTableSnapshot")
+            rows = list(snapshot.objects.order_by("effective_at").values_list("effective_at", "pk"))
+            self._index = ([when for when, _ in rows], [pk for _, pk in rows])
+            self.loaded(stamp)
+            return self._index
+
+    def snapshot_pk(self, when: datetime) -> int:
+        # the pk of the snapshot in effect at `when`: the last one effective
+        # at or before it
+        dates, pks = self.index()
+        i = bisect_right(dates, when)
+        if not i:
+            snapshot = apps.get_model("api", "RateTableSnapshot")
+            raise snapshot.DoesNotExist(
+                "No rate table snapshot was in effect at {}.".format(when.isoformat()))
+        return pks[i - 1]
+
+    def as_of(self, when: datetime) -> RateTable:
+        return self.table(self.snapshot_pk(when))
+
+    def table(self, pk: int) -> RateTable:
+        with self._lock:
+            table = self._tables.get(pk)
+            if table is not None:
+                self._tables.move_to_end(pk)
+                return table
+        snapshot = apps.get_model("api", "RateTableSnapshot")
+        version, values = snapshot.objects.values_list("version", "values").get(pk=pk)
+        table = RateTable({(scope, key): value for scope, key, value in values}, version)
+        with self._lock:
+            self.loads += 1
+            self._tables[pk] = table
+            while len(self._tables) > self.maxsize:
+                self._tables.popitem(last=False)
+        return table
+
+    def invalidate(self):
+        self._index = None
+        self.bump()
+
+    def clear(self):
+        with self._lock:
+            self._index = None
+            self._stamp = None
+            self._tables.clear()
+            self.loads = 0
+
+
+rate_table_snapshots = RateTableSnapshots()
@@ -0,0 +1,855 @@
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.db.models import prefetch_related_objects
+from django.utils import timezone
+from collections import OrderedDict, defaultdict
+from datetime import datetime
+from typing import Iterable, Iterator, List, Sequence, Set, Tuple
+import numpy as np
+import threading
+import logging
+import math
+import time
+
+from .models import (Quote, QuoteVariable, VariableSpecification, PolicyVariable, RatingResult,
+                     GLOBAL_SCOPE, STATE_TAX_RATE_KEY,
+                     VARIABLE_TYPE_STATE_LOOKUP, VARIABLE_TYPE_GLOBAL_LOOKUP,
+                     VARIABLE_TYPE_SIMPLE, VARIABLE_TYPE_FORMULA, VARIABLE_APPLICATION_ADDITIVE,
+                     VARIABLE_APPLICATION_MULTIPLIER, RATING_ERRORS, base_rate_key,
+                     normalized_percent, trunc)
+from .rate_table import rate_table, rate_table_snapshots, RateTable
+from .dependencies import index_quotes
+from .metrics import record_rating
+from .formulas import formula_cache
+from . import fixed_point
+
+DEFAULT_PLAN_CACHE_SIZE = 256
+DEFAULT_RATING_MEMO_SIZE = 100000
+# batches smaller than this are rated quote by quote in plain python
+VECTORIZE_MIN_GROUP = 16
+COST_FIELDS = ["subtotal", "taxes", "total", "rate_version"]
+# settings.RATING_ARITHMETIC, floats (the default) or integer micros and
+# basis points (see api.fixed_point). Stored costs go stale when it changes
+# (see RateTable.cost_version), run rerate_quotes after switching.
+ARITHMETIC_FLOAT = "float"
+ARITHMETIC_FIXED = "fixed"
+
+# what a plan step needs to know about its VariableSpecification. Quotes whose
+# ordered variables have the same signature (and coverage type) share a plan.
+SpecSignature = Tuple[str, int, str, str, str, str]
+
+# How a step gets its value: bound when the plan is compiled (global lookups),
+# bound once per state (state lookups), from the quote variable (simple) or
+# not at all (unknown types, which double the running subtotal just like the
+# single quote rater always has). Formulas (see api.formulas) are evaluated
+# per quote with their rate table entries bound like lookups.
+SOURCE_CONSTANT = "constant"
+SOURCE_STATE = "state"
+SOURCE_SIMPLE = "simple"
+SOURCE_FORMULA = "formula"
+SOURCE_NONE = "none"
+
+
+def spec_signature(spec) -> SpecSignature:
+    return (spec.code, spec.priority, spec.type, spec.application, spec.lookup_key, spec.formula)
+
+
+def arithmetic() -> str:
+    mode = getattr(settings, "RATING_ARITHMETIC", ARITHMETIC_FLOAT)
+    if mode not in (ARITHMETIC_FLOAT, ARITHMETIC_FIXED):
+        raise ImproperlyConfigured("RATING_ARITHMETIC must be {!r} or {!r}, not {!r}".format(
+            ARITHMETIC_FLOAT, ARITHMETIC_FIXED, mode))
+    return mode
+
+
+class PlanStep:
+    __slots__ = ("code", "source", "key", "multiplier", "value")
+
+    def __init__(self, code: str, source: str, key: str, multiplier: bool, value: float):
+        self.code = code
+        self.source = source
+        self.key = key
+        self.multiplier = multiplier
+        # pre-normalized for multipliers, only set for constant steps. The
+        # compiled Formula of formula steps.
+        self.value = value
+
+
+class RatingPlan:
+    # The ordered variable specs for one coverage type compiled against one
+    # rate table. Global lookups and the base rate are resolved at compile
+    # time, state lookups the first time a state is rated and simple values
+    # are the only thing bound per quote.
+    def __init__(self, table: RateTable, coverage_type: str, specs: Sequence[SpecSignature]):
+        self.table = table
+        self.coverage_type = coverage_type
+        self.signature = tuple(specs)
+        self.base = table.get(GLOBAL_SCOPE, base_rate_key(coverage_type))
+        self.steps = tuple(self.compile_step(table, *spec) for spec in specs)
+        self.formulas = any(step.source == SOURCE_FORMULA for step in self.steps)
+        self._states = {}
+
+    @staticmethod
+    def compile_step(table: RateTable, code, priority, type, application, lookup_key,
+                     formula=None) -> PlanStep:
+        if application not in (VARIABLE_APPLICATION_ADDITIVE, VARIABLE_APPLICATION_MULTIPLIER):
+            logging.warning(
+                "Can't handle application {} so returning base value".format(application))
+            return PlanStep(code, SOURCE_NONE, None, True, 1.0)
+        multiplier = application == VARIABLE_APPLICATION_MULTIPLIER
+        if type == VARIABLE_TYPE_GLOBAL_LOOKUP:
+            value = table.get(GLOBAL_SCOPE, lookup_key)
+            return PlanStep(code, SOURCE_CONSTANT, lookup_key, multiplier,
+                            normalized_percent(value) if multiplier else value)
+        elif type == VARIABLE_TYPE_STATE_LOOKUP:
+            return PlanStep(code, SOURCE_STATE, lookup_key, multiplier, None)
+        elif type == VARIABLE_TYPE_SIMPLE:
+            return PlanStep(code, SOURCE_SIMPLE, None, multiplier, None)
+        elif type == VARIABLE_TYPE_FORMULA:
+            compiled = formula_cache.get(code, formula or "")
+            for scope, key in compiled.rates:
+                if scope == "global":
+                    table.get(GLOBAL_SCOPE, key)
+            return PlanStep(code, SOURCE_FORMULA, None, multiplier, compiled)
+        logging.warning("unknown variable type {}".format(type))
+        return PlanStep(code, SOURCE_NONE, None, True, 1.0)
+
+    def state_values(self, state: str) -> Tuple[float, tuple]:
+        # (normalized state tax rate, step values with state lookups bound)
+        bound = self._states.get(state)
+        if bound is None:
+            values = []
+            for step in self.steps:
+                value = step.value
+                if step.source == SOURCE_STATE:
+                    value = self.table.get(state, step.key)
+                    if step.multiplier:
+                        value = normalized_percent(value)
+                elif step.source == SOURCE_FORMULA:
+                    value = formula_rates(self.table, state, step.value)
+                values.append(value)
+            tax_rate = normalized_percent(self.table.get(state, STATE_TAX_RATE_KEY))
+            bound = self._states[state] = (tax_rate, tuple(values))
+        return bound
+
+    def rate(self, state: str, simple_values: Sequence[float]) -> RatingResult:
+        # simple_values lines up with the steps, only the simple ones are read
+        tax_rate, values = self.state_values(state)
+        variables = self.variables(simple_values)
+        sub = self.base
+        for step, value, simple_value in zip(self.steps, values, simple_values):
+            if step.source == SOURCE_SIMPLE:
+                value = simple_value
+                if value is None:
+                    sub = sub + sub
+                    continue
+                if step.multiplier:
+                    value = normalized_percent(value)
+            elif step.source == SOURCE_FORMULA:
+                value = step.value.evaluate(sub, simple_value, state, self.coverage_type,
+                                            variables, value)
+                if step.multiplier:
+                    value = normalized_percent(value)
+            if step.multiplier:
+                sub = sub + sub * value
+            else:
+                sub = sub + value
+        tax = sub * tax_rate
+        sub = round(sub, 2)
+        return RatingResult(subtotal=sub, taxes=trunc(tax), total=trunc(sub + tax))
+
+    def variables(self, simple_values: Sequence[float]) -> dict:
+        # the quote's values by spec code, for formulas
+        if not self.formulas:
+            return {}
+        return {step.code: value for step, value in zip(self.steps, simple_values)}
+
+
+class FixedPointPlan(RatingPlan):
+    # RatingPlan in integers: the base rate and additive values in micros,
+    # multipliers and the tax rate in basis points, see api.fixed_point
+    def __init__(self, table: RateTable, coverage_type: str, specs: Sequence[SpecSignature]):
+        super().__init__(table, coverage_type, specs)
+        self.base = fixed_point.amount(self.base)
+
+    def state_values(self, state: str) -> Tuple[int, tuple]:
+        bound = self._states.get(state)
+        if bound is None:
+            values = []
+            for step in self.steps:
+                if step.source == SOURCE_CONSTANT:
+                    value = self.table.get(GLOBAL_SCOPE, step.key)
+                elif step.source == SOURCE_STATE:
+                    value = self.table.get(state, step.key)
+                elif step.source == SOURCE_NONE:
+                    value = 100.0
+                elif step.source == SOURCE_FORMULA:
+                    values.append(formula_rates(self.table, state, step.value))
+                    continue
+                else:
+                    values.append(None)
+                    continue
+                values.append(fixed_point.step_units(value, step.multiplier))
+            tax_rate = fixed_point.basis_points(self.table.get(state, STATE_TAX_RATE_KEY))
+            bound = self._states[state] = (tax_rate, tuple(values))
+        return bound
+
+    def rate(self, state: str, simple_values: Sequence[float]) -> RatingResult:
+        tax_rate, values = self.state_values(state)
+        variables = self.variables(simple_values)
+        sub = self.base
+        for step, value, simple_value in zip(self.steps, values, simple_values):
+            if step.source == SOURCE_SIMPLE:
+                if simple_value is None:
+                    sub = sub + sub
+                    continue
+                value = fixed_point.step_units(simple_value, step.multiplier)
+            elif step.source == SOURCE_FORMULA:
+                # formulas are evaluated in floats
+                value = fixed_point.step_units(
+                    step.value.evaluate(sub / fixed_point.MICROS, simple_value, state,
+                                        self.coverage_type, variables, value),
+                    step.multiplier)
+            sub = fixed_point.apply(sub, value, step.multiplier)
+        return fixed_point.finish(sub, tax_rate)
+
+
+def formula_rates(table: RateTable, state: str, formula) -> dict:
+    # the rate table entries a formula reads, for one state
+    return {(scope, key): table.get(state if scope == "state" else GLOBAL_SCOPE, key)
+            for scope, key in formula.rates}
+
+
+class PlanCache:
+    # Bounded LRU of compiled plans keyed by rate table version, coverage type
+    # and spec signature. A new rate table version simply misses and the
+    # stale plans age out.
+    def __init__(self, maxsize: int = None):
+        self._maxsize = maxsize
+        self._plans = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.compile_time = 0.0
+
+    @property
+    def maxsize(self) -> int:
+        if self._maxsize is not None:
+            return self._maxsize
+        return getattr(settings, "RATING_PLAN_CACHE_SIZE", DEFAULT_PLAN_CACHE_SIZE)
+
+    def plan_for(self, table: RateTable, coverage_type: str, specs: Sequence[SpecSignature]) -> RatingPlan:
+        mode = arithmetic()
+        key = (table.version, mode, coverage_type, tuple(specs))
+        with self._lock:
+            plan = self._plans.get(key)
+            if plan is not None:
+                self._plans.move_to_end(key)
+                self.hits += 1
+                return plan
+            self.misses += 1
+        started = time.perf_counter()
+        plan = (FixedPointPlan if mode == ARITHMETIC_FIXED else RatingPlan)(table, coverage_type, specs)
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self.compile_time += elapsed
+            self._plans[key] = plan
+            while len(self._plans) > self.maxsize:
+                self._plans.popitem(last=False)
+        return plan
+
+    def clear(self):
+        with self._lock:
+            self._plans.clear()
+            self.hits = self.misses = 0
+            self.compile_time = 0.0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return dict(size=len(self._plans),
+                    maxsize=self.maxsize,
+                    hits=self.hits,
+                    misses=self.misses,
+                    hit_rate=self.hits / lookups if lookups else 0.0,
+                    compile_time=self.compile_time)
+
+
+plan_cache = PlanCache()
+
+
+class RatingMemo:
+    # Bounded LRU of the costs of quote shapes, everything a quote's costs
+    # depend on: (state, coverage type, spec signature, simple values), keyed
+    # along with the rate table version and arithmetic like PlanCache. It
+    # outlives requests, so a book whose quotes come in a few thousand shapes
+    # is only rated a few thousand times per rate table version. Quotes that
+    # can't be rated aren't kept. A size of 0 turns it off.
+    def __init__(self, maxsize: int = None):
+        self._maxsize = maxsize
+        self._costs = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def maxsize(self) -> int:
+        if self._maxsize is not None:
+            return self._maxsize
+        return getattr(settings, "RATING_MEMO_SIZE", DEFAULT_RATING_MEMO_SIZE)
+
+    def get_many(self, table: RateTable, shapes: Sequence[tuple]) -> np.ndarray:
+        # (subtotal, taxes, total) rows of the shapes, nan for the ones it
+        # doesn't have
+        prefix = (table.version, arithmetic())
+        missing = (np.nan, np.nan, np.nan)
+        found = []
+        with self._lock:
+            costs = self._costs
+            for shape in shapes:
+                key = prefix + shape
+                cost = costs.get(key)
+                if cost is None:
+                    found.append(missing)
+                else:
+                    costs.move_to_end(key)
+                    found.append(cost)
+            misses = sum(1 for cost in found if cost is missing)
+            self.misses += misses
+            self.hits += len(found) - misses
+        return np.array(found, dtype=float).reshape(len(found), 3)
+
+    def put_many(self, table: RateTable, shapes: Sequence[tuple], costs: np.ndarray):
+        maxsize = self.maxsize
+        if maxsize <= 0:
+            return
+        prefix = (table.version, arithmetic())
+        # the last maxsize would push out all the others anyway
+        rated = [(shape, cost) for shape, cost in zip(shapes[-maxsize:], costs[-maxsize:].tolist())
+                 if not np.isnan(cost[2])]
+        with self._lock:
+            for shape, cost in rated:
+                self._costs[prefix + shape] = tuple(cost)
+            while len(self._costs) > maxsize:
+                self._costs.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._costs.clear()
+            self.hits = self.misses = 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return dict(size=len(self._costs),
+                    maxsize=self.maxsize,
+                    hits=self.hits,
+                    misses=self.misses,
+                    hit_rate=self.hits / lookups if lookups else 0.0)
+
+
+rating_memo = RatingMemo()
+
+
+def plan_for_quote(quote: Quote, table: RateTable) -> Tuple[RatingPlan, list]:
+    variables = quote.variables.all()
+    plan = plan_cache.plan_for(table, quote.coverage_type,
+                               [spec_signature(v.spec) for v in variables])
+    return plan, [v.value for v in variables]
+
+
+def rate_quote(quote: Quote, table: RateTable = None) -> RatingResult:
+    if table is None:
+        table = rate_table.table()
+    started = time.perf_counter()
+    plan, values = plan_for_quote(quote, table)
+    rate = plan.rate(quote.state, values)
+    record_rating(time.perf_counter() - started, 1)
+    return rate
+
+
+def rate_unsaved(state: str, coverage_type: str,
+                 variables: Sequence[Tuple[VariableSpecification, float]],
+                 table: RateTable = None) -> RatingResult:
+    # Rates a quote that only exists as a description: its state, coverage
+    # type and (VariableSpecification, value) pairs. The variables are put in
+    # priority order like QuoteVariablesManager does for saved quotes.
+    if table is None:
+        table = rate_table.table()
+    started = time.perf_counter()
+    variables = sorted(variables, key=lambda v: v[0].priority)
+    plan = plan_cache.plan_for(table, coverage_type,
+                               [spec_signature(spec) for spec, _ in variables])
+    rate = plan.rate(state, [value for _, value in variables])
+    record_rating(time.perf_counter() - started, 1)
+    return rate
+
+
+class QuoteBatch:
+    # Quotes reduced to what their rating depends on (state, coverage type,
+    # ordered spec signatures and simple values) so that the same batch can
+    # be rated against any number of rate tables without going back to the
+    # database.
+    #
+    # Rather than a plan per distinct set of variables, which a real book has
+    # far too many of to vectorize well, the steps are lined up in columns:
+    # every lookup is resolved once per (spec, state) and step j of every
+    # quote is then applied with a few numpy operations. The arithmetic is the
+    # same as RatingPlan.rate so the results are identical to rating the
+    # quotes one by one.
+    #
+    # Many quotes are priced alike, so only one quote of every distinct
+    # shape (see RatingMemo) that the memo doesn't have is actually rated.
+    def __init__(self):
+        self.size = 0
+        self._states = []
+        self._coverage_types = []
+        # signature -> ([quote index, ...], [simple values, ...])
+        self._groups = {}
+        # shape -> index, and every quote's shape index
+        self._shapes = {}
+        self._quote_shapes = []
+        self._distinct = None
+        self._columns = None
+        self._fixed_values = None
+        self._variable_values = {}
+
+    def add(self, state: str, coverage_type: str, signature: Tuple[SpecSignature, ...],
+            values: Sequence[float]):
+        group = self._groups.get(signature)
+        if group is None:
+            group = self._groups[signature] = ([], [])
+        group[0].append(self.size)
+        group[1].append(values)
+        self._states.append(state)
+        self._coverage_types.append(coverage_type)
+        shape = (state, coverage_type, signature, tuple(values))
+        self._quote_shapes.append(self._shapes.setdefault(shape, len(self._shapes)))
+        self.size += 1
+        self._columns = self._fixed_values = self._distinct = None
+        self._variable_values = {}
+
+    def columns(self):
+        # (distinct states, coverage types and specs, per quote state and
+        # coverage type indexes, spec index and simple value of every step)
+        if self._columns is None:
+            states = sorted(set(self._states))
+            coverage_types = sorted(set(self._coverage_types))
+            state_index = {state: i for i, state in enumerate(states)}
+            coverage_index = {coverage: i for i, coverage in enumerate(coverage_types)}
+            specs = sorted({spec for signature in self._groups for spec in signature})
+            spec_index = {spec: i for i, spec in enumerate(specs)}
+            width = max((len(signature) for signature in self._groups), default=0)
+            # padding steps point at the last spec, see rate_arrays
+            step_specs = np.full((self.size, width), -1, dtype=np.intp)
+            step_values = np.full((self.size, width), np.nan)
+            for signature, (quotes, values) in self._groups.items():
+                if signature:
+                    quotes = np.array(quotes)
+                    step_specs[quotes, :len(signature)] = [spec_index[spec] for spec in signature]
+                    step_values[quotes, :len(signature)] = np.array(values, dtype=float)
+            self._columns = (states, coverage_types, specs,
+                             np.array([state_index[s] for s in self._states], dtype=np.intp),
+                             np.array([coverage_index[c] for c in self._coverage_types], dtype=np.intp),
+                             step_specs, step_values)
+        return self._columns
+
+    def distinct(self) -> "QuoteBatch":
+        # a batch of one quote per shape, in shape index order
+        if len(self._shapes) == self.size:
+            return self
+        if self._distinct is None:
+            self._distinct = QuoteBatch()
+            for shape in self._shapes:
+                self._distinct.add(*shape)
+        return self._distinct
+
+    def rate_arrays(self, table: RateTable, strict: bool = True,
+                    memo: bool = True) -> Tuple[np.ndarray, ...]:
+        # subtotals, taxes and totals in the order the quotes were added.
+        # Unless strict, quotes that read a missing rate table entry come out
+        # as nan. Without memo the shared rating memo is neither read nor
+        # filled, for tables that are only rated once (see api.simulation).
+        shapes = list(self._shapes)
+        memo = memo and len(shapes) <= rating_memo.maxsize
+        if memo:
+            costs = rating_memo.get_many(table, shapes)
+        else:
+            # more than it can hold would only push out what it has
+            costs = np.full((len(shapes), 3), np.nan)
+        missing = np.flatnonzero(np.isnan(costs[:, 2]))
+        if len(missing) == len(shapes):
+            batch = self.distinct()
+        else:
+            batch = QuoteBatch()
+            for i in missing.tolist():
+                batch.add(*shapes[i])
+        if batch.size:
+            costs[missing] = np.column_stack(batch.rate_shapes(table, strict))
+            if memo:
+                rating_memo.put_many(table, [shapes[i] for i in missing.tolist()], costs[missing])
+        if batch is self:
+            return tuple(costs.T.copy())
+        quote_shapes = np.array(self._quote_shapes, dtype=np.intp)
+        return tuple(costs[quote_shapes, c] for c in range(costs.shape[1]))
+
+    def rate_shapes(self, table: RateTable, strict: bool) -> Tuple[np.ndarray, ...]:
+        # rate_arrays without the memo, every quote rated
+        if self.size < VECTORIZE_MIN_GROUP:
+            # numpy's per call overhead isn't worth it for a handful of quotes
+            return self.rate_each(table, strict)
+        if arithmetic() == ARITHMETIC_FIXED:
+            return self.rate_fixed(table, strict)
+        states, coverage_types, specs, quote_states, quote_coverages, \
+            step_specs, step_values = self.columns()
+        base = np.array([lookup(table, GLOBAL_SCOPE, base_rate_key(coverage))
+                         for coverage in coverage_types])
+        tax_rates = np.array([lookup(table, state, STATE_TAX_RATE_KEY, True)
+                              for state in states])
+        # one row per spec plus a padding row that adds 0
+        resolved = np.zeros((len(specs) + 1, len(states)))
+        multiplier = np.zeros(len(specs) + 1, dtype=bool)
+        simple = np.zeros(len(specs) + 1, dtype=bool)
+        formulas = {}
+        for i, spec in enumerate(specs):
+            try:
+                step = RatingPlan.compile_step(table, *spec)
+            except RATING_ERRORS:
+                resolved[i] = np.nan
+                continue
+            multiplier[i] = step.multiplier
+            simple[i] = step.source == SOURCE_SIMPLE
+            if step.source == SOURCE_FORMULA:
+                formulas[i] = step.value
+                continue
+            for j, state in enumerate(states):
+                if step.source == SOURCE_STATE:
+                    resolved[i, j] = lookup(table, state, step.key, step.multiplier)
+                elif step.source != SOURCE_SIMPLE:
+                    resolved[i, j] = step.value
+
+        sub = base[quote_coverages]
+        for j in range(step_specs.shape[1]):
+            spec = step_specs[:, j]
+            column = step_values[:, j]
+            is_multiplier = multiplier[spec]
+            is_simple = simple[spec]
+            value = np.where(is_simple, np.where(is_multiplier, column / 100.0, column),
+                             resolved[spec, quote_states])
+            for i, formula in formulas.items():
+                rows = np.flatnonzero(spec == i)
+                if rows.size:
+                    result = self.evaluate(formula, table, rows, sub[rows], column[rows])
+                    value[rows] = result / 100.0 if multiplier[i] else result
+            applied = np.where(is_multiplier, sub + sub * value, sub + value)
+            # a simple variable without a value doubles the subtotal
+            sub = np.where(is_simple & np.isnan(column), sub + sub, applied)
+        tax = sub * tax_rates[quote_states]
+
+        subtotals = np.array([round(s, 2) for s in sub.tolist()])
+        results = subtotals, trunc_array(tax), trunc_array(subtotals + tax)
+        if strict and np.isnan(subtotals).any():
+            # rate the first one that failed the slow way for its exception
+            self.rate_each(table, True, int(np.flatnonzero(np.isnan(subtotals))[0]))
+        return results
+
+    def rate_fixed(self, table: RateTable, strict: bool) -> Tuple[np.ndarray, ...]:
+        # rate_arrays in int64 with api.fixed_point's rounding. Rate table
+        # values are looked up as floats like above, nan when missing, and
+        # converted at the end.
+        states, coverage_types, specs, quote_states, quote_coverages, \
+            step_specs, step_values = self.columns()
+        if self._fixed_values is None:
+            # simple values in both units, they don't depend on the table
+            self._fixed_values = fixed_point.scaled_array(
+                step_values, (fixed_point.BASIS_POINTS // 100, fixed_point.MICROS))
+        simple_bp, simple_micros = self._fixed_values
+        missing_values = np.isnan(step_values)
+
+        raw_base = np.array([lookup(table, GLOBAL_SCOPE, base_rate_key(coverage))
+                             for coverage in coverage_types])
+        base, = fixed_point.scaled_array(raw_base, (fixed_point.MICROS,))
+        raw_tax_rates = np.array([lookup(table, state, STATE_TAX_RATE_KEY) for state in states])
+        tax_rates, = fixed_point.scaled_array(raw_tax_rates, (fixed_point.BASIS_POINTS // 100,))
+        # one row per spec plus a padding row that adds 0, multipliers in
+        # basis points and the rest in micros
+        raw = np.zeros((len(specs) + 1, len(states)))
+        multiplier = np.zeros(len(specs) + 1, dtype=bool)
+        simple = np.zeros(len(specs) + 1, dtype=bool)
+        formulas = {}
+        for i, spec in enumerate(specs):
+            try:
+                step = RatingPlan.compile_step(table, *spec)
+            except RATING_ERRORS:
+                raw[i] = np.nan
+                continue
+            multiplier[i] = step.multiplier
+            simple[i] = step.source == SOURCE_SIMPLE
+            if step.source == SOURCE_FORMULA:
+                formulas[i] = step.value
+            elif step.source == SOURCE_CONSTANT:
+                raw[i] = lookup(table, GLOBAL_SCOPE, step.key)
+            elif step.source == SOURCE_STATE:
+                raw[i] = [lookup(table, state, step.key) for state in states]
+            elif step.source == SOURCE_NONE:
+                raw[i] = 100.0
+        as_bp, as_micros = fixed_point.scaled_array(
+            raw, (fixed_point.BASIS_POINTS // 100, fixed_point.MICROS))
+        resolved = np.where(multiplier[:, None], as_bp, as_micros)
+
+        failed = np.isnan(raw_base)[quote_coverages]
+        failed |= np.isnan(raw_tax_rates)[quote_states]
+        sub = base[quote_coverages]
+        for j in range(step_specs.shape[1]):
+            spec = step_specs[:, j]
+            is_multiplier = multiplier[spec]
+            is_simple = simple[spec]
+            failed |= np.isnan(raw[spec, quote_states])
+            value = np.where(is_simple, np.where(is_multiplier, simple_bp[:, j], simple_micros[:, j]),
+                             resolved[spec, quote_states])
+            for i, formula in formulas.items():
+                rows = np.flatnonzero(spec == i)
+                if rows.size:
+                    # formulas are evaluated in floats
+                    result = self.evaluate(formula, table, rows, sub[rows] / fixed_point.MICROS,
+                                           step_values[rows, j])
+                    failed[rows] |= np.isnan(result)
+                    value[rows], = fixed_point.scaled_array(result, (
+                        fixed_point.BASIS_POINTS // 100 if multiplier[i] else fixed_point.MICROS,))
+            if fixed_point.overflows(sub, value):
+                return self.rate_each(table, strict)
+            applied = fixed_point.apply_array(sub, value, is_multiplier)
+            sub = np.where(is_simple & missing_values[:, j], sub + sub, applied)
+        tax_rates = tax_rates[quote_states]
+        if fixed_point.overflows(sub, np.maximum(tax_rates, fixed_point.BASIS_POINTS)):
+            return self.rate_each(table, strict)
+
+        results = fixed_point.finish_arrays(sub, tax_rates)
+        if failed.any():
+            if strict:
+                self.rate_each(table, True, int(np.flatnonzero(failed)[0]))
+            for a in results:
+                a[failed] = np.nan
+        return results
+
+    def evaluate(self, formula, table: RateTable, rows: np.ndarray, subtotals: np.ndarray,
+                 values: np.ndarray) -> np.ndarray:
+        # a formula step's values for some of the quotes, nan for the ones
+        # whose state is missing a rate it reads
+        states, coverage_types, _, quote_states, quote_coverages, _, _ = self.columns()
+        rates = {}
+        missing = np.zeros(rows.size, dtype=bool)
+        for scope, key in formula.rates:
+            if scope == "state":
+                rate = np.array([lookup(table, state, key) for state in states])[quote_states[rows]]
+                missing |= np.isnan(rate)
+            else:
+                rate = lookup(table, GLOBAL_SCOPE, key)
+            rates[(scope, key)] = rate
+        result = formula.evaluate(subtotals, values,
+                                  np.array(states)[quote_states[rows]],
+                                  np.array(coverage_types)[quote_coverages[rows]],
+                                  {name: self.variable_values(name)[rows] for name in formula.names},
+                                  rates)
+        return np.where(missing, np.nan, result)
+
+    def variable_values(self, code: str) -> np.ndarray:
+        # every quote's value of the variable with that spec code, nan when
+        # it doesn't have one
+        values = self._variable_values.get(code)
+        if values is None:
+            _, _, specs, _, _, step_specs, step_values = self.columns()
+            indexes = [i for i, spec in enumerate(specs) if spec[0] == code]
+            values = np.full(self.size, np.nan)
+            rows, columns = np.nonzero(np.isin(step_specs, indexes))
+            values[rows] = step_values[rows, columns]
+            values = self._variable_values[code] = values
+        return values
+
+    def rate_each(self, table: RateTable, strict: bool, only: int = None) -> Tuple[np.ndarray, ...]:
+        subtotals, taxes, totals = (np.full(self.size, np.nan) for _ in range(3))
+        for signature, (quotes, values) in self._groups.items():
+            for i, quote_values in zip(quotes, values):
+                if only is not None and i != only:
+                    continue
+                try:
+                    plan = plan_cache.plan_for(table, self._coverage_types[i], signature)
+                    subtotals[i], taxes[i], totals[i] = plan.rate(self._states[i], quote_values)
+                except RATING_ERRORS:
+                    if strict:
+                        raise
+        return subtotals, taxes, totals
+
+    def rate(self, table: RateTable, strict: bool = True) -> List[RatingResult]:
+        return [RatingResult(*rate) for rate in
+                zip(*(a.tolist() for a in self.rate_arrays(table, strict)))]
+
+
+def lookup(table: RateTable, scope: str, key: str, percent: bool = False) -> float:
+    # a rate table value for QuoteBatch, nan when it is missing
+    try:
+        value = table.get(scope, key)
+    except PolicyVariable.DoesNotExist:
+        return np.nan
+    return normalized_percent(value) if percent else value
+
+
+def rate_many(quotes: Iterable[Quote], table: RateTable = None,
+              strict: bool = True) -> List[RatingResult]:
+    # Rates a whole batch of quotes at once. The quotes' variables are
+    # prefetched in a fixed number of queries (no-op when the queryset already
+    # did it) and the rate table comes from the cache. Unless strict, quotes
+    # that can't be rated get nan costs.
+    quotes = list(quotes)
+    if not quotes:
+        return []
+    if table is None:
+        table = rate_table.table()
+    prefetch_related_objects(quotes, "variables__spec")
+
+    started = time.perf_counter()
+    batch = QuoteBatch()
+    for quote in quotes:
+        variables = quote.variables.all()
+        batch.add(quote.state, quote.coverage_type,
+                  tuple(spec_signature(v.spec) for v in variables),
+                  [v.value for v in variables])
+    results = batch.rate(table, strict)
+    record_rating(time.perf_counter() - started, len(quotes))
+    return results
+
+
+def rate_many_as_of(quotes: Iterable[Quote], when: datetime = None) -> List[RatingResult]:
+    # rate_many against the rate table snapshot in effect at `when`, or for
+    # each quote when it was created. Quotes on the same snapshot are rated
+    # together.
+    quotes = list(quotes)
+    groups = defaultdict(list)
+    for i, quote in enumerate(quotes):
+        groups[rate_table_snapshots.snapshot_pk(when or quote.created_at)].append(i)
+    results = [None] * len(quotes)
+    for pk, members in groups.items():
+        rates = rate_many([quotes[i] for i in members], rate_table_snapshots.table(pk))
+        for i, rate in zip(members, rates):
+            results[i] = rate
+    return results
+
+
+def load_batch(queryset, pks: Set[int] = None) -> Tuple[List[tuple], QuoteBatch]:
+    # A QuoteBatch of the quotes in the queryset built from value rows
+    # instead of model instances, which is what makes rating a whole book in
+    # one go affordable: three queries and no per row objects. Returns the
+    # (pk, state, coverage_type) rows in pk order alongside it. With pks only
+    # those quotes are kept, reading a pk range and skipping what isn't
+    # wanted is a lot cheaper than a long IN list.
+    queryset = queryset.prefetch_related(None)
+    quotes = list(queryset.order_by("pk").values_list("pk", "state", "coverage_type"))
+    if pks is not None:
+        quotes = [row for row in quotes if row[0] in pks]
+    return quotes, build_batch(quotes, QuoteVariable.objects.filter(quote__in=queryset.values("pk")))
+
+
+def build_batch(quotes: List[tuple], variables) -> QuoteBatch:
+    # A QuoteBatch of (pk, state, coverage_type) rows, which must be in pk
+    # order, from a QuoteVariable queryset covering at least those quotes.
+    specs = {spec.code: spec_signature(spec) for spec in VariableSpecification.objects.all()}
+    # ordering by priority too would make the database sort every row, the
+    # (quote, spec) index already hands them over a quote at a time.
+    rows = iter(variables.
+                prefetch_related(None).
+                order_by("quote_id").
+                values_list("quote_id", "spec_id", "value"))
+
+    # both sides are in quote order, so this is a merge join. The variables
+    # are put in priority order through the signature of their codes.
+    batch = QuoteBatch()
+    signatures = {}
+    row = next(rows, None)
+    for pk, state, coverage_type in quotes:
+        codes, values = [], []
+        while row is not None and row[0] <= pk:
+            if row[0] == pk:
+                codes.append(row[1])
+                values.append(row[2])
+            row = next(rows, None)
+        codes = tuple(codes)
+        ordered = signatures.get(codes)
+        if ordered is None:
+            order = sorted(range(len(codes)), key=lambda i: specs[codes[i]][1])
+            ordered = signatures[codes] = (tuple(specs[codes[i]] for i in order), order)
+        signature, order = ordered
+        batch.add(state, coverage_type, signature, [values[i] for i in order])
+    return batch
+
+
+def rated_chunks(queryset, chunk_size: int = 2000) -> Iterator[List[Quote]]:
+    # Walks a quote queryset with a server side cursor and yields it a chunk
+    # at a time with every quote rated, so that memory stays flat however
+    # many quotes there are. Quotes with current stored costs aren't rated.
+    chunk = []
+    for quote in queryset.iterator(chunk_size=chunk_size):
+        chunk.append(quote)
+        if len(chunk) == chunk_size:
+            yield rate_chunk(chunk)
+            chunk = []
+    if chunk:
+        yield rate_chunk(chunk)
+
+
+def rate_chunk(quotes: List[Quote]) -> List[Quote]:
+    unrated = [q for q in quotes if q.stored_cost is None]
+    for quote, rate in zip(unrated, rate_many(unrated)):
+        quote._batch_rate = rate
+    return quotes
+
+
+async def arate_quotes(quotes: List[Quote]) -> List[Quote]:
+    # rate_chunk for async views. Only the rate table (when the cache is
+    # cold) and the variables of quotes with stale costs need the database;
+    # the rating itself doesn't block.
+    table = await rate_table.atable()
+    stale = []
+    for quote in quotes:
+        stored = quote.stored_cost_at(table.cost_version)
+        if stored is None:
+            stale.append(quote)
+        else:
+            quote._batch_rate = stored
+    if stale:
+        await sync_to_async(prefetch_related_objects)(stale, "variables__spec")
+        for quote, rate in zip(stale, rate_many(stale, table)):
+            quote._batch_rate = rate
+    return quotes
+
+
+def refresh_costs(quotes: Iterable[Quote], table: RateTable = None, strict: bool = True) -> int:
+    # rates the quotes in a batch and writes the materialized cost columns
+    # back in one bulk update along with their dependency index rows. Quotes
+    # whose costs change count as modified (see api.caching). Unless strict,
+    # quotes that can't be rated are left stale (rate_version None).
+    quotes = list(quotes)
+    if not quotes:
+        return 0
+    if table is None:
+        table = rate_table.table()
+    now = timezone.now()
+    for quote, rate in zip(quotes, rate_many(quotes, table, strict)):
+        if math.isnan(rate.total):
+            if quote.rate_version is not None:
+                quote.updated_at = now
+            quote.rate_version = None
+            continue
+        if (quote.subtotal, quote.taxes, quote.total) != tuple(rate):
+            quote.updated_at = now
+        quote.subtotal, quote.taxes, quote.total = rate
+        quote.rate_version = table.cost_version
+    with transaction.atomic():
+        Quote.objects.bulk_update(quotes, COST_FIELDS + ["updated_at"])
+        # a quote's dependencies only change along with its costs
+        index_quotes(quotes)
+    return len(quotes)
+
+
+def trunc_array(n: np.ndarray) -> np.ndarray:
+    # vectorized models.trunc
+    return np.floor(n * 100) / 100
@@ -1,5 +1,21 @@
 from rest_framework import serializers
-from .models import Quote
+from .aggregates import GROUP_BY_CHOICES
+from .export import parse_when
+from .metrics import serialization
+from .models import Quote, PolicyRater, QUOTE_STATE_CHOICES, COVERAGE_TYPE_CHOICES
+
+
+class QuoteListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        # rate everything that wasn't already rated by the queryset in one
+        # batch instead of once per row in get_cost.
+        quotes = list(data.all() if hasattr(data, "all") else data)
+        unrated = [q for q in quotes if getattr(q, "_batch_rate", None) is None
+                   and q.stored_cost is None]
+        for quote, rate in zip(unrated, PolicyRater.rate_many(unrated)):
+            quote._batch_rate = rate
+        with serialization():
+            return super().to_representation(quotes)
 
 
 class QuoteSerializer(serializers.ModelSerializer):
@@ -7,12 +23,115 @@ class QuoteSerializer(serializers.ModelSerializer):
     class Meta:
         model = Quote
         fields = ['customer_name', 'description', 'state', 'coverage_type', 'cost']
+        list_serializer_class = QuoteListSerializer
 
+    def to_representation(self, instance):
+        with serialization():
+            return super().to_representation(instance)
 
     def get_cost(self, obj: Quote):
-        rate = obj.rate
+        rate = obj.cost
         return dict(
             subtotal=rate.subtotal,
             taxes=rate.taxes,
             total=rate.total
-        )
\ No newline at end of file
+        )
+
+
+class RateVariableSerializer(serializers.Serializer):
+    code = serializers.CharField(max_length=32)
+    value = serializers.FloatField(required=False, allow_null=True, default=None)
+
+
+class RateRequestSerializer(serializers.Serializer):
+    # an unsaved quote to be priced by POST quotes/rate
+    state = serializers.ChoiceField(choices=QUOTE_STATE_CHOICES)
+    coverage_type = serializers.ChoiceField(choices=COVERAGE_TYPE_CHOICES, default="basic")
+    variables = RateVariableSerializer(many=True, required=False, default=list)
+
+    def validate_variables(self, variables):
+        codes = [v["code"] for v in variables]
+        if len(set(codes)) != len(codes):
+            raise serializers.ValidationError("Variables must be unique.")
+        return variables
+
+
+class BulkVariableSerializer(RateVariableSerializer):
+    notes = serializers.CharField(max_length=1024, required=False, allow_null=True,
+                                  allow_blank=True, default=None)
+
+
+class BulkQuoteSerializer(RateRequestSerializer):
+    # a quote to create with POST quotes/bulk
+    customer = serializers.IntegerField()
+    description = serializers.CharField(max_length=50, required=False, allow_null=True,
+                                        allow_blank=True, default=None)
+    variables = BulkVariableSerializer(many=True, required=False, default=list)
+
+
+class RateOverrideSerializer(serializers.Serializer):
+    scope = serializers.CharField(max_length=64)
+    key = serializers.CharField(max_length=64)
+    value = serializers.FloatField()
+
+
+class RateSimulationSerializer(serializers.Serializer):
+    # proposed rate table values for POST rates/simulate
+    overrides = RateOverrideSerializer(many=True, allow_empty=False)
+    all = serializers.BooleanField(default=False)
+    diff = serializers.BooleanField(default=False)
+
+    def validate_overrides(self, overrides):
+        keys = [(o["scope"], o["key"]) for o in overrides]
+        if len(set(keys)) != len(keys):
+            raise serializers.ValidationError("Overrides must be unique.")
+        return overrides
+
+
+class QuoteExportSerializer(serializers.Serializer):
+    # query parameters of GET quotes/export
+    type = serializers.ChoiceField(choices=["csv", "ndjson"], default="csv")
+    state = serializers.ListField(child=serializers.ChoiceField(choices=QUOTE_STATE_CHOICES),
+                                  required=False, default=list)
+    coverage_type = serializers.ListField(
+        child=serializers.ChoiceField(choices=COVERAGE_TYPE_CHOICES), required=False, default=list)
+    created_after = serializers.CharField(required=False)
+    created_before = serializers.CharField(required=False)
+
+    def validate_created_after(self, value):
+        return self.parse(value)
+
+    def validate_created_before(self, value):
+        return self.parse(value, end=True)
+
+    @staticmethod
+    def parse(value, end=False):
+        try:
+            return parse_when(value, end)
+        except ValueError as e:
+            raise serializers.ValidationError(str(e))
+
+
+class QuoteFilterSerializer(QuoteExportSerializer):
+    # query parameters of GET quotes, see api.filters
+    type = None
+    customer = serializers.ListField(child=serializers.IntegerField(min_value=1),
+                                     required=False, default=list)
+    updated_after = serializers.CharField(required=False)
+    updated_before = serializers.CharField(required=False)
+    customer_name = serializers.CharField(max_length=255, required=False, trim_whitespace=False)
+
+    def validate_updated_after(self, value):
+        return self.parse(value)
+
+    def validate_updated_before(self, value):
+        return self.parse(value, end=True)
+
+
+class QuoteAggregateSerializer(QuoteFilterSerializer):
+    # query parameters of GET quotes/aggregate
+    group_by = serializers.ListField(child=serializers.ChoiceField(choices=GROUP_BY_CHOICES),
+                                     required=False, default=list)
+
+    def validate_group_by(self, value):
+        return list(dict.fromkeys(value))
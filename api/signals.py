@@ -0,0 +1,123 @@
+from contextlib import contextmanager
+from django.db import transaction
+from django.db.models.signals import pre_save, pre_delete, post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+from .models import (PolicyVariable, Quote, QuoteVariable, VariableSpecification, RateTableSnapshot,
+                     RATING_ERRORS)
+from .rate_table import rate_table, rate_table_snapshots
+from .rating import refresh_costs
+from .dependencies import rerate_dependents
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+@receiver(pre_save, sender=PolicyVariable)
+@receiver(pre_delete, sender=PolicyVariable)
+def remember_rate_table(sender, instance, raw=False, **kwargs):
+    # the table version and the row's (scope, key) from before the change,
+    # for re-rating the quotes that depended on it afterwards.
+    if raw:
+        return
+    previous = PolicyVariable.objects.filter(pk=instance.pk).values_list(
+        "scope", "key").first() if instance.pk else None
+    instance._rate_table_before = (rate_table.cost_version, previous)
+
+
+@receiver(post_save, sender=PolicyVariable)
+@receiver(post_delete, sender=PolicyVariable)
+def invalidate_rate_table(sender, instance, raw=False, **kwargs):
+    # drop it right away so the rest of this transaction sees the change and
+    # again once it commits in case something reloaded the table in between.
+    rate_table.invalidate()
+    transaction.on_commit(rate_table.invalidate)
+    before = getattr(instance, "_rate_table_before", None)
+    if raw or before is None:
+        return
+    version, previous = before
+    changed = {(instance.scope, instance.key)}
+    if previous is not None:
+        changed.add(previous)
+    rerate_dependents(changed, version)
+
+
+@receiver(post_save, sender=RateTableSnapshot)
+@receiver(post_delete, sender=RateTableSnapshot)
+def invalidate_rate_table_snapshots(sender, instance, **kwargs):
+    rate_table_snapshots.invalidate()
+    transaction.on_commit(rate_table_snapshots.invalidate)
+
+
+# The materialized costs on Quote are recomputed in the same transaction as
+# the change that affects them. Fixture loading (raw) is skipped because the
+# related rows may not be there yet; those quotes show up in Quote.objects.stale().
+
+@receiver(post_save, sender=Quote)
+def refresh_quote_cost(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    (refreshed,) = refresh_quote_costs([instance.pk])
+    instance.subtotal, instance.taxes, instance.total = (
+        refreshed.subtotal, refreshed.taxes, refreshed.total)
+    instance.rate_version = refreshed.rate_version
+
+
+@receiver(post_save, sender=QuoteVariable)
+@receiver(post_delete, sender=QuoteVariable)
+def refresh_quote_variable_cost(sender, instance, raw=False, origin=None, **kwargs):
+    # nothing to do when the variable is going away with its quote
+    if raw or isinstance(origin, Quote) or getattr(origin, "model", None) is Quote:
+        return
+    pending = getattr(deferred, "pks", None)
+    if pending is not None:
+        pending.add(instance.quote_id)
+        return
+    refresh_quote_costs([instance.quote_id])
+
+
+@receiver(post_save, sender=VariableSpecification)
+def refresh_spec_costs(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    quotes = Quote.objects.filter(variables__spec=instance)
+    try:
+        with transaction.atomic():
+            quotes.refresh_costs()
+    except RATING_ERRORS as e:
+        logger.warning("can't re-rate quotes: %s", e)
+        quotes.update(rate_version=None, updated_at=timezone.now())
+
+
+deferred = threading.local()
+
+
+@contextmanager
+def deferred_cost_refresh():
+    # Quotes whose variables change inside the block are re-rated once, all
+    # together, when it ends instead of after every change. Yields the set of
+    # pending quote pks, for changes that don't send signals (bulk_create).
+    pending = getattr(deferred, "pks", None)
+    if pending is not None:
+        yield pending
+        return
+    deferred.pks = pending = set()
+    try:
+        yield pending
+    finally:
+        deferred.pks = None
+    if pending:
+        refresh_quote_costs(pending)
+
+
+def refresh_quote_costs(pks):
+    try:
+        with transaction.atomic():
+            quotes = list(Quote.objects.filter(pk__in=pks))
+            refresh_costs(quotes)
+    except RATING_ERRORS as e:
+        logger.warning("can't re-rate quotes: %s", e)
+        Quote.objects.filter(pk__in=pks).update(rate_version=None, updated_at=timezone.now())
+        quotes = list(Quote.objects.filter(pk__in=pks))
+    return quotes
@@ -0,0 +1,149 @@
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+import numpy as np
+import time
+
+from .dependencies import dependent_quotes
+from .models import Quote
+from .rate_table import RateKey, RateTable, rate_table
+from .rating import load_batch
+
+SIMULATION_CHUNK_SIZE = 50000
+PERCENTILES = (5, 25, 50, 75, 95)
+COST_COLUMNS = ("subtotal", "taxes", "total")
+
+
+class Simulation:
+    # The costs of a set of quotes under the current rate table and under
+    # the table with some proposed values, side by side. Nothing is written:
+    # both sides are rated in memory from the same rows, so the stored costs
+    # (which may be stale) play no part in it.
+    def __init__(self, overrides: Dict[RateKey, float], table: RateTable):
+        self.overrides = overrides
+        self.table = table
+        self.proposed = RateTable({**table.values, **overrides})
+        self.pks: List[int] = []
+        self.states: List[str] = []
+        self.coverage_types: List[str] = []
+        self._current = []
+        self._simulated = []
+        self.seconds = 0.0
+
+    def add(self, rows: List[tuple], current: np.ndarray, simulated: np.ndarray):
+        # the results of rate_range for one chunk
+        for pk, state, coverage_type in rows:
+            self.pks.append(pk)
+            self.states.append(state)
+            self.coverage_types.append(coverage_type)
+        self._current.append(current)
+        self._simulated.append(simulated)
+
+    @property
+    def current(self) -> np.ndarray:
+        # one row per quote, one column per COST_COLUMNS entry
+        return np.concatenate(self._current) if self._current else np.empty((0, 3))
+
+    @property
+    def simulated(self) -> np.ndarray:
+        return np.concatenate(self._simulated) if self._simulated else np.empty((0, 3))
+
+    def summary(self) -> dict:
+        current, simulated = self.current, self.simulated
+        # quotes that can't be rated now (a rate table entry they read is
+        # missing) have nothing to compare against
+        rated = ~np.isnan(current).any(axis=1)
+        delta = simulated - current
+        states = np.array(self.states, dtype=object)
+        coverage_types = np.array(self.coverage_types, dtype=object)
+        return dict(
+            version=self.table.version,
+            proposed_version=self.proposed.version,
+            overrides=[dict(scope=scope, key=key, value=self.table.values.get((scope, key)),
+                            proposed=value)
+                       for (scope, key), value in sorted(self.overrides.items())],
+            unrated=int((~rated).sum()),
+            seconds=round(self.seconds, 3),
+            **describe(current, delta, rated),
+            by_state={state: describe(current, delta, rated & (states == state))
+                      for state in sorted(set(self.states))},
+            by_coverage_type={coverage: describe(current, delta, rated & (coverage_types == coverage))
+                              for coverage in sorted(set(self.coverage_types))})
+
+    def diff(self) -> Iterator[list]:
+        # [pk, state, coverage_type, current costs..., simulated costs...] for
+        # every quote whose costs would move
+        current, simulated = self.current, self.simulated
+        changed = np.flatnonzero((current != simulated).any(axis=1) &
+                                 ~np.isnan(current).any(axis=1))
+        for i in changed.tolist():
+            yield [self.pks[i], self.states[i], self.coverage_types[i],
+                   *current[i].tolist(), *simulated[i].tolist()]
+
+
+def describe(current: np.ndarray, delta: np.ndarray, mask: np.ndarray) -> dict:
+    current, delta = current[mask], delta[mask]
+    changed = (delta != 0).any(axis=1)
+    summary = dict(quotes=len(delta), changed=int(changed.sum()))
+    if not len(delta):
+        return summary
+    summary["mean_delta"] = {column: round(float(delta[:, i].mean()), 4)
+                             for i, column in enumerate(COST_COLUMNS)}
+    total_delta = delta[:, 2]
+    summary["total_delta"] = dict(
+        min=round(float(total_delta.min()), 4),
+        max=round(float(total_delta.max()), 4),
+        **{"p{}".format(p): round(float(v), 4)
+           for p, v in zip(PERCENTILES, np.percentile(total_delta, PERCENTILES))})
+    priced = current[:, 2] != 0
+    if priced.any():
+        summary["mean_total_change_percent"] = round(
+            float((total_delta[priced] / current[priced, 2]).mean() * 100), 4)
+    return summary
+
+
+def affected_pks(scope_keys) -> Set[int]:
+    # quotes that read one of the entries according to the dependency index,
+    # plus the ones with stale costs whose index rows can't be trusted.
+    pks = set(dependent_quotes(scope_keys).values_list("pk", flat=True))
+    pks.update(Quote.objects.stale().values_list("pk", flat=True))
+    return pks
+
+
+def chunks(queryset, overrides: Dict[RateKey, float], affected_only: bool = True,
+           chunk_size: int = SIMULATION_CHUNK_SIZE) -> List[Tuple[int, int, Optional[Set[int]]]]:
+    # (lo, hi, pks to keep) ranges covering the quotes to simulate
+    pks = list(queryset.prefetch_related(None).order_by("pk").values_list("pk", flat=True))
+    if affected_only:
+        affected = affected_pks(overrides)
+        pks = [pk for pk in pks if pk in affected]
+    return [(chunk[0], chunk[-1], set(chunk) if affected_only else None)
+            for chunk in (pks[start:start + chunk_size]
+                          for start in range(0, len(pks), chunk_size))]
+
+
+def rate_range(query, lo: int, hi: int, pks: Optional[Set[int]],
+               table: RateTable, proposed: RateTable):
+    # Rates one chunk under both tables. Takes the queryset's query rather
+    # than the queryset so that it can be sent to a worker process. The
+    # proposed table is hypothetical, its costs stay out of the rating memo.
+    queryset = Quote.objects.all()
+    queryset.query = query
+    rows, batch = load_batch(queryset.filter(pk__gte=lo, pk__lte=hi), pks)
+    return (rows,
+            np.column_stack(batch.rate_arrays(table, strict=False)),
+            np.column_stack(batch.rate_arrays(proposed, strict=False, memo=False)))
+
+
+def simulate(overrides: Dict[RateKey, float], queryset=None, affected_only: bool = True,
+             chunk_size: int = SIMULATION_CHUNK_SIZE) -> Simulation:
+    # Rates the quotes in queryset (by default all of them) under both rate
+    # tables, only the ones the overrides affect unless affected_only is
+    # off. The quotes are loaded a pk range at a time to keep memory flat.
+    started = time.perf_counter()
+    simulation = Simulation(overrides, rate_table.table())
+    if queryset is None:
+        queryset = Quote.objects.all()
+    for lo, hi, pks in chunks(queryset, overrides, affected_only, chunk_size):
+        simulation.add(*rate_range(queryset.query, lo, hi, pks,
+                                   simulation.table, simulation.proposed))
+    simulation.seconds = time.perf_counter() - started
+    return simulation
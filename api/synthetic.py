@@ -0,0 +1,112 @@
+from django.db import transaction
+from itertools import islice
+import random
+
+from .models import (Customer, Quote, QuoteVariable, VariableSpecification,
+                     PolicyVariable, QUOTE_STATE_CHOICES, COVERAGE_TYPE_CHOICES,
+                     VARIABLE_TYPE_CHOICES, VARIABLE_TYPE_SIMPLE, VARIABLE_TYPE_FORMULA,
+                     VARIABLE_APPLICATION_CHOICES, VARIABLE_APPLICATION_MULTIPLIER,
+                     GLOBAL_SCOPE, STATE_TAX_RATE_KEY, BASIC_POLICY_BASE_KEY,
+                     PREMIUM_POLICY_BASE_KEY)
+from .rate_table import rate_table
+
+SYNTHETIC_PREFIX = "syn_"
+BATCH_SIZE = 5000
+STATES = [state for state, _ in QUOTE_STATE_CHOICES]
+COVERAGE_TYPES = [coverage for coverage, _ in COVERAGE_TYPE_CHOICES]
+# simple values come from a short list so that, like real books of business,
+# a lot of quotes end up priced the same way.
+SIMPLE_VALUES = [1.0, 2.5, 5.0, 7.5, 10.0, 12.5, 15.0, 25.0]
+# formula variables read their state's value above a subtotal
+FORMULA = 'state_rate("{}") if subtotal > 30 else 0'
+
+
+def generate(quotes: int, customers: int = None, specs_per_kind: int = 2,
+             max_variables: int = 5, seed: int = 0) -> dict:
+    # Creates a reproducible synthetic book of business: rate tables for every
+    # state, specs of each type and application, customers, quotes and their
+    # variables. Rows are written with bulk_create, so no costs are stored;
+    # use Quote.objects.stale().refresh_costs() for that.
+    rng = random.Random(seed)
+    if customers is None:
+        customers = max(1, quotes // 10)
+    with transaction.atomic():
+        specs = generate_rate_tables(rng, specs_per_kind)
+        customer_pks = generate_customers(customers)
+        quote_count, variable_count = generate_quotes(
+            rng, quotes, customer_pks, specs, max_variables)
+    rate_table.invalidate()
+    return dict(customers=customers, quotes=quote_count,
+                variables=variable_count, specs=len(specs))
+
+
+def generate_rate_tables(rng: random.Random, specs_per_kind: int):
+    values = {(GLOBAL_SCOPE, BASIC_POLICY_BASE_KEY): 20.0,
+              (GLOBAL_SCOPE, PREMIUM_POLICY_BASE_KEY): 40.0}
+    for state in STATES:
+        values[(state, STATE_TAX_RATE_KEY)] = round(rng.uniform(0.5, 8.0), 2)
+
+    specs = []
+    for type, _ in VARIABLE_TYPE_CHOICES:
+        for application, _ in VARIABLE_APPLICATION_CHOICES:
+            for i in range(specs_per_kind):
+                code = "{}{}_{}_{}".format(SYNTHETIC_PREFIX, type, application, i)
+                lookup_key = formula = None
+                if type != VARIABLE_TYPE_SIMPLE:
+                    lookup_key = code + "_value"
+                    scopes = [GLOBAL_SCOPE] + STATES
+                    for scope in scopes:
+                        values[(scope, lookup_key)] = lookup_value(rng, application)
+                if type == VARIABLE_TYPE_FORMULA:
+                    lookup_key, formula = None, FORMULA.format(lookup_key)
+                specs.append(VariableSpecification(
+                    code=code, type=type, application=application,
+                    description="Synthetic {} {} variable".format(type, application),
+                    priority=rng.randrange(1, 200), lookup_key=lookup_key, formula=formula))
+
+    PolicyVariable.objects.bulk_create(
+        [PolicyVariable(scope=scope, key=key, value=value)
+         for (scope, key), value in values.items()],
+        update_conflicts=True, unique_fields=["key", "scope"], update_fields=["value"])
+    VariableSpecification.objects.bulk_create(specs, ignore_conflicts=True)
+    return specs
+
+
+def lookup_value(rng: random.Random, application: str) -> float:
+    if application == VARIABLE_APPLICATION_MULTIPLIER:
+        return round(rng.uniform(0, 25), 2)
+    return round(rng.uniform(1, 50), 2)
+
+
+def generate_customers(count: int):
+    first = Customer.objects.count()
+    created = Customer.objects.bulk_create(
+        (Customer(name="Synthetic Customer {}".format(first + i)) for i in range(count)),
+        batch_size=BATCH_SIZE)
+    return [c.pk for c in created]
+
+
+def generate_quotes(rng: random.Random, count: int, customer_pks, specs, max_variables: int):
+    quote_count = variable_count = 0
+    remaining = iter(range(count))
+    while True:
+        batch = list(islice(remaining, BATCH_SIZE))
+        if not batch:
+            break
+        quotes = Quote.objects.bulk_create([
+            Quote(customer_id=rng.choice(customer_pks),
+                  description="Synthetic quote {}".format(i),
+                  state=rng.choice(STATES),
+                  coverage_type=rng.choice(COVERAGE_TYPES))
+            for i in batch])
+        variables = []
+        for quote in quotes:
+            for spec in rng.sample(specs, rng.randint(0, min(max_variables, len(specs)))):
+                value = None
+                if spec.type == VARIABLE_TYPE_SIMPLE:
+                    value = rng.choice(SIMPLE_VALUES)
+                variables.append(QuoteVariable(quote_id=quote.pk, spec_id=spec.code, value=value))
+        QuoteVariable.objects.bulk_create(variables, batch_size=BATCH_SIZE)
+        quote_count += len(quotes)
+        variable_count += len(variables)
+    return quote_count, variable_count
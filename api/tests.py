@@ -1,6 +1,52 @@
-from django.test import TestCase
+from django.contrib.auth.models import User
+from django.test import LiveServerTestCase, TestCase, TransactionTestCase, override_settings
 from .models import Quote, Customer, RatingResult, PolicyVariable, trunc, normalized_percent, GLOBAL_SCOPE, STATE_TAX_RATE_KEY, PREMIUM_POLICY_BASE_KEY, BASIC_POLICY_BASE_KEY
+from .models import PolicyRater, QuoteVariable, VariableSpecification, VARIABLE_TYPE_SIMPLE, VARIABLE_APPLICATION_ADDITIVE, VARIABLE_APPLICATION_MULTIPLIER
 from .serializers import QuoteSerializer
+from .models import base_rate_key, RateTableSnapshot
+from .rate_table import (rate_table, rate_table_snapshots, RateTable, RATE_SNAPSHOT_STAMP_KEY,
+                         RATE_TABLE_STAMP_KEY)
+from .caching import response_cache
+from .lean import quote_rows, rate_rows, render_quotes
+from .rating import plan_cache, PlanCache, spec_signature, load_batch, rate_many, rate_many_as_of, refresh_costs
+from .rating import FixedPointPlan, QuoteBatch, RatingMemo, RatingPlan, rating_memo
+from . import fixed_point
+from .simulation import simulate
+from .export import parse_when
+from .filters import filter_quotes
+from .pagination import KeysetPagination
+from .views import QuoteViewSet
+from .dependencies import dependent_quotes, quote_dependencies
+from .synthetic import generate
+from . import aggregates, benchmarks, loadtest, metrics
+from .models import VARIABLE_TYPE_CHOICES, VARIABLE_APPLICATION_CHOICES, VARIABLE_TYPE_FORMULA
+from .formulas import Formula, FormulaError, formula_cache
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from datetime import timedelta
+from asgiref.sync import sync_to_async
+from collections import OrderedDict
+from rest_framework.renderers import JSONRenderer
+from functools import reduce
+from fractions import Fraction
+from math import floor
+import math
+import warnings
+import asyncio
+import csv
+from io import StringIO
+from unittest import mock
+import json
+import numpy as np
+import os
+import pstats
+import random
+import tempfile
 # Create your tests here.
 
 
@@ -99,3 +145,2057 @@ class SerializerTests(TestCase):
                        'total': r.total}}
 
        self.assertDictEqual(expected, d)
+
+
+class RateTableCacheTests(TestCase):
+    fixtures = ["customers.json",
+                "policy_variables.json",
+                "quote_variables.json",
+                "quotes.json",
+                "variable_specifications.json"]
+
+    def setUp(self):
+        rate_table.invalidate()
+        rate_table.reset_stats()
+
+    def test_loads_in_one_query(self):
+        with self.assertNumQueries(1):
+            table = rate_table.table()
+        self.assertEqual(len(table), PolicyVariable.objects.count())
+        self.assertEqual(table.get('CA', STATE_TAX_RATE_KEY), 1.0)
+        with self.assertRaises(PolicyVariable.DoesNotExist):
+            table.get('CA', 'not_a_key')
+
+    def test_warm_cache_does_no_rate_table_queries(self):
+        q = Quote.objects.get(pk=1)
+        q.rate
+        with self.assertNumQueries(0):
+            rate = q.rate
+        self.assertEqual(rate.total, 41.2)
+        stats = rate_table.stats()
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['loads'], 1)
+
+    def test_save_and_delete_invalidate(self):
+        # the cache holds on to the change when the test rolls it back
+        self.addCleanup(rate_table.invalidate)
+        version = rate_table.version
+        pv = PolicyVariable.objects.get(scope='CA', key=STATE_TAX_RATE_KEY)
+        pv.value = 2.0
+        pv.save()
+        self.assertEqual(rate_table.stats()['invalidations'], 1)
+        self.assertNotEqual(rate_table.version, version)
+        self.assertEqual(Quote.objects.get(pk=1).rate.taxes, .81)
+
+        version = rate_table.version
+        PolicyVariable.objects.get(scope='global', key='pet_premium_addition').delete()
+        self.assertEqual(rate_table.stats()['invalidations'], 2)
+        self.assertNotEqual(rate_table.version, version)
+        with self.assertRaises(PolicyVariable.DoesNotExist):
+            Quote.objects.get(pk=1).rate
+
+    def test_changes_in_other_processes(self):
+        self.addCleanup(rate_table.invalidate)
+        table = rate_table.table()
+        # another process changing a rate, without this one's signals
+        PolicyVariable.objects.filter(scope='CA', key=STATE_TAX_RATE_KEY).update(value=2.0)
+        self.assertIs(rate_table.table(), table)
+        with self.settings(RATE_TABLE_CHECK_INTERVAL=0):
+            self.assertIs(rate_table.table(), table)
+            # and replacing the stamp, like its invalidate() does
+            rate_table.shared().set(RATE_TABLE_STAMP_KEY, 'other process')
+            self.assertEqual(rate_table.table().get('CA', STATE_TAX_RATE_KEY), 2.0)
+            self.assertEqual(rate_table.stats()['loads'], 2)
+
+    def test_reloaded_when_old(self):
+        self.addCleanup(rate_table.invalidate)
+        table = rate_table.table()
+        with self.settings(RATE_TABLE_CHECK_INTERVAL=0, RATE_TABLE_MAX_AGE=0):
+            self.assertIsNot(rate_table.table(), table)
+
+
+class BatchRatingTests(TestCase):
+    fixtures = ["customers.json",
+                "policy_variables.json",
+                "quote_variables.json",
+                "quotes.json",
+                "variable_specifications.json"]
+
+    def setUp(self):
+        response_cache().clear()
+
+    def test_rate_many_matches_canned_scenarios(self):
+        expected = {1: RatingResult(40.8, .40, 41.2),
+                    2: RatingResult(61.2, .61, 61.81),
+                    3: RatingResult(60.0, 1.20, 61.20),
+                    4: RatingResult(30.0, .15, 30.15)}
+        quotes = list(Quote.objects.order_by('pk'))
+        rates = PolicyRater.rate_many(quotes)
+        self.assertEqual(dict(zip([q.pk for q in quotes], rates)), expected)
+
+    def test_matches_single_rater(self):
+        pugs = VariableSpecification.objects.create(
+            code='pug_count', type=VARIABLE_TYPE_SIMPLE,
+            application=VARIABLE_APPLICATION_MULTIPLIER,
+            description='', priority=50)
+        fee = VariableSpecification.objects.create(
+            code='fee', type=VARIABLE_TYPE_SIMPLE,
+            application=VARIABLE_APPLICATION_ADDITIVE,
+            description='', priority=200)
+        for i, q in enumerate(Quote.objects.all()):
+            QuoteVariable.objects.create(quote=q, spec=pugs, value=3.3 * i)
+            if i % 2:
+                QuoteVariable.objects.create(quote=q, spec=fee, value=7.77)
+        quotes = list(Quote.objects.order_by('pk'))
+        singles = [PolicyRater(q).calculate_quote_rate() for q in quotes]
+        self.assertEqual(PolicyRater.rate_many(quotes), singles)
+
+    def test_with_rates_uses_constant_queries(self):
+        rate_table.table()
+        # quotes, customers, quote variables and their specs
+        with self.assertNumQueries(4):
+            quotes = list(Quote.objects.with_rates())
+            rates = [q.rate for q in quotes]
+        self.assertEqual(len(rates), 4)
+
+    def test_list_endpoint(self):
+        rate_table.table()
+        # the ETag's, quotes joined with customers, then variables and specs
+        # for rating
+        with self.assertNumQueries(4):
+            response = self.client.get('/api/v1/quotes/')
+        self.assertEqual(response.status_code, 200)
+        by_description = {q['description']: q['cost'] for q in response.json()['results']}
+        self.assertEqual(by_description['Quote 2'],
+                         dict(subtotal=61.2, taxes=.61, total=61.81))
+
+    def test_list_serializer_batches(self):
+        quotes = list(Quote.objects.all())
+        rate_table.table()
+        with self.assertNumQueries(0):
+            data = QuoteSerializer(quotes, many=True).data
+        self.assertEqual(data[0]['cost']['total'], quotes[0].rate.total)
+
+
+class RatingPlanTests(TestCase):
+    fixtures = ["customers.json",
+                "policy_variables.json",
+                "quote_variables.json",
+                "quotes.json",
+                "variable_specifications.json"]
+
+    def setUp(self):
+        plan_cache.clear()
+
+    def reference_rate(self, quote: Quote) -> RatingResult:
+        # the original reduction over PolicyRater.variable_value
+        pr = PolicyRater(quote)
+        sub = reduce(lambda acc, var: acc + pr.variable_value(acc, var),
+                     quote.variables.all(),
+                     pr.table.get(GLOBAL_SCOPE, base_rate_key(quote.coverage_type)))
+        tax = sub * normalized_percent(pr.table.get(quote.state, STATE_TAX_RATE_KEY))
+        sub = round(sub, 2)
+        return RatingResult(sub, trunc(tax), trunc(sub + tax))
+
+    def test_quotes_share_plans(self):
+        quotes = list(Quote.objects.all())
+        for q in quotes + quotes:
+            q.rate
+        stats = plan_cache.stats()
+        self.assertEqual(stats['size'], 4)
+        self.assertEqual(stats['hits'], 4)
+        self.assertEqual(stats['misses'], 4)
+        self.assertGreater(stats['compile_time'], 0)
+
+    def test_cache_is_bounded(self):
+        cache = PlanCache(maxsize=2)
+        table = rate_table.table()
+        for q in Quote.objects.all():
+            plan = cache.plan_for(table, q.coverage_type,
+                                  [spec_signature(v.spec) for v in q.variables.all()])
+            self.assertEqual(plan.rate(q.state, [v.value for v in q.variables.all()]),
+                             self.reference_rate(q))
+        self.assertEqual(cache.stats()['size'], 2)
+
+    def test_matches_reference_rater(self):
+        rng = random.Random(1234)
+        specs = [VariableSpecification.objects.create(
+            code='spec_{}'.format(i), type=VARIABLE_TYPE_SIMPLE,
+            application=rng.choice([VARIABLE_APPLICATION_ADDITIVE,
+                                    VARIABLE_APPLICATION_MULTIPLIER]),
+            description='', priority=rng.randint(1, 300)) for i in range(6)]
+        specs += list(VariableSpecification.objects.filter(
+            code__in=['flood_addition_indicator', 'pet_ownership_indicator']))
+        customer = Customer.objects.get(pk=1)
+        for i in range(60):
+            q = Quote.objects.create(customer=customer,
+                                     state=rng.choice(['NY', 'CA', 'TX']),
+                                     coverage_type=rng.choice(['basic', 'premium']))
+            for spec in rng.sample(specs, rng.randint(0, len(specs))):
+                QuoteVariable.objects.create(
+                    quote=q, spec=spec,
+                    value=rng.choice([None, round(rng.uniform(-20, 120), 2)]))
+        quotes = list(Quote.objects.order_by('pk'))
+        with self.assertLogs(level='WARNING'):
+            expected = [self.reference_rate(q) for q in quotes]
+        self.assertEqual([q.rate for q in quotes], expected)
+        self.assertEqual(PolicyRater.rate_many(quotes), expected)
+
+
+class RatingMemoTests(TestCase):
+    fixtures = ["customers.json",
+                "policy_variables.json",
+                "quote_variables.json",
+                "quotes.json",
+                "variable_specifications.json"]
+
+    def setUp(self):
+        rating_memo.clear()
+        self.addCleanup(rating_memo.clear)
+        self.addCleanup(rate_table.invalidate)
+
+    def book(self, size: int, seed: int = 0) -> QuoteBatch:
+        # the fixture quotes' variables with values from a short list, so
+        # that many quotes come out alike
+        rng = random.Random(seed)
+        quotes = [(q.state, q.coverage_type, tuple(spec_signature(v.spec) for v in q.variables.all()))
+                  for q in Quote.objects.prefetch_related('variables__spec')]
+        batch = QuoteBatch()
+        for _ in range(size):
+            state, coverage_type, signature = rng.choice(quotes)
+            batch.add(rng.choice([state, 'CA', 'TX']), coverage_type, signature,
+                      [rng.choice([None, 1.0, 2.5]) for _ in signature])
+        return batch
+
+    def test_distinct_shapes_rated_once(self):
+        batch = self.book(500)
+        table = rate_table.table()
+        shapes = len(batch.distinct()._shapes)
+        self.assertLess(shapes, 100)
+        rates = batch.rate(table)
+        self.assertEqual(rating_memo.stats()['misses'], shapes)
+        self.assertEqual(rating_memo.stats()['size'], shapes)
+        self.assertEqual(rates, [RatingResult(*rate) for rate in
+                                 zip(*(a.tolist() for a in batch.rate_shapes(table, True)))])
+
+        # another batch of the same shapes is all hits
+        self.assertEqual(self.book(500).rate(table), rates)
+        stats = rating_memo.stats()
+        self.assertEqual(stats['hits'], shapes)
+        self.assertEqual(stats['hit_rate'], .5)
+
+    def test_matches_rating_every_quote(self):
+        table = rate_table.table()
+        for mode in ['float', 'fixed']:
+            with self.subTest(mode=mode), override_settings(RATING_ARITHMETIC=mode):
+                batch = self.book(300, seed=1)
+                expected = batch.rate_shapes(table, True)
+                # half of them from the memo, the other half not
+                self.book(150, seed=1).rate_arrays(table)
+                for rated, want in zip(batch.rate_arrays(table), expected):
+                    self.assertEqual(rated.tolist(), want.tolist())
+
+    def test_new_rate_table_misses(self):
+        batch = self.book(100)
+        before = batch.rate(rate_table.table())
+        PolicyVariable.objects.filter(key=STATE_TAX_RATE_KEY).update(value=9.0)
+        rate_table.invalidate()
+        table = rate_table.table()
+        after = batch.rate(table)
+        self.assertNotEqual(before, after)
+        self.assertEqual(rating_memo.stats()['hits'], 0)
+        self.assertEqual(after, [RatingResult(*rate) for rate in
+                                 zip(*(a.tolist() for a in batch.rate_shapes(table, True)))])
+
+    def test_unratable_quotes_are_not_kept(self):
+        PolicyVariable.objects.get(scope='global', key='pet_premium_addition').delete()
+        rate_table.invalidate()
+        batch = self.book(100)
+        subtotals, _, _ = batch.rate_arrays(rate_table.table(), strict=False)
+        self.assertTrue(np.isnan(subtotals).any())
+        distinct, _, _ = batch.distinct().rate_shapes(rate_table.table(), False)
+        self.assertEqual(rating_memo.stats()['size'], (~np.isnan(distinct)).sum())
+        with self.assertRaises(PolicyVariable.DoesNotExist):
+            batch.rate(rate_table.table())
+
+    def test_bounded(self):
+        memo = RatingMemo(maxsize=2)
+        table = rate_table.table()
+        shapes = [('NY', 'basic', (), (float(i),)) for i in range(3)]
+        memo.put_many(table, shapes, np.array([[i, 0, i] for i in range(3)], dtype=float))
+        self.assertEqual(memo.stats()['size'], 2)
+        self.assertEqual(memo.get_many(table, shapes)[:, 2].tolist()[1:], [1.0, 2.0])
+        self.assertTrue(math.isnan(memo.get_many(table, shapes)[0, 2]))
+
+        # a batch of more shapes than the memo holds doesn't go through it
+        with override_settings(RATING_MEMO_SIZE=3):
+            self.book(500).rate(table)
+        self.assertEqual(rating_memo.stats()['size'], 0)
+        self.assertEqual(rating_memo.stats()['misses'], 0)
+
+    def test_metrics(self):
+        self.book(100).rate(rate_table.table())
+        body = self.client.get('/metrics').content.decode()
+        self.assertIn('acme_rating_memo_lookups_total{{result="miss"}} {}'.format(
+            rating_memo.stats()['misses']), body)
+        self.assertIn('acme_rating_memo_size {}'.format(rating_memo.stats()['size']), body)
+
+
+class MaterializedCostTests(TestCase):
+    fixtures = ["customers.json",
+                "policy_variables.json",
+                "quote_variables.json",
+                "quotes.json",
+                "variable_specifications.json"]
+
+    def setUp(self):
+        response_cache().clear()
+
+    def test_fixture_quotes_are_stale_until_refreshed(self):
+        self.assertEqual(Quote.objects.stale().count(), 4)
+        self.assertEqual(Quote.objects.stale().refresh_costs(), 4)
+        self.assertEqual(Quote.objects.stale().count(), 0)
+        q = Quote.objects.get(pk=2)
+        self.assertEqual(q.stored_cost, RatingResult(61.2, .61, 61.81))
+        self.assertEqual(q.rate_version, rate_table.version)
+
+    def test_recomputed_on_change(self):
+        q = Quote.objects.create(customer_id=1, description='new', state='CA')
+        self.assertEqual(q.total, 20.2)
+        self.assertEqual(Quote.objects.get(pk=q.pk).stored_cost, q.rate)
+
+        var = QuoteVariable.objects.create(quote=q, spec_id='pet_ownership_indicator')
+        self.assertEqual(Quote.objects.get(pk=q.pk).total, 40.4)
+
+        spec = var.spec
+        spec.lookup_key = 'basic_policy_base'
+        spec.save()
+        self.assertEqual(Quote.objects.get(pk=q.pk).total, 40.4)
+        self.assertEqual(Quote.objects.get(pk=1).total, 41.2)
+
+        var.delete()
+        self.assertEqual(Quote.objects.get(pk=q.pk).total, 20.2)
+
+        q.coverage_type = 'premium'
+        q.save()
+        self.assertEqual(q.total, 40.4)
+        self.assertEqual(Quote.objects.get(pk=q.pk).total, 40.4)
+
+    def test_switching_arithmetic_makes_costs_stale(self):
+        Quote.objects.all().refresh_costs()
+        etag = self.client.get('/api/v1/quotes/1/')['ETag']
+        with override_settings(RATING_ARITHMETIC='fixed'):
+            self.assertEqual(Quote.objects.stale().count(), 4)
+            self.assertIsNone(Quote.objects.get(pk=1).stored_cost)
+            self.assertNotEqual(self.client.get('/api/v1/quotes/1/')['ETag'], etag)
+            Quote.objects.all().refresh_costs()
+            self.assertEqual(Quote.objects.stale().count(), 0)
+            self.assertEqual(len(Quote.objects.get(pk=1).rate_version), 16)
+        self.assertEqual(Quote.objects.stale().count(), 4)
+
+    def test_unratable_changes_leave_quotes_stale(self):
+        self.addCleanup(rate_table.invalidate)
+        spec = VariableSpecification.objects.create(
+            code='missing', type='global_lookup', application=VARIABLE_APPLICATION_ADDITIVE,
+            description='', priority=10, lookup_key='not_there')
+        with self.assertLogs('api.signals', 'WARNING'):
+            QuoteVariable.objects.create(quote_id=1, spec=spec)
+        self.assertIsNone(Quote.objects.get(pk=1).rate_version)
+        with self.assertLogs('api.signals', 'WARNING'):
+            spec.priority = 20
+            spec.save()
+
+        PolicyVariable.objects.get(scope='TX', key=STATE_TAX_RATE_KEY).delete()
+        with self.assertLogs('api.signals', 'WARNING'):
+            q = Quote.objects.create(customer_id=1, description='new', state='TX')
+        self.assertIsNone(q.rate_version)
+        self.assertIn(q, Quote.objects.stale())
+
+    def test_stale_costs_fall_back_to_live_rating(self):
+        # the cache holds on to the change when the test rolls it back
+        self.addCleanup(rate_table.invalidate)
+        pv = PolicyVariable.objects.get(scope='CA', key=STATE_TAX_RATE_KEY)
+        pv.value = 2.0
+        pv.save()
+        q = Quote.objects.get(pk=1)
+        self.assertIsNone(q.stored_cost)
+        self.assertEqual(q.cost.taxes, .81)
+        self.assertEqual(QuoteSerializer(q).data['cost']['taxes'], .81)
+
+    def test_list_endpoint_reads_columns(self):
+        Quote.objects.all().refresh_costs()
+        rate_table.table()
+        # the ETag's and the page's
+        with self.assertNumQueries(2):
+            response = self.client.get('/api/v1/quotes/')
+        self.assertEqual(len(response.json()['results']), 4)
+
+
+class DependencyIndexTests(TestCase):
+    fixtures = ["customers.json",
+                "policy_variables.json",
+                "quote_variables.json",
+                "quotes.json",
+                "variable_specifications.json"]
+
+    def setUp(self):
+        self.addCleanup(rate_table.invalidate)
+        Quote.objects.all().refresh_costs()
+
+    def dependents(self, scope, key):
+        return set(dependent_quotes([(scope, key)]).values_list('pk', flat=True))
+
+    def test_index(self):
+        self.assertEqual(self.dependents('global', BASIC_POLICY_BASE_KEY), {1, 4})
+        self.assertEqual(self.dependents('CA', STATE_TAX_RATE_KEY), {1, 2})
+        self.assertEqual(self.dependents('CA', 'flood_coverage_multiplier'), {1, 2})
+        self.assertEqual(self.dependents('global', 'pet_premium_addition'), {1, 2, 3})
+        self.assertEqual(self.dependents('NY', 'flood_coverage_multiplier'), set())
+
+    def test_kept_up_to_date(self):
+        q = Quote.objects.create(customer_id=1, state='NY')
+        self.assertIn(q.pk, self.dependents('NY', STATE_TAX_RATE_KEY))
+        var = QuoteVariable.objects.create(quote=q, spec_id='flood_addition_indicator')
+        self.assertEqual(self.dependents('NY', 'flood_coverage_multiplier'), {q.pk})
+        var.delete()
+        self.assertEqual(self.dependents('NY', 'flood_coverage_multiplier'), set())
+        q.state = 'TX'
+        q.save()
+        self.assertNotIn(q.pk, self.dependents('NY', STATE_TAX_RATE_KEY))
+        self.assertIn(q.pk, self.dependents('TX', STATE_TAX_RATE_KEY))
+        q.delete()
+        self.assertNotIn(q.pk, self.dependents('TX', STATE_TAX_RATE_KEY))
+
+    def test_change_rerates_only_dependents(self):
+        before = {q.pk: q.updated_at for q in Quote.objects.all()}
+        pv = PolicyVariable.objects.get(scope='CA', key='flood_coverage_multiplier')
+        pv.value = 10.0
+        with CaptureQueriesContext(connection) as queries:
+            pv.save()
+        updates = [q['sql'] for q in queries if q['sql'].startswith('UPDATE "api_quote"')]
+        # the bulk update of quotes 1 and 2 and the version bump of 3 and 4
+        self.assertEqual(len(updates), 2)
+        self.assertEqual(Quote.objects.stale().count(), 0)
+        self.assertEqual(Quote.objects.get(pk=1).total, 44.44)
+        self.assertEqual(Quote.objects.get(pk=3).total, 61.2)
+
+    def test_missing_lookup_leaves_dependents_stale(self):
+        PolicyVariable.objects.get(scope='global', key='pet_premium_addition').delete()
+        self.assertEqual(set(Quote.objects.stale().values_list('pk', flat=True)), {1, 2, 3})
+
+
+class RerateQuotesCommandTests(TestCase):
+    fixtures = ["customers.json",
+                "policy_variables.json",
+                "quote_variables.json",
+                "quotes.json",
+                "variable_specifications.json"]
+
+    def rerate(self, *args):
+        out, err = StringIO(), StringIO()
+        call_command('rerate_quotes', '--workers', '1', *args, stdout=out, stderr=err)
+        return out.getvalue(), err.getvalue()
+
+    def test_rerates_filtered_quotes(self):
+        out, _ = self.rerate('--state', 'CA', '--chunk-size', '1')
+        self.assertIn('re-rated 2 quotes', out)
+        self.assertEqual(set(Quote.objects.stale().values_list('pk', flat=True)), {3, 4})
+        self.assertEqual(Quote.objects.get(pk=2).total, 61.81)
+        out, _ = self.rerate('--stale', '--coverage-type', 'premium')
+        self.assertIn('re-rated 1 quotes', out)
+
+    def test_dry_run(self):
+        self.rerate()
+        Quote.objects.filter(pk=3).update(total=1.0)
+        out, err = self.rerate('--dry-run')
+        self.assertEqual(out.splitlines()[1:], ['3,60.0,1.2,1.0,60.0,1.2,61.2'])
+        self.assertIn('rated 4 quotes', err)
+        self.assertEqual(Quote.objects.get(pk=3).total, 1.0)
+
+    def test_missing_rate(self):
+        self.addCleanup(rate_table.invalidate)
+        PolicyVariable.objects.filter(scope='global', key='pet_premium_addition').delete()
+        rate_table.invalidate()
+        out, err = self.rerate('--dry-run')
+        self.assertEqual(out.splitlines()[1:], ['4,None,None,None,30.0,0.15,30.15'])
+        self.assertIn('3 quotes can\'t be rated', err)
+        out, _ = self.rerate('--chunk-size', '2')
+        self.assertIn('re-rated 4 quotes', out)
+        self.assertIn('3 quotes can\'t be rated', out)
+        self.assertEqual(set(Quote.objects.filter(rate_version=None).values_list('pk', flat=True)),
+                         {1, 2, 3})
+        self.assertEqual(Quote.objects.get(pk=4).total, 30.15)
+
+    def test_checkpoint(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            checkpoint = os.path.join(tmp, 'checkpoint.json')
+            out, _ = self.rerate('--checkpoint', checkpoint, '--chunk-size', '3')
+            self.assertIn('2 chunks to rate, 0 already done', out)
+            Quote.objects.all().update(rate_version=None)
+            out, _ = self.rerate('--checkpoint', checkpoint, '--chunk-size', '3')
+            self.assertIn('0 chunks to rate, 2 already done', out)
+            self.assertEqual(Quote.objects.stale().count(), 4)
+            with self.assertRaises(CommandError):
+                self.rerate('--checkpoint', checkpoint, '--chunk-size', '2')
+
+
+class BenchmarkTests(TestCase):
+    def tearDown(self):
+        rate_table.invalidate()
+
+    def test_generate(self):
+        generated = generate(40, seed=7)
+        self.assertEqual(generated['quotes'], 40)
+        self.assertEqual(generated['specs'], 16)
+        self.assertEqual(Quote.objects.count(), 40)
+        self.assertEqual(QuoteVariable.objects.count(), generated['variables'])
+        self.assertEqual(set(VariableSpecification.objects.values_list('type', 'application').distinct()),
+                         {(t, a) for t, _ in VARIABLE_TYPE_CHOICES for a, _ in VARIABLE_APPLICATION_CHOICES})
+        shape = list(Quote.objects.order_by('pk').values_list('state', 'coverage_type'))
+        # every quote can be rated against the generated tables
+        self.assertEqual(len(PolicyRater.rate_many(Quote.objects.all())), 40)
+
+        Quote.objects.all().delete()
+        generate(40, seed=7)
+        self.assertEqual(list(Quote.objects.order_by('pk').values_list('state', 'coverage_type')), shape)
+
+    def test_run(self):
+        report = benchmarks.run([30], repeat=1)
+        names = [r['benchmark'] for r in report['results']]
+        self.assertIn('list_endpoint', names)
+        self.assertIn('calculate_quote_rate', names)
+        self.assertIn('bulk_create', names)
+        self.assertTrue(all(r['within_budget'] for r in report['results']), report['results'])
+        # everything it generated was rolled back
+        self.assertEqual(Quote.objects.count(), 0)
+        json.dumps(report)
+
+
+class QuoteListPaginationTests(TestCase):
+    fixtures = ["customers.json",
+                "policy_variables.json",
+                "quote_variables.json",
+                "quotes.json",
+                "variable_specifications.json"]
+
+    def setUp(self):
+        # two quotes share a created_at so the id has to break the tie
+        Quote.objects.filter(pk=3).update(created_at=Quote.objects.get(pk=2).created_at)
+
+    def test_pages(self):
+        response = self.client.get('/api/v1/quotes/', {'page_size': 2})
+        page = response.json()
+        self.assertEqual([q['description'] for q in page['results']], ['Quote 1', 'Quote 2'])
+        self.assertIsNone(page['previous'])
+
+        page = self.client.get(page['next']).json()
+        self.assertEqual([q['description'] for q in page['results']], ['Quote 3', 'Quote 4'])
+        self.assertIsNone(page['next'])
+
+        page = self.client.get(page['previous']).json()
+        self.assertEqual([q['description'] for q in page['results']], ['Quote 1', 'Quote 2'])
+        self.assertIsNone(page['previous'])
+        self.assertIsNotNone(page['next'])
+
+    def test_new_rows_dont_shift_pages(self):
+        page = self.client.get('/api/v1/quotes/', {'page_size': 3}).json()
+        Quote.objects.filter(pk=1).delete()
+        page = self.client.get(page['next']).json()
+        self.assertEqual([q['description'] for q in page['results']], ['Quote 4'])
+
+    def test_invalid_cursor(self):
+        response = self.client.get('/api/v1/quotes/', {'cursor': 'bogus'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_stream(self):
+        response = self.client.get('/api/v1/quotes/', {'stream': '1'})
+        self.assertTrue(response.streaming)
+        streamed = json.loads(b''.join(response.streaming_content))
+        expected = QuoteSerializer(Quote.objects.order_by('created_at', 'id'), many=True).data
+        self.assertEqual(streamed, expected)
+
+    def test_stream_in_chunks(self):
+        generate(25, seed=3)
+        self.addCleanup(rate_table.invalidate)
+        with mock.patch('api.views.STREAM_CHUNK_SIZE', 10):
+            response = self.client.get('/api/v1/quotes/', {'stream': 'true'})
+            streamed = json.loads(b''.join(response.streaming_content))
+        self.assertEqual(len(streamed), 29)
+        self.assertEqual(streamed[-1]['cost'], QuoteSerializer(
+            Quote.objects.order_by('created_at', 'id').last()).data['cost'])
+
+
+class RateUnsavedQuotesTests(TestCase):
+    fixtures = ["customers.json",
+                "policy_variables.json",
+                "quote_variables.json",
+                "quotes.json",
+                "variable_specifications.json"]
+
+    def post(self, data):
+        return self.client.post('/api/v1/quotes/rate/', data, content_type='application/json')
+
+    def test_matches_saved_quotes(self):
+        quotes = list(Quote.objects.order_by('pk'))
+        data = [{'state': q.state, 'coverage_type': q.coverage_type,
+                 'variables': [{'code': v.spec_id} for v in reversed(q.variables.all())]}
+                for q in quotes]
+        counts = (Quote.objects.count(), QuoteVariable.objects.count())
+        response = self.post({'quotes': data})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([r['cost'] for r in response.json()['results']],
+                         [QuoteSerializer(q).data['cost'] for q in quotes])
+        self.assertEqual((Quote.objects.count(), QuoteVariable.objects.count()), counts)
+
+    def test_simple_values(self):
+        VariableSpecification.objects.create(
+            code='discount', type=VARIABLE_TYPE_SIMPLE,
+            application=VARIABLE_APPLICATION_MULTIPLIER, description='', priority=5)
+        response = self.post([{'state': 'TX',
+                               'variables': [{'code': 'discount', 'value': -10}]}])
+        self.assertEqual(response.json()['results'][0]['cost'],
+                         {'subtotal': 18.0, 'taxes': .09, 'total': 18.09})
+
+    def test_per_item_errors(self):
+        PolicyVariable.objects.filter(scope='NY', key='flood_coverage_multiplier').delete()
+        self.addCleanup(rate_table.invalidate)
+        response = self.post([
+            {'state': 'CA'},
+            {'state': 'ZZ'},
+            {'state': 'CA', 'variables': [{'code': 'nope'}]},
+            {'state': 'NY', 'variables': [{'code': 'flood_addition_indicator'}]},
+            {'state': 'CA', 'variables': [{'code': 'pet_ownership_indicator'},
+                                          {'code': 'pet_ownership_indicator'}]},
+        ])
+        results = response.json()['results']
+        self.assertEqual(results[0]['cost']['total'], 20.2)
+        self.assertIn('state', results[1]['errors'])
+        self.assertIn('nope', results[2]['errors']['variables'][0])
+        self.assertIn('NY/flood_coverage_multiplier', results[3]['errors']['non_field_errors'][0])
+        self.assertIn('variables', results[4]['errors'])
+
+    def test_bad_request(self):
+        self.assertEqual(self.post({'state': 'CA'}).status_code, 400)
+        with mock.patch('api.views.MAX_RATE_REQUESTS', 2):
+            self.assertEqual(self.post([{'state': 'CA'}] * 3).status_code, 400)
+
+
+class AsyncQuoteViewTests(TestCase):
+    fixtures = ["customers.json",
+                "policy_variables.json",
+                "quote_variables.json",
+                "quotes.json",
+                "variable_specifications.json"]
+
+    async def test_detail(self):
+        rate_table.invalidate()
+        response = await self.async_client.get('/api/v1/async/quotes/2/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['cost'], {'subtotal': 61.2, 'taxes': .61, 'total': 61.81})
+        response = await self.async_client.get('/api/v1/async/quotes/99/')
+        self.assertEqual(response.status_code, 404)
+
+    async def test_list_matches_sync_view(self):
+        await sync_to_async(Quote.objects.filter(pk__in=[1, 2]).refresh_costs)()
+        response = await self.async_client.get('/api/v1/async/quotes/', {'page_size': 3})
+        expected = await sync_to_async(self.client.get)('/api/v1/quotes/', {'page_size': 3})
+        self.assertEqual(response.json()['results'], expected.json()['results'])
+        self.assertIsNotNone(response.json()['next'])
+        response = await self.async_client.get(response.json()['next'])
+        self.assertEqual([q['description'] for q in response.json()['results']], ['Quote 4'])
+
+    async def test_bad_cursor(self):
+        response = await self.async_client.get('/api/v1/async/quotes/', {'cursor': 'zzz'})
+        expected = await sync_to_async(self.client.get)('/api/v1/quotes/', {'cursor': 'zzz'})
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json(), expected.json())
+
+    async def test_concurrent_requests(self):
+        responses = await asyncio.gather(*[
+            self.async_client.get('/api/v1/async/quotes/{}/'.format(pk % 4 + 1))
+            for pk in range(20)])
+        self.assertTrue(all(r.status_code == 200 for r in responses))
+
+    async def test_method_not_allowed(self):
+        response = await self.async_client.post('/api/v1/async/quotes/')
+        self.assertEqual(response.status_code, 405)
+
+
+class MetricsTests(TestCase):
+    fixtures = ["customers.json",
+                "policy_variables.json",
+                "quote_variables.json",
+                "quotes.json",
+                "variable_specifications.json"]
+
+    def setUp(self):
+        response_cache().clear()
+        for histogram in metrics.HISTOGRAMS:
+            histogram.reset()
+
+    def test_server_timing(self):
+        rate_table.invalidate()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/v1/quotes/')
+        timing = response['Server-Timing']
+        self.assertIn('desc="{} queries"'.format(len(queries)), timing)
+        self.assertIn('desc="4 quotes"', timing)
+        self.assertIn('serialize;dur=', timing)
+
+    async def test_async_server_timing(self):
+        rate_table.invalidate()
+        response = await self.async_client.get('/api/v1/async/quotes/1/')
+        # rate table, quote and customer, variables, specs
+        self.assertIn('desc="4 queries"', response['Server-Timing'])
+        self.assertIn('desc="1 quotes"', response['Server-Timing'])
+
+    def test_metrics_endpoint(self):
+        self.client.get('/api/v1/quotes/')
+        self.client.get('/api/v1/quotes/1/')
+        body = self.client.get('/metrics').content.decode()
+        self.assertIn('# TYPE acme_request_duration_seconds histogram', body)
+        self.assertIn('acme_request_duration_seconds_count{view="quote-list"} 1', body)
+        self.assertIn('acme_request_sql_queries_bucket{view="quote-detail",le="+Inf"} 1', body)
+        self.assertIn('acme_quote_rating_duration_seconds_count 5', body)
+
+    def test_streamed_metrics(self):
+        rate_table.invalidate()
+        response = self.client.get('/api/v1/quotes/', {'stream': '1'})
+        self.assertNotIn('Server-Timing', response)
+        self.assertNotIn('view="quote-list"', self.client.get('/metrics').content.decode())
+        b''.join(response.streaming_content)
+        body = self.client.get('/metrics').content.decode()
+        self.assertIn('acme_request_duration_seconds_count{view="quote-list"} 1', body)
+        # rate table, quotes, variables, specs, all read while streaming
+        self.assertIn('acme_request_sql_queries_sum{view="quote-list"} 4.0', body)
+        self.assertIn('acme_quote_rating_duration_seconds_count 4', body)
+
+    def test_slow_request_profiles(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            with self.settings(METRICS_PROFILE_SAMPLE_RATE=1.0, METRICS_PROFILE_DIR=tmp,
+                               METRICS_PROFILE_KEEP=2):
+                for i in range(4):
+                    self.client.get('/api/v1/quotes/')
+            profiles = os.listdir(tmp)
+            self.assertEqual(len(profiles), 2)
+            pstats.Stats(os.path.join(tmp, profiles[0]))
+
+
+class RateSimulationTests(TestCase):
+    fixtures = ["customers.json",
+                "policy_variables.json",
+                "quote_variables.json",
+                "quotes.json",
+                "variable_specifications.json"]
+
+    def setUp(self):
+        self.addCleanup(rate_table.invalidate)
+        Quote.objects.all().refresh_costs()
+
+    def costs(self):
+        return {q.pk: (q.subtotal, q.taxes, q.total) for q in Quote.objects.all()}
+
+    def test_proposed_table_stays_out_of_the_memo(self):
+        rating_memo.clear()
+        self.addCleanup(rating_memo.clear)
+        simulate({('global', BASIC_POLICY_BASE_KEY): 25.0}, affected_only=False)
+        self.assertTrue(rating_memo.stats()['size'])
+        self.assertEqual({key[0] for key in rating_memo._costs}, {rate_table.version})
+
+    def test_matches_publishing_the_values(self):
+        before = self.costs()
+        overrides = {('CA', 'flood_coverage_multiplier'): 10.0,
+                     ('global', BASIC_POLICY_BASE_KEY): 25.0}
+        with CaptureQueriesContext(connection) as queries:
+            simulation = simulate(overrides)
+        self.assertFalse([q for q in queries if not q['sql'].startswith('SELECT')])
+        self.assertEqual(self.costs(), before)
+        summary = simulation.summary()
+        self.assertEqual(summary['quotes'], 3)
+        self.assertEqual(summary['changed'], 3)
+        self.assertEqual(summary['by_state']['CA']['quotes'], 2)
+        self.assertEqual(summary['overrides'][0]['value'], PolicyVariable.objects.get(
+            scope='CA', key='flood_coverage_multiplier').value)
+
+        for (scope, key), value in overrides.items():
+            PolicyVariable.objects.filter(scope=scope, key=key).update(value=value)
+        rate_table.invalidate()
+        Quote.objects.all().refresh_costs()
+        after = self.costs()
+        diff = {row[0]: tuple(row[6:]) for row in simulation.diff()}
+        self.assertEqual(diff, {pk: after[pk] for pk in after if after[pk] != before[pk]})
+        self.assertAlmostEqual(summary['mean_delta']['total'],
+                               sum(after[pk][2] - before[pk][2] for pk in diff) / 3, 3)
+
+    def test_batch_matches_rate_many(self):
+        generate(300, seed=7)
+        quotes, batch = load_batch(Quote.objects.all())
+        self.assertEqual(batch.rate(rate_table.table()),
+                         PolicyRater.rate_many(Quote.objects.filter(
+                             pk__in=[pk for pk, _, _ in quotes]).order_by('pk')))
+
+    def test_unread_key_affects_nothing(self):
+        summary = simulate({('NY', 'flood_coverage_multiplier'): 50.0}).summary()
+        self.assertEqual((summary['quotes'], summary['changed']), (0, 0))
+        summary = simulate({('NY', 'flood_coverage_multiplier'): 50.0},
+                           affected_only=False, chunk_size=1).summary()
+        self.assertEqual((summary['quotes'], summary['changed']), (4, 0))
+
+    def test_endpoint(self):
+        response = self.client.post('/api/v1/rates/simulate/', {
+            'overrides': [{'scope': 'CA', 'key': STATE_TAX_RATE_KEY, 'value': 10}],
+            'diff': True}, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data['changed'], 2)
+        self.assertEqual({d['quote'] for d in data['diff']}, {1, 2})
+        self.assertEqual(data['diff'][0]['current']['total'], Quote.objects.get(pk=1).total)
+
+        response = self.client.post('/api/v1/rates/simulate/', {'overrides': []},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_command(self):
+        out, err = StringIO(), StringIO()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'diff.csv')
+            call_command('simulate_rates', 'CA/{}=10'.format(STATE_TAX_RATE_KEY),
+                         '--workers', '1', '--diff', path, stdout=out, stderr=err)
+            with open(path) as f:
+                rows = f.read().splitlines()
+        self.assertEqual(json.loads(out.getvalue())['changed'], 2)
+        self.assertEqual(len(rows), 3)
+        with self.assertRaises(CommandError):
+            call_command('simulate_rates', 'CA-tax', stdout=out, stderr=err)
+
+
+class RateTableSnapshotTests(TestCase):
+    fixtures = ["customers.json",
+                "policy_variables.json",
+                "quote_variables.json",
+                "quotes.json",
+                "variable_specifications.json"]
+
+    def setUp(self):
+        self.addCleanup(rate_table.invalidate)
+        self.addCleanup(rate_table_snapshots.clear)
+        rate_table_snapshots.clear()
+        self.start = timezone.now() - timedelta(days=30)
+
+    def test_interned_table(self):
+        table = RateTable({('CA', 'a'): 1.5, ('NY', 'b'): 2.0})
+        self.assertEqual(table.get('CA', 'a'), 1.5)
+        self.assertIs(type(table.get('CA', 'a')), float)
+        self.assertIn(('NY', 'b'), table)
+        self.assertNotIn(('CA', 'b'), table)
+        self.assertEqual(len(table), 2)
+        self.assertEqual(table.values, {('CA', 'a'): 1.5, ('NY', 'b'): 2.0})
+        with self.assertRaises(PolicyVariable.DoesNotExist):
+            table.get('CA', 'b')
+        self.assertEqual(table.version, RateTable(table.values).version)
+
+    def test_old_quotes_keep_their_rates(self):
+        quote = Quote.objects.get(pk=1)
+        Quote.objects.update(created_at=self.start + timedelta(days=1))
+        quote.refresh_from_db()
+        before = quote.rate
+        RateTableSnapshot.objects.publish(self.start)
+        PolicyVariable.objects.filter(scope='global', key=BASIC_POLICY_BASE_KEY).update(value=50)
+        rate_table.invalidate()
+        RateTableSnapshot.objects.publish(self.start + timedelta(days=2))
+
+        self.assertNotEqual(quote.rate, before)
+        self.assertEqual(quote.rate_as_of(), before)
+        self.assertEqual(quote.rate_as_of(self.start + timedelta(days=3)), quote.rate)
+        with self.assertRaises(RateTableSnapshot.DoesNotExist):
+            quote.rate_as_of(self.start - timedelta(seconds=1))
+
+        quotes = list(Quote.objects.order_by('pk'))
+        self.assertEqual(rate_many_as_of(quotes)[0], before)
+        self.assertEqual(rate_many_as_of(quotes, self.start + timedelta(days=3)),
+                         PolicyRater.rate_many(quotes))
+
+    def test_lookup_queries(self):
+        RateTableSnapshot.objects.publish(self.start)
+        RateTableSnapshot.objects.publish(self.start + timedelta(days=1))
+        rate_table_snapshots.clear()
+        # the index and then the snapshot itself
+        with self.assertNumQueries(2):
+            rate_table_snapshots.as_of(self.start + timedelta(hours=1))
+        with self.assertNumQueries(1):
+            rate_table_snapshots.as_of(self.start + timedelta(days=2))
+        with self.assertNumQueries(0):
+            table = rate_table_snapshots.as_of(self.start + timedelta(days=3))
+        self.assertEqual(table.version, rate_table.version)
+        self.assertEqual(rate_table_snapshots.loads, 2)
+
+    def test_publishing_swaps_the_index(self):
+        first = RateTableSnapshot.objects.publish(self.start)
+        self.assertEqual(rate_table_snapshots.snapshot_pk(timezone.now()), first.pk)
+        second = RateTableSnapshot.objects.publish(self.start + timedelta(days=1))
+        self.assertEqual(rate_table_snapshots.snapshot_pk(timezone.now()), second.pk)
+
+    def test_published_in_other_processes(self):
+        first = RateTableSnapshot.objects.publish(self.start)
+        stamp = rate_table_snapshots.shared().get(RATE_SNAPSHOT_STAMP_KEY)
+        self.assertEqual(rate_table_snapshots.snapshot_pk(timezone.now()), first.pk)
+        # another process publishing, without this one's signals
+        second = RateTableSnapshot.objects.bulk_create([RateTableSnapshot(
+            effective_at=self.start + timedelta(days=1), version=first.version, values=first.values)])[0]
+        self.assertEqual(rate_table_snapshots.snapshot_pk(timezone.now()), first.pk)
+        with self.settings(RATE_TABLE_CHECK_INTERVAL=0):
+            self.assertEqual(rate_table_snapshots.snapshot_pk(timezone.now()), first.pk)
+            # and replacing the stamp, like its publish does
+            rate_table_snapshots.shared().set(RATE_SNAPSHOT_STAMP_KEY, 'other process')
+            self.assertEqual(rate_table_snapshots.snapshot_pk(timezone.now()), second.pk)
+        RateTableSnapshot.objects.publish(self.start + timedelta(days=2))
+        self.assertNotEqual(rate_table_snapshots.shared().get(RATE_SNAPSHOT_STAMP_KEY), stamp)
+
+    def test_immutable(self):
+        snapshot = RateTableSnapshot.objects.publish(self.start)
+        snapshot.description = 'changed'
+        with self.assertRaises(ValueError):
+            snapshot.save()
+
+    def test_command(self):
+        out = StringIO()
+        call_command('publish_rates', '--effective-at', '2020-01-01T00:00:00', stdout=out)
+        self.assertIn(rate_table.version, out.getvalue())
+        with self.assertRaises(CommandError):
+            call_command('publish_rates', '--effective-at', '2020-01-01T00:00:00', stdout=out)
+        with self.assertRaises(CommandError):
+            call_command('publish_rates', '--effective-at', 'yesterday', stdout=out)
+
+
+class ConditionalGetTests(TestCase):
+    fixtures = ["customers.json",
+                "policy_variables.json",
+                "quote_variables.json",
+                "quotes.json",
+                "variable_specifications.json"]
+
+    def setUp(self):
+        self.addCleanup(rate_table.invalidate)
+        response_cache().clear()
+        Quote.objects.all().refresh_costs()
+        rate_table.table()
+
+    def test_not_modified(self):
+        response = self.client.get('/api/v1/quotes/1/')
+        etag = response['ETag']
+        self.assertTrue(etag.startswith('"'))
+        # the ETag covers more than updated_at, see api.caching
+        self.assertNotIn('Last-Modified', response)
+        with mock.patch.object(QuoteSerializer, 'to_representation') as serialize:
+            with self.assertNumQueries(1):
+                response = self.client.get('/api/v1/quotes/1/', HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response['ETag'], etag)
+            serialize.assert_not_called()
+
+    def test_representations_have_their_own_etags(self):
+        response = self.client.get('/api/v1/quotes/1/')
+        self.assertIn('Accept', response['Vary'])
+        indented = self.client.get('/api/v1/quotes/1/', HTTP_ACCEPT='application/json; indent=2',
+                                   HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(indented.status_code, 200)
+        self.assertNotEqual(indented['ETag'], response['ETag'])
+        self.assertIn('Accept', indented['Vary'])
+        response = self.client.get('/api/v1/quotes/1/', HTTP_ACCEPT='application/json; indent=2',
+                                   HTTP_IF_NONE_MATCH=indented['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_served_from_cache(self):
+        expected = self.client.get('/api/v1/quotes/2/').content
+        with mock.patch.object(QuoteSerializer, 'to_representation') as serialize:
+            with self.assertNumQueries(1):
+                response = self.client.get('/api/v1/quotes/2/')
+            serialize.assert_not_called()
+        self.assertEqual(response.content, expected)
+        self.assertEqual(response['Content-Type'], 'application/json')
+
+    def test_etag_changes(self):
+        def etag():
+            return self.client.get('/api/v1/quotes/1/')['ETag']
+
+        etags = [etag()]
+        var = QuoteVariable.objects.filter(quote_id=1).first()
+        var.notes = 'just a note'
+        var.save()
+        etags.append(etag())
+        var.delete()
+        etags.append(etag())
+        pv = PolicyVariable.objects.get(scope='global', key=BASIC_POLICY_BASE_KEY)
+        pv.value = 25
+        pv.save()
+        etags.append(etag())
+        Customer.objects.filter(pk=Quote.objects.get(pk=1).customer_id).update(name='Renamed')
+        etags.append(etag())
+        self.assertEqual(etags[0], etags[1])
+        self.assertEqual(len(set(etags)), 4)
+        self.assertEqual(self.client.get('/api/v1/quotes/1/').json()['customer_name'], 'Renamed')
+
+    def test_cost_change_moves_updated_at(self):
+        before = Quote.objects.get(pk=1).updated_at
+        QuoteVariable.objects.filter(quote_id=1).first().delete()
+        self.assertGreater(Quote.objects.get(pk=1).updated_at, before)
+        unchanged = Quote.objects.get(pk=4).updated_at
+        Quote.objects.all().refresh_costs()
+        self.assertEqual(Quote.objects.get(pk=4).updated_at, unchanged)
+
+    def test_list(self):
+        response = self.client.get('/api/v1/quotes/', {'page_size': 2})
+        etag = response['ETag']
+        response = self.client.get('/api/v1/quotes/', {'page_size': 2}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        # a different page is a different resource
+        response = self.client.get('/api/v1/quotes/', {'page_size': 3}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        Quote.objects.create(customer_id=1, state='NY', description='Quote 0')
+        response = self.client.get('/api/v1/quotes/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['results']), 5)
+
+    def test_missing_quote(self):
+        self.assertEqual(self.client.get('/api/v1/quotes/99/').status_code, 404)
+        self.assertEqual(self.client.get('/api/v1/quotes/abc/').status_code, 404)
+
+
+class LeanReadPathTests(TestCase):
+    fixtures = ["customers.json",
+                "policy_variables.json",
+                "quote_variables.json",
+                "quotes.json",
+                "variable_specifications.json"]
+
+    def setUp(self):
+        self.addCleanup(rate_table.invalidate)
+        response_cache().clear()
+        generate(40, seed=5)
+        # half the book with stored costs, half stale
+        Quote.objects.filter(pk__in=Quote.objects.order_by('pk').values('pk')[:22]).refresh_costs()
+        Customer.objects.filter(pk=1).update(name='Zoë "Ünïcode"   Smith')
+
+    def serialized(self, quotes):
+        return JSONRenderer().render(QuoteSerializer(quotes, many=True).data)
+
+    def test_matches_serializer(self):
+        quotes = Quote.objects.order_by('created_at', 'id')
+        self.assertTrue(Quote.objects.stale().exists())
+        self.assertEqual(render_quotes(quotes), self.serialized(quotes))
+
+    def test_list_matches_serializer(self):
+        with mock.patch.object(QuoteSerializer, 'to_representation') as serialize:
+            response = self.client.get('/api/v1/quotes/', {'page_size': 30})
+            serialize.assert_not_called()
+        page = Quote.objects.order_by('created_at', 'id')[:30]
+        body = json.loads(response.content)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertEqual(response.content, JSONRenderer().render(OrderedDict(
+            [('next', body['next']), ('previous', None),
+             ('results', QuoteSerializer(page, many=True).data)])))
+        response = self.client.get(body['next'])
+        self.assertEqual(json.loads(response.content)['results'],
+                         json.loads(self.serialized(Quote.objects.order_by('created_at', 'id')[30:])))
+
+    def test_detail_matches_serializer(self):
+        for quote in (Quote.objects.stale().first(), Quote.objects.exclude(
+                pk__in=Quote.objects.stale()).first()):
+            with mock.patch.object(QuoteSerializer, 'to_representation') as serialize:
+                response = self.client.get('/api/v1/quotes/{}/'.format(quote.pk))
+                serialize.assert_not_called()
+            self.assertEqual(response.content, JSONRenderer().render(QuoteSerializer(quote).data))
+
+    def test_stream_matches_serializer(self):
+        with mock.patch('api.views.STREAM_CHUNK_SIZE', 7):
+            response = self.client.get('/api/v1/quotes/', {'stream': '1'})
+            streamed = b''.join(response.streaming_content)
+        self.assertEqual(streamed, self.serialized(Quote.objects.order_by('created_at', 'id')))
+
+    def test_indented_json_uses_serializer(self):
+        with mock.patch.object(QuoteSerializer, 'to_representation',
+                               return_value={}) as serialize:
+            self.client.get('/api/v1/quotes/1/', HTTP_ACCEPT='application/json; indent=2')
+            serialize.assert_called()
+
+    def test_queries(self):
+        rows = quote_rows(Quote.objects.order_by('pk'))
+        with self.assertNumQueries(2):
+            costs = rate_rows(rows)
+        self.assertEqual(costs, rate_many(Quote.objects.order_by('pk')))
+        Quote.objects.stale().refresh_costs()
+        with self.assertNumQueries(1):
+            render_quotes(Quote.objects.all())
+
+
+class IngestCommandTests(TestCase):
+    fixtures = ["customers.json",
+                "policy_variables.json",
+                "quote_variables.json",
+                "quotes.json",
+                "variable_specifications.json"]
+
+    def setUp(self):
+        self.addCleanup(rate_table.invalidate)
+        Quote.objects.all().refresh_costs()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def ingest(self, model, name, content, *args):
+        path = os.path.join(self.tmp.name, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        out, err = StringIO(), StringIO()
+        call_command('ingest', model, path, *args, stdout=out, stderr=err)
+        return out.getvalue(), err.getvalue()
+
+    def assertCostsCurrent(self):
+        quotes = list(Quote.objects.order_by('pk'))
+        self.assertFalse(Quote.objects.stale().exists())
+        self.assertEqual([q.stored_cost for q in quotes], rate_many(quotes))
+        for quote in quotes:
+            self.assertEqual(set(quote.dependencies.values_list('scope', 'key')),
+                             quote_dependencies(quote))
+
+    def test_quotes_and_variables(self):
+        out, _ = self.ingest('quote', 'quotes.csv',
+                             'id,customer,description,state,coverage_type\n'
+                             ',1,New one,TX,premium\n'
+                             '1,1,Quote 1 moved,TX,basic\n')
+        self.assertIn('2 rows read, 2 written, 0 invalid', out)
+        self.assertIn('rows/s', out)
+        self.assertEqual(Quote.objects.count(), 5)
+        self.assertEqual(Quote.objects.get(pk=1).state, 'TX')
+        new = Quote.objects.get(description='New one')
+        out, _ = self.ingest('quote_variable', 'variables.ndjson',
+                             json.dumps({'quote': new.pk, 'spec': 'flood_addition_indicator'}) + '\n\n' +
+                             json.dumps({'quote': 1, 'spec': 'flood_addition_indicator',
+                                         'notes': 'upserted'}) + '\n')
+        self.assertIn('2 written', out)
+        self.assertEqual(QuoteVariable.objects.get(quote_id=1, spec_id='flood_addition_indicator').notes,
+                         'upserted')
+        self.assertCostsCurrent()
+
+    def test_invalid_rows(self):
+        content = ('quote,spec,value\n'
+                   '1,no_such_spec,\n'
+                   '99,flood_addition_indicator,\n'
+                   '2,flood_addition_indicator,abc\n'
+                   '2,flood_addition_indicator,1,extra\n'
+                   '3,flood_addition_indicator,\n')
+        with self.assertRaises(CommandError):
+            self.ingest('quote_variable', 'variables.csv', content)
+        self.assertFalse(QuoteVariable.objects.filter(quote_id=3, spec_id='flood_addition_indicator').exists())
+        out, err = self.ingest('quote_variable', 'variables.csv', content, '--max-errors', '4')
+        self.assertIn('5 rows read, 1 written, 4 invalid', out)
+        self.assertEqual([line.split(':')[0] for line in err.splitlines()],
+                         ['line 2', 'line 3', 'line 4', 'line 5'])
+        self.assertIn('no_such_spec does not exist', err)
+        self.assertIn('quote 99 does not exist', err)
+        self.assertIn('value:', err)
+        self.assertCostsCurrent()
+        with self.assertRaises(CommandError):
+            self.ingest('quote', 'quotes.csv', 'customer,state\n1,ZZ\n')
+
+    def test_defer_costs(self):
+        out, _ = self.ingest('quote_variable', 'variables.csv',
+                             'quote,spec\n2,flood_addition_indicator\n3,flood_addition_indicator\n',
+                             '--defer-costs', '--batch-size', '1')
+        self.assertIn('2 quotes have stale costs', out)
+        self.assertEqual(set(Quote.objects.stale().values_list('pk', flat=True)), {2, 3})
+        Quote.objects.stale().refresh_costs()
+        self.assertCostsCurrent()
+
+    def test_rate_table(self):
+        ca_tax = PolicyVariable.objects.get(scope='CA', key=STATE_TAX_RATE_KEY)
+        out, _ = self.ingest('policy_variable', 'rates.ndjson',
+                             json.dumps({'scope': 'CA', 'key': STATE_TAX_RATE_KEY, 'value': 3.5}) + '\n' +
+                             json.dumps({'scope': 'NY', 'key': 'new_rate', 'value': 1}) + '\n')
+        self.assertIn('re-rated 2 quotes', out)
+        ca_tax.refresh_from_db()
+        self.assertEqual(ca_tax.value, 3.5)
+        self.assertEqual(rate_table.table().get('NY', 'new_rate'), 1.0)
+        self.assertCostsCurrent()
+        out, _ = self.ingest('policy_variable', 'rates.csv',
+                             'scope,key,value\nCA,state_tax_rate,1.0\n', '--defer-costs')
+        self.assertIn('2 quotes have stale costs', out)
+        self.assertEqual(Quote.objects.stale().count(), 2)
+
+    def test_specifications(self):
+        out, _ = self.ingest('variable_specification', 'specs.csv',
+                             'code,type,application,priority\n'
+                             'flood_addition_indicator,state_lookup,additive,10\n'
+                             'brand_new,simple,bogus,1\n', '--max-errors', '1')
+        self.assertIn('1 written, 1 invalid', out)
+        self.assertEqual(VariableSpecification.objects.get(pk='flood_addition_indicator').application,
+                         'additive')
+        self.assertNotEqual(VariableSpecification.objects.get(pk='flood_addition_indicator').description, '')
+        self.assertCostsCurrent()
+
+
+class ExportTests(TestCase):
+    fixtures = ["customers.json",
+                "policy_variables.json",
+                "quote_variables.json",
+                "quotes.json",
+                "variable_specifications.json"]
+
+    def setUp(self):
+        self.addCleanup(rate_table.invalidate)
+        generate(30, seed=7)
+        # some stored, some stale
+        Quote.objects.filter(pk__lte=12).refresh_costs()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def export(self, *args):
+        err = StringIO()
+        call_command('export_quotes', *args, stdout=StringIO(), stderr=err)
+        return err.getvalue()
+
+    def expected(self, quotes):
+        return {q.pk: list(rate_many([q])[0]) for q in quotes}
+
+    def test_csv(self):
+        path = os.path.join(self.tmp.name, 'quotes.csv')
+        err = self.export(path, '--chunk-size', '7')
+        self.assertIn('exported 34 quotes', err)
+        with open(path, newline='') as f:
+            rows = list(csv.DictReader(f))
+        quotes = Quote.objects.order_by('pk')
+        self.assertEqual([int(r['id']) for r in rows], [q.pk for q in quotes])
+        self.assertEqual({int(r['id']): [float(r[c]) for c in ('subtotal', 'taxes', 'total')]
+                          for r in rows}, self.expected(quotes))
+        self.assertEqual(rows[0]['customer_name'], quotes[0].customer.name)
+
+    def test_ndjson_filters(self):
+        path = os.path.join(self.tmp.name, 'quotes.ndjson')
+        Quote.objects.filter(pk__in=[1, 2]).update(created_at=timezone.now() - timedelta(days=10))
+        since = (timezone.now() - timedelta(days=5)).date().isoformat()
+        self.export(path, '--format', 'ndjson', '--state', 'CA', '--state', 'TX',
+                    '--coverage-type', 'basic', '--created-after', since)
+        with open(path) as f:
+            rows = [json.loads(line) for line in f]
+        quotes = Quote.objects.filter(state__in=['CA', 'TX'], coverage_type='basic',
+                                      created_at__gte=parse_when(since)).order_by('pk')
+        self.assertTrue(rows)
+        self.assertEqual([r['id'] for r in rows], [q.pk for q in quotes])
+        self.assertNotIn(2, [r['id'] for r in rows])
+        self.assertEqual({r['id']: [r['subtotal'], r['taxes'], r['total']] for r in rows},
+                         self.expected(quotes))
+        with self.assertRaises(CommandError):
+            self.export(path, '--created-before', 'yesterday')
+
+    def test_npy(self):
+        directory = os.path.join(self.tmp.name, 'quotes')
+        self.export(directory, '--format', 'npy', '--chunk-size', '5')
+        with open(os.path.join(directory, 'manifest.json')) as f:
+            manifest = json.load(f)
+        self.assertEqual(manifest['rows'], 34)
+        self.assertEqual(manifest['rate_version'], rate_table.version)
+        columns = {c['name']: np.load(os.path.join(directory, c['file']), mmap_mode='r')
+                   for c in manifest['columns']}
+        quotes = list(Quote.objects.order_by('pk'))
+        self.assertEqual(columns['id'].tolist(), [q.pk for q in quotes])
+        self.assertEqual(columns['state'].tolist(), [q.state for q in quotes])
+        expected = self.expected(quotes)
+        self.assertEqual(np.column_stack([columns[c] for c in ('subtotal', 'taxes', 'total')]).tolist(),
+                         [expected[q.pk] for q in quotes])
+        self.assertEqual(columns['created_at'][0].astype(object),
+                         quotes[0].created_at.replace(tzinfo=None))
+
+    def test_unratable_quotes_have_no_costs(self):
+        PolicyVariable.objects.filter(key='pet_premium_addition').delete()
+        response = self.client.get('/api/v1/quotes/export/', {'type': 'ndjson'})
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual(len(rows), 34)
+        self.assertIsNone(next(r for r in rows if r['id'] == 3)['total'])
+
+    def test_endpoint(self):
+        response = self.client.get('/api/v1/quotes/export/', {'state': 'NY'})
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        rows = list(csv.DictReader(StringIO(b''.join(response.streaming_content).decode())))
+        self.assertEqual([int(r['id']) for r in rows],
+                         list(Quote.objects.filter(state='NY').order_by('pk').values_list('pk', flat=True)))
+        self.assertEqual(self.client.get('/api/v1/quotes/export/', {'state': 'ZZ'}).status_code, 400)
+        self.assertEqual(self.client.get('/api/v1/quotes/export/',
+                                         {'created_before': 'soon'}).status_code, 400)
+
+
+class AdminTests(TestCase):
+    fixtures = ["customers.json",
+                "policy_variables.json",
+                "quote_variables.json",
+                "quotes.json",
+                "variable_specifications.json"]
+
+    def setUp(self):
+        self.addCleanup(rate_table.invalidate)
+        user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(user)
+
+    def changelist_queries(self, url):
+        with CaptureQueriesContext(connection) as captured:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(captured)
+
+    def test_changelist_queries_dont_grow_with_the_page(self):
+        generate(5, seed=1)
+        small = {url: self.changelist_queries(url)
+                 for url in ('/admin/api/quote/', '/admin/api/quotevariable/', '/admin/api/customer/')}
+        generate(80, seed=2)
+        for url, queries in small.items():
+            self.assertEqual(self.changelist_queries(url), queries, url)
+        response = self.client.get('/admin/api/quote/', {'state__exact': 'CA'})
+        self.assertContains(response, '>{:.2f}<'.format(
+            Quote.objects.filter(state='CA').order_by('-id').first().rate.total))
+        self.assertTrue(Quote.objects.stale().exists())
+
+    def test_unratable_quotes_on_the_page(self):
+        generate(20, seed=1)
+        queries = self.changelist_queries('/admin/api/quote/')
+        PolicyVariable.objects.get(scope='global', key='pet_premium_addition').delete()
+        rate_table.invalidate()
+        self.assertEqual(self.changelist_queries('/admin/api/quote/'), queries)
+        response = self.client.get('/admin/api/quote/')
+        self.assertContains(response, 'PolicyVariable global/pet_premium_addition does not exist.',
+                            count=Quote.objects.filter(
+                                variables__spec='pet_ownership_indicator').distinct().count())
+        self.assertContains(response, '>{:.2f}<'.format(Quote.objects.get(pk=4).rate.total))
+
+    def test_estimated_count(self):
+        generate(60, seed=1)
+        with mock.patch('api.admin.COUNT_LIMIT', 10):
+            with mock.patch('api.admin.estimated_rows', return_value=5000):
+                response = self.client.get('/admin/api/quote/')
+                self.assertContains(response, '5000 quotes')
+                response = self.client.get('/admin/api/quote/', {'state__exact': 'CA'})
+                # a filtered list is only counted up to the limit
+                self.assertGreater(Quote.objects.filter(state='CA').count(), 11)
+                self.assertContains(response, '11 results')
+
+    def test_inline_variables_saved_in_bulk(self):
+        quote = Quote.objects.get(pk=3)
+        existing = QuoteVariable.objects.get(quote=quote, spec='pet_ownership_indicator')
+        data = {
+            'customer': quote.customer_id, 'description': 'Quote 3', 'state': quote.state,
+            'coverage_type': quote.coverage_type,
+            'variables-TOTAL_FORMS': '2', 'variables-INITIAL_FORMS': '1',
+            'variables-MIN_NUM_FORMS': '0', 'variables-MAX_NUM_FORMS': '1000',
+            'variables-0-id': existing.pk, 'variables-0-quote': quote.pk,
+            'variables-0-spec': 'pet_ownership_indicator', 'variables-0-notes': 'Now has pugs',
+            'variables-0-value': '',
+            'variables-1-id': '', 'variables-1-quote': quote.pk,
+            'variables-1-spec': 'flood_addition_indicator', 'variables-1-notes': '',
+            'variables-1-value': '',
+        }
+        with mock.patch('api.signals.refresh_costs', side_effect=refresh_costs) as refresh:
+            response = self.client.post('/admin/api/quote/3/change/', data)
+        self.assertEqual(response.status_code, 302)
+        # once for the quote itself, once for its variables
+        self.assertEqual(refresh.call_count, 2)
+        self.assertEqual(QuoteVariable.objects.get(pk=existing.pk).notes, 'Now has pugs')
+        quote = Quote.objects.get(pk=3)
+        self.assertEqual(quote.variables.count(), 2)
+        self.assertEqual(quote.stored_cost, rate_many([quote])[0])
+
+
+@override_settings(RATING_ARITHMETIC="fixed")
+class FixedPointScenarioTests(CannedScenarioTests):
+    def setUp(self):
+        plan_cache.clear()
+
+    def test_rate_many(self):
+        rates = PolicyRater.rate_many(Quote.objects.order_by('pk'))
+        self.assertEqual(rates, [RatingResult(40.8, .40, 41.2), RatingResult(61.2, .61, 61.81),
+                                 RatingResult(60.0, 1.20, 61.20), RatingResult(30.0, .15, 30.15)])
+
+
+class FixedPointTests(TestCase):
+    states = ['NY', 'CA', 'TX']
+
+    def setUp(self):
+        plan_cache.clear()
+        self.addCleanup(plan_cache.clear)
+
+    def random_book(self, rng: random.Random, size: int):
+        # a rate table and (state, coverage type, signature, values) quotes
+        # against it, without the database
+        values = {(GLOBAL_SCOPE, BASIC_POLICY_BASE_KEY): round(rng.uniform(10, 500), 2),
+                  (GLOBAL_SCOPE, PREMIUM_POLICY_BASE_KEY): round(rng.uniform(10, 500), 2)}
+        specs = []
+        for i in range(10):
+            type = rng.choice(['simple', 'state_lookup', 'global_lookup', 'bogus'])
+            application = rng.choice(['additive', 'multiplier'])
+            key = 'rate_{}'.format(i)
+            for scope in ([GLOBAL_SCOPE] if type == 'global_lookup' else self.states):
+                values[(scope, key)] = round(rng.uniform(0, 30) if application == 'multiplier'
+                                             else rng.uniform(-5, 80), 2)
+            specs.append(('spec_{}'.format(i), rng.randint(1, 300), type, application, key))
+        for state in self.states:
+            values[(state, STATE_TAX_RATE_KEY)] = round(rng.uniform(0, 10), 2)
+        quotes = []
+        for _ in range(size):
+            signature = tuple(sorted(rng.sample(specs, rng.randint(0, 6)), key=lambda s: s[1]))
+            quotes.append((rng.choice(self.states), rng.choice(['basic', 'premium']), signature,
+                           [rng.choice([None, round(rng.uniform(-20, 120), 2)]) for _ in signature]))
+        return RateTable(values), quotes
+
+    def exact_rate(self, table: RateTable, state, coverage_type, signature, values):
+        # the float core's arithmetic on exact fractions, (subtotal, tax)
+        def get(scope, key):
+            return Fraction(repr(table.get(scope, key)))
+        sub = get(GLOBAL_SCOPE, base_rate_key(coverage_type))
+        for (code, priority, type, application, key), value in zip(signature, values):
+            if type == 'simple':
+                value = None if value is None else Fraction(repr(value))
+            elif type in ('state_lookup', 'global_lookup'):
+                value = get(state if type == 'state_lookup' else GLOBAL_SCOPE, key)
+            else:
+                value = Fraction(100)
+                application = 'multiplier'
+            if value is None:
+                sub += sub
+            elif application == 'multiplier':
+                sub += sub * value / 100
+            else:
+                sub += value
+        return sub, sub * get(state, STATE_TAX_RATE_KEY) / 100
+
+    def test_conversions(self):
+        # decimal values, not the binary ones
+        self.assertEqual(fixed_point.amount(2.675), 2675000)
+        self.assertEqual(fixed_point.amount(0.1), 100000)
+        self.assertEqual(fixed_point.basis_points(9.75), 975)
+        self.assertEqual(fixed_point.basis_points(0.125), 12)
+        self.assertEqual(fixed_point.basis_points(0.135), 14)
+        self.assertEqual([fixed_point.div_round(n, 10) for n in (14, 15, 25, 26, -15, -16)],
+                         [1, 2, 2, 3, -2, -2])
+        n = np.array([14, 15, 25, 26, -15, -16], dtype=np.int64)
+        self.assertEqual(fixed_point.div_round_array(n, 10).tolist(), [1, 2, 2, 3, -2, -2])
+
+    def test_float_boundaries(self):
+        # 2.5% of 2.80 is 0.07, which floats put just under it
+        table = RateTable({(GLOBAL_SCOPE, BASIC_POLICY_BASE_KEY): 2.8,
+                           (GLOBAL_SCOPE, PREMIUM_POLICY_BASE_KEY): 2.675,
+                           ('NY', STATE_TAX_RATE_KEY): 2.5})
+        self.assertEqual(RatingPlan(table, 'basic', ()).rate('NY', []),
+                         RatingResult(2.8, .06, 2.86))
+        self.assertEqual(FixedPointPlan(table, 'basic', ()).rate('NY', []),
+                         RatingResult(2.8, .07, 2.87))
+        # half a cent rounds to even
+        self.assertEqual(RatingPlan(table, 'premium', ()).rate('NY', []).subtotal, 2.67)
+        self.assertEqual(FixedPointPlan(table, 'premium', ()).rate('NY', []).subtotal, 2.68)
+
+    def test_batch_matches_plans(self):
+        table, quotes = self.random_book(random.Random(19), 500)
+        batch = QuoteBatch()
+        for quote in quotes:
+            batch.add(*quote)
+        with override_settings(RATING_ARITHMETIC="fixed"), self.assertLogs(level='WARNING'):
+            expected = [plan_cache.plan_for(table, coverage_type, signature).rate(state, values)
+                        for state, coverage_type, signature, values in quotes]
+            self.assertEqual(batch.rate(table), expected)
+            # the same batch against another table
+            other = RateTable({**table.values, ('NY', STATE_TAX_RATE_KEY): 7.0})
+            self.assertEqual(batch.rate(other)[:50],
+                             [plan_cache.plan_for(other, c, sig).rate(s, v)
+                              for s, c, sig, v in quotes[:50]])
+        self.assertIsInstance(plan_cache.plan_for(table, 'basic', ()), RatingPlan)
+        self.assertNotIsInstance(plan_cache.plan_for(table, 'basic', ()), FixedPointPlan)
+
+    def test_equivalent_to_float_path(self):
+        # the two cores only disagree where the exact result is on (or a
+        # rounding error away from) a cent, or half of one for subtotals
+        def near(amount, step):
+            return abs(amount * 100 - round(amount * 100 / step) * step) < Fraction(1, 100)
+
+        rng = random.Random(20)
+        differences = 0
+        for _ in range(4):
+            table, quotes = self.random_book(rng, 500)
+            batch = QuoteBatch()
+            for quote in quotes:
+                batch.add(*quote)
+            with self.assertLogs(level='WARNING'):
+                floats = batch.rate(table)
+                with override_settings(RATING_ARITHMETIC="fixed"):
+                    fixed = batch.rate(table)
+            for quote, float_rate, fixed_rate in zip(quotes, floats, fixed):
+                if float_rate == fixed_rate:
+                    continue
+                differences += 1
+                sub, tax = self.exact_rate(table, *quote)
+                for a, b in zip(float_rate, fixed_rate):
+                    self.assertAlmostEqual(a, b, delta=.0101)
+                if float_rate.subtotal != fixed_rate.subtotal:
+                    self.assertTrue(near(sub, Fraction(1, 2)), quote)
+                if float_rate.taxes != fixed_rate.taxes:
+                    self.assertTrue(near(tax, 1), quote)
+                if float_rate.total != fixed_rate.total:
+                    exact_subtotal = Fraction(repr(fixed_rate.subtotal))
+                    self.assertTrue(near(exact_subtotal + tax, 1)
+                                    or float_rate.subtotal != fixed_rate.subtotal, quote)
+        self.assertLess(differences, 2000 * .05)
+
+    def test_missing_rates(self):
+        table = RateTable({(GLOBAL_SCOPE, BASIC_POLICY_BASE_KEY): 20.0,
+                           ('NY', STATE_TAX_RATE_KEY): 1.0,
+                           ('CA', STATE_TAX_RATE_KEY): 2.0,
+                           ('NY', 'flood'): 10.0})
+        flood = ('flood', 10, 'state_lookup', 'multiplier', 'flood')
+        batch = QuoteBatch()
+        for i in range(40):
+            batch.add(['NY', 'CA', 'TX'][i % 3], 'basic', (flood,) if i % 2 else (), [None] if i % 2 else [])
+        with override_settings(RATING_ARITHMETIC="fixed"):
+            with self.assertRaises(PolicyVariable.DoesNotExist):
+                batch.rate(table)
+            subtotals, taxes, totals = batch.rate_arrays(table, strict=False)
+        # CA has no flood rate and TX no tax rate
+        self.assertEqual(subtotals[[0, 3, 4]].tolist(), [20.0, 22.0, 20.0])
+        self.assertEqual(totals[[0, 3, 4]].tolist(), [20.2, 22.22, 20.4])
+        self.assertTrue(np.isnan(subtotals[[1, 2, 5]]).all())
+        self.assertTrue(np.isnan(taxes[[1, 2, 5]]).all())
+
+    def test_overflow_falls_back_to_python_ints(self):
+        table = RateTable({(GLOBAL_SCOPE, BASIC_POLICY_BASE_KEY): 9e12,
+                           ('NY', STATE_TAX_RATE_KEY): 1.0})
+        pugs = ('pugs', 10, 'simple', 'multiplier', None)
+        batch = QuoteBatch()
+        for _ in range(20):
+            batch.add('NY', 'basic', (pugs,), [50.0])
+        with override_settings(RATING_ARITHMETIC="fixed"):
+            rates = batch.rate(table)
+        self.assertEqual(rates[0], RatingResult(1.35e13, 1.35e11, 1.3635e13))
+
+    @override_settings(RATING_ARITHMETIC="decimal")
+    def test_unknown_arithmetic(self):
+        with self.assertRaises(ImproperlyConfigured):
+            plan_cache.plan_for(RateTable({}), 'basic', ())
+
+
+class FormulaTests(TestCase):
+    fixtures = ["customers.json",
+                "policy_variables.json",
+                "quote_variables.json",
+                "quotes.json",
+                "variable_specifications.json"]
+
+    def setUp(self):
+        plan_cache.clear()
+        self.addCleanup(rate_table.invalidate)
+
+    def add_surcharge(self, formula: str, quotes=(1, 2, 3, 4)) -> VariableSpecification:
+        spec = VariableSpecification.objects.create(
+            code='surcharge', type=VARIABLE_TYPE_FORMULA,
+            application=VARIABLE_APPLICATION_ADDITIVE,
+            description='', priority=150, formula=formula)
+        for pk in quotes:
+            QuoteVariable.objects.create(quote_id=pk, spec=spec)
+        return spec
+
+    def test_rejects_anything_else(self):
+        for text in ['__import__("os")', 'subtotal.real', '(lambda: 1)()', 'open("x")',
+                     'x[0]', '2 ** 3', 'state + 1', 'state < "CA"', '1 if state else 2',
+                     'subtotal > 1', 'global_rate(key)', 'min(1)', 'a; b', 'x' * 1001,
+                     '1' + '0' * 400]:
+            with self.assertRaises(FormulaError, msg=text):
+                Formula(text)
+        spec = VariableSpecification(code='bad', type=VARIABLE_TYPE_FORMULA,
+                                     application=VARIABLE_APPLICATION_ADDITIVE,
+                                     description='x', formula='subtotal.__class__')
+        with self.assertRaises(ValidationError):
+            spec.full_clean()
+        spec.formula = ''
+        with self.assertRaises(ValidationError):
+            spec.full_clean()
+
+    def test_evaluates_scalars_and_arrays(self):
+        formula = Formula('state_rate("flood") * 2 + pugs / value '
+                          'if state in ("CA", "NY") and not coverage_type == "basic" else min(1, pugs)')
+        self.assertEqual(formula.names, {'pugs'})
+        self.assertEqual(formula.rates, {('state', 'flood')})
+        self.assertEqual(formula.evaluate(10.0, 2.0, 'CA', 'premium', {'pugs': 3.0},
+                                          {('state', 'flood'): 1.5}), 4.5)
+        # missing values are 0, and so is anything / 0
+        self.assertEqual(formula.evaluate(10.0, None, 'CA', 'premium', {},
+                                          {('state', 'flood'): 1.5}), 3.0)
+        result = formula.evaluate(np.array([1.0, 2.0, 3.0]), np.array([2.0, np.nan, 1.0]),
+                                  np.array(['CA', 'TX', 'NY']), np.array(['premium', 'premium', 'basic']),
+                                  {'pugs': np.array([4.0, np.nan, 5.0])},
+                                  {('state', 'flood'): np.array([1.5, 2.0, 3.0])})
+        self.assertEqual(result.tolist(), [5.0, 0.0, 1.0])
+
+    def test_tiered_surcharge(self):
+        self.add_surcharge('state_rate("flood_coverage_multiplier") * 2 if subtotal > 50 '
+                           'else 5 + pet_ownership_indicator')
+        expected = [RatingResult(45.8, .45, 46.25), RatingResult(65.2, .65, 65.85),
+                    RatingResult(80.0, 1.6, 81.59), RatingResult(35.0, .17, 35.17)]
+        quotes = list(Quote.objects.order_by('pk'))
+        self.assertEqual([q.rate for q in quotes], expected)
+        self.assertEqual(rate_many(quotes), expected)
+        # the stored costs were refreshed when the variables were added
+        self.assertEqual([q.stored_cost for q in quotes], expected)
+        self.assertIn(('NY', 'flood_coverage_multiplier'), quote_dependencies(quotes[2]))
+
+        # and follow the rates the formula reads
+        PolicyVariable.objects.filter(scope='NY', key='flood_coverage_multiplier').update(value=5.0)
+        rate_table.invalidate()
+        PolicyVariable.objects.get(scope='NY', key='flood_coverage_multiplier').save()
+        self.assertEqual(Quote.objects.get(pk=3).stored_cost, RatingResult(70.0, 1.4, 71.4))
+
+    def test_compiled_once_per_version(self):
+        spec = self.add_surcharge('10')
+        formula = formula_cache.get('surcharge', '10')
+        self.assertIs(formula_cache.get('surcharge', '10'), formula)
+        self.assertEqual(Quote.objects.get(pk=3).rate.subtotal, 70.0)
+        spec.formula = '20'
+        spec.save()
+        self.assertIsNot(formula_cache.get('surcharge', '20'), formula)
+        self.assertEqual(Quote.objects.get(pk=3).rate.subtotal, 80.0)
+        self.assertEqual(Quote.objects.get(pk=3).stored_cost.subtotal, 80.0)
+
+    def test_batch_matches_plans(self):
+        rng = random.Random(20)
+        table = RateTable({**rate_table.table().values,
+                           ('NY', 'tier'): 100.0, ('CA', 'tier'): 30.0, ('TX', 'tier'): 55.5,
+                           (GLOBAL_SCOPE, 'cap'): 12.0})
+        pugs = ('pugs', 5, 'simple', 'multiplier', None, None)
+        formulas = [
+            ('tiered', 20, 'formula', 'additive', None,
+             'global_rate("cap") if subtotal > state_rate("tier") else subtotal / 10'),
+            ('per_pug', 30, 'formula', 'multiplier', None,
+             'min(pugs * value, 40) if coverage_type == "premium" or state != "TX" else -pugs'),
+            ('after', 50, 'formula', 'additive', None, 'max(value, tiered, 1.5)'),
+        ]
+        batch = QuoteBatch()
+        quotes = []
+        for _ in range(300):
+            signature = tuple(sorted(rng.sample([pugs, *formulas], rng.randint(0, 4)),
+                                     key=lambda s: s[1]))
+            quote = (rng.choice(['NY', 'CA', 'TX']), rng.choice(['basic', 'premium']), signature,
+                     [rng.choice([None, round(rng.uniform(0, 20), 2)]) for _ in signature])
+            quotes.append(quote)
+            batch.add(*quote)
+        for arithmetic in ('float', 'fixed'):
+            with override_settings(RATING_ARITHMETIC=arithmetic):
+                expected = [plan_cache.plan_for(table, c, sig).rate(s, v) for s, c, sig, v in quotes]
+                self.assertEqual(batch.rate(table), expected)
+
+    def test_missing_rates(self):
+        PolicyVariable.objects.create(scope='CA', key='tier', value=3.0)
+        self.add_surcharge('state_rate("tier")', quotes=[1])
+        self.assertEqual(Quote.objects.get(pk=1).rate.subtotal, 43.8)
+        table = rate_table.table()
+        spec = ('surcharge', 150, 'formula', 'additive', None, 'state_rate("tier")')
+        with self.assertRaises(PolicyVariable.DoesNotExist):
+            plan_cache.plan_for(table, 'basic', (spec,)).rate('NY', [None])
+        batch = QuoteBatch()
+        for i in range(20):
+            batch.add(['CA', 'NY'][i % 2], 'basic', (spec,), [None])
+        subtotals, _, _ = batch.rate_arrays(table, strict=False)
+        self.assertEqual(subtotals[0], 23.0)
+        self.assertTrue(np.isnan(subtotals[1]))
+        with self.assertRaises(PolicyVariable.DoesNotExist):
+            batch.rate(table)
+
+    def test_broken_stored_formula(self):
+        self.add_surcharge('10', quotes=[1])
+        # update() skips validate_formula
+        VariableSpecification.objects.filter(code='surcharge').update(formula='10 +')
+        plan_cache.clear()
+        quotes = list(Quote.objects.order_by('pk'))
+        costs = rate_many(quotes, strict=False)
+        self.assertTrue(math.isnan(costs[0].total))
+        self.assertFalse(any(math.isnan(cost.total) for cost in costs[1:]))
+        with self.assertRaises(FormulaError):
+            rate_many(quotes)
+        refresh_costs(quotes, strict=False)
+        self.assertEqual(set(Quote.objects.stale().values_list('pk', flat=True)), {1})
+
+        table = rate_table.table()
+        spec = spec_signature(VariableSpecification.objects.get(code='surcharge'))
+        batch = QuoteBatch()
+        for i in range(20):
+            batch.add('CA', 'basic', (spec,) if i % 2 else (), [None] if i % 2 else [])
+        for arithmetic in ('float', 'fixed'):
+            with override_settings(RATING_ARITHMETIC=arithmetic):
+                subtotals, _, _ = batch.rate_shapes(table, False)
+                self.assertTrue(np.isnan(subtotals[1::2]).all())
+                self.assertFalse(np.isnan(subtotals[::2]).any())
+                with self.assertRaises(FormulaError):
+                    batch.rate_shapes(table, True)
+
+
+class BulkCreateTests(TestCase):
+    fixtures = ["customers.json",
+                "policy_variables.json",
+                "quote_variables.json",
+                "quotes.json",
+                "variable_specifications.json"]
+
+    def setUp(self):
+        response_cache().clear()
+
+    def post(self, data):
+        return self.client.post('/api/v1/quotes/bulk/', data, content_type='application/json')
+
+    def test_creates_rated_quotes(self):
+        response = self.post({'quotes': [
+            {'customer': 1, 'state': 'CA', 'description': 'Bulk 1',
+             'variables': [{'code': 'flood_addition_indicator'},
+                           {'code': 'pet_ownership_indicator', 'notes': 'Two cats'}]},
+            {'customer': 2, 'state': 'TX', 'coverage_type': 'premium'},
+        ]})
+        self.assertEqual(response.status_code, 201)
+        results = response.json()['results']
+        self.assertEqual([r['cost'] for r in results],
+                         [dict(subtotal=40.8, taxes=.40, total=41.2),
+                          dict(subtotal=40.0, taxes=.20, total=40.2)])
+        quotes = list(Quote.objects.filter(pk__in=[r['id'] for r in results]).order_by('pk'))
+        self.assertEqual([q.description for q in quotes], ['Bulk 1', None])
+        # the costs are stored, current and indexed
+        self.assertEqual([q.stored_cost for q in quotes], [q.rate for q in quotes])
+        self.assertEqual(quotes[0].variables.get(spec='pet_ownership_indicator').notes, 'Two cats')
+        for quote in quotes:
+            self.assertEqual(set(quote.dependencies.values_list('scope', 'key')),
+                             quote_dependencies(quote))
+
+    def test_queries_dont_grow_with_the_quotes(self):
+        rate_table.table()
+        data = [{'customer': 1 + i % 3, 'state': 'NY',
+                 'variables': [{'code': 'pet_ownership_indicator'}]} for i in range(50)]
+        # customers, specs, then the quotes, variables and dependency rows in
+        # a savepoint
+        with self.assertNumQueries(7):
+            response = self.post(data)
+        self.assertEqual(len(response.json()['results']), 50)
+        self.assertEqual(Quote.objects.stale().filter(
+            pk__in=[r['id'] for r in response.json()['results']]).count(), 0)
+
+    def test_nothing_is_written_with_errors(self):
+        counts = (Quote.objects.count(), QuoteVariable.objects.count())
+        response = self.post([{'customer': 1, 'state': 'CA'}, {'customer': 1, 'state': 'ZZ'}])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([e['index'] for e in response.json()['errors']], [1])
+        response = self.post([{'customer': 99, 'state': 'CA'},
+                              {'customer': 1, 'state': 'CA', 'variables': [{'code': 'nope'}]},
+                              {'customer': 1, 'state': 'CA'}])
+        self.assertEqual(response.json()['errors'], [
+            {'index': 0, 'errors': {'customer': ['Customer 99 does not exist.']}},
+            {'index': 1, 'errors': {'variables': ['Unknown variable specification nope.']}}])
+
+        PolicyVariable.objects.filter(scope='NY', key='flood_coverage_multiplier').delete()
+        self.addCleanup(rate_table.invalidate)
+        response = self.post([{'customer': 1, 'state': 'NY',
+                               'variables': [{'code': 'flood_addition_indicator'}]}])
+        self.assertEqual(response.json()['errors'], [{'index': 0, 'errors': {
+            'non_field_errors': ['PolicyVariable NY/flood_coverage_multiplier does not exist.']}}])
+        self.assertEqual((Quote.objects.count(), QuoteVariable.objects.count()), counts)
+
+    def test_limit(self):
+        with mock.patch('api.views.MAX_BULK_QUOTES', 2):
+            response = self.post([{'customer': 1, 'state': 'CA'}] * 3)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.post({'quotes': 'x'}).status_code, 400)
+
+
+class QuoteFilterTests(TestCase):
+    fixtures = ["customers.json",
+                "policy_variables.json",
+                "quote_variables.json",
+                "quotes.json",
+                "variable_specifications.json"]
+
+    def setUp(self):
+        response_cache().clear()
+
+    def descriptions(self, **params):
+        response = self.client.get('/api/v1/quotes/', params)
+        self.assertEqual(response.status_code, 200)
+        return [q['description'] for q in response.json()['results']]
+
+    def test_filters(self):
+        self.assertEqual(self.descriptions(state='CA'), ['Quote 1', 'Quote 2'])
+        self.assertEqual(self.descriptions(state=['NY', 'TX']), ['Quote 3', 'Quote 4'])
+        self.assertEqual(self.descriptions(state='CA', coverage_type='premium'), ['Quote 2'])
+        self.assertEqual(self.descriptions(customer=3), ['Quote 2', 'Quote 3'])
+        self.assertEqual(self.descriptions(customer=[2, 4]), ['Quote 1', 'Quote 4'])
+        self.assertEqual(self.descriptions(created_after='2023-01-29T01:37:27.012Z',
+                                           created_before='2023-01-29T01:40:00Z'),
+                         ['Quote 2', 'Quote 3'])
+        self.assertEqual(self.descriptions(created_before='2023-01-28'), [])
+        self.assertEqual(self.descriptions(created_before='2023-01-29'),
+                         ['Quote 1', 'Quote 2', 'Quote 3', 'Quote 4'])
+        self.assertEqual(self.descriptions(updated_after='2023-01-29T23:09:00Z'),
+                         ['Quote 3', 'Quote 4'])
+        self.assertEqual(self.descriptions(updated_before='2023-01-29T23:09:00Z'),
+                         ['Quote 1', 'Quote 2'])
+
+    def test_customer_name_prefix(self):
+        self.assertEqual(self.descriptions(customer_name='kev'), ['Quote 2', 'Quote 3'])
+        self.assertEqual(self.descriptions(customer_name='IRWIN F'), ['Quote 1'])
+        self.assertEqual(self.descriptions(customer_name='Flynn'), [])
+        Customer.objects.create(name='Kevin')
+        Quote.objects.create(customer=Customer.objects.get(name='Kevin'), state='TX',
+                             description='Quote 5')
+        self.assertEqual(self.descriptions(customer_name='Kevin'), ['Quote 2', 'Quote 3', 'Quote 5'])
+        self.assertEqual(self.descriptions(customer_name='kevin '), ['Quote 2', 'Quote 3'])
+
+    def test_filtered_pages(self):
+        page = self.client.get('/api/v1/quotes/', {'coverage_type': 'basic', 'page_size': 1}).json()
+        self.assertEqual([q['description'] for q in page['results']], ['Quote 1'])
+        self.assertIn('coverage_type=basic', page['next'])
+        page = self.client.get(page['next']).json()
+        self.assertEqual([q['description'] for q in page['results']], ['Quote 4'])
+        self.assertIsNone(page['next'])
+
+    def test_stream_is_filtered(self):
+        response = self.client.get('/api/v1/quotes/', {'stream': '1', 'state': 'TX'})
+        streamed = json.loads(b''.join(response.streaming_content))
+        self.assertEqual([q['description'] for q in streamed], ['Quote 4'])
+
+    def test_invalid_filters(self):
+        for params in ({'state': 'ZZ'}, {'customer': 'x'}, {'created_after': 'yesterday'},
+                       {'updated_before': '2023-13-01'}):
+            response = self.client.get('/api/v1/quotes/', params)
+            self.assertEqual(response.status_code, 400, params)
+            self.assertIn(next(iter(params)), response.json())
+
+    def test_detail_ignores_filters(self):
+        response = self.client.get('/api/v1/quotes/1/', {'state': 'TX'})
+        self.assertEqual(response.status_code, 200)
+
+    def plan(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            return [row[3] for row in cursor.fetchall()]
+
+    def test_filters_use_indexes(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('SQLite query plans')
+        when = timezone.now()
+        cases = [
+            ({}, 'api_quote_created_idx'),
+            ({'state': ['CA']}, 'api_quote_state_coverage_idx'),
+            ({'state': ['CA'], 'coverage_type': ['basic']}, 'api_quote_state_coverage_idx'),
+            ({'customer': [1]}, 'api_quote_customer_idx'),
+            ({'created_after': when, 'created_before': when}, 'api_quote_created_idx'),
+            ({'updated_after': when, 'updated_before': when}, 'api_quote_updated_idx'),
+            ({'customer_name': 'Kev'}, 'api_customer_name_lower_idx'),
+        ]
+        view_queryset = QuoteViewSet.queryset.all()
+        for filters, index in cases:
+            # a page of the list as KeysetPagination reads it
+            queryset = filter_quotes(view_queryset, **filters).order_by(*KeysetPagination.ordering)
+            plan = self.plan(queryset[:KeysetPagination.page_size + 1])
+            self.assertTrue(any(index in step for step in plan), (filters, plan))
+            for step in plan:
+                # every table is read through an index, none is scanned
+                self.assertRegex(step, r'USING|TEMP B-TREE', (filters, plan))
+        # the variables prefetch reads a quote's variables through the
+        # unique (quote, spec) index
+        plan = self.plan(QuoteVariable.objects.filter(quote__in=[1, 2]))
+        self.assertTrue(any('api_quotevariable' in step and 'USING' in step and '(quote_id=?)' in step
+                            for step in plan), plan)
+
+
+class AggregateTests(TestCase):
+    fixtures = ["customers.json",
+                "policy_variables.json",
+                "quote_variables.json",
+                "quotes.json",
+                "variable_specifications.json"]
+
+    def setUp(self):
+        self.addCleanup(rate_table.invalidate)
+
+    def assertDescribes(self, summary, costs):
+        # exact sums and extremes, percentiles within the sketch's accuracy
+        self.assertEqual(summary['quotes'], len(costs))
+        for i, column in enumerate(('subtotal', 'taxes', 'total')):
+            values = np.array([cost[i] for cost in costs])
+            described = summary[column]
+            self.assertAlmostEqual(described['sum'], values.sum(), places=2)
+            self.assertEqual((described['min'], described['max']), (values.min(), values.max()))
+            for p in (5, 25, 50, 75, 95):
+                exact = np.percentile(values, p, method='lower')
+                # and rounded to a cent
+                self.assertAlmostEqual(described['p{}'.format(p)], exact,
+                                       delta=abs(exact) * aggregates.PERCENTILE_ACCURACY + .0051)
+
+    def test_portfolio(self):
+        response = self.client.get('/api/v1/customers/3/portfolio/')
+        self.assertEqual(response.status_code, 200)
+        portfolio = response.json()
+        quotes = Quote.objects.filter(customer=3).order_by('pk')
+        self.assertEqual(portfolio['customer'], {'id': 3, 'name': 'Kevin Flynn'})
+        self.assertEqual(portfolio['version'], rate_table.version)
+        self.assertEqual(portfolio['unrated'], 0)
+        self.assertDescribes(portfolio, [q.rate for q in quotes])
+        self.assertEqual(set(portfolio['by_state']), {'CA', 'NY'})
+        self.assertDescribes(portfolio['by_state']['NY'], [quotes.get(state='NY').rate])
+        self.assertEqual(list(portfolio['by_coverage_type']), ['premium'])
+        self.assertEqual(portfolio['by_coverage_type']['premium']['quotes'], 2)
+
+    def test_empty_portfolio(self):
+        portfolio = self.client.get('/api/v1/customers/1/portfolio/').json()
+        self.assertEqual(portfolio['quotes'], 0)
+        self.assertEqual(portfolio['total'], {'sum': 0.0})
+        self.assertEqual(portfolio['by_state'], {})
+        self.assertEqual(self.client.get('/api/v1/customers/99/portfolio/').status_code, 404)
+
+    def test_grouped(self):
+        response = self.client.get('/api/v1/quotes/aggregate/', {'group_by': ['state', 'coverage_type']})
+        self.assertEqual(response.status_code, 200)
+        groups = response.json()['groups']
+        self.assertEqual([(g['state'], g['coverage_type']) for g in groups],
+                         [('CA', 'basic'), ('CA', 'premium'), ('NY', 'premium'), ('TX', 'basic')])
+        for group in groups:
+            self.assertDescribes(group, [q.rate for q in Quote.objects.filter(
+                state=group['state'], coverage_type=group['coverage_type'])])
+
+    def test_filtered(self):
+        data = self.client.get('/api/v1/quotes/aggregate/',
+                               {'customer': [3, 4], 'group_by': 'customer'}).json()
+        self.assertEqual(data['group_by'], ['customer'])
+        self.assertEqual([(g['customer'], g['quotes']) for g in data['groups']], [(3, 2), (4, 1)])
+        data = self.client.get('/api/v1/quotes/aggregate/', {'state': 'CA'}).json()
+        self.assertEqual(len(data['groups']), 1)
+        self.assertDescribes(data['groups'][0], [q.rate for q in Quote.objects.filter(state='CA')])
+
+    def test_invalid(self):
+        response = self.client.get('/api/v1/quotes/aggregate/', {'group_by': 'description'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('group_by', response.json())
+
+    def test_unrated_quotes(self):
+        PolicyVariable.objects.filter(scope='NY', key=STATE_TAX_RATE_KEY).delete()
+        rate_table.invalidate()
+        groups = self.client.get('/api/v1/quotes/aggregate/', {'group_by': 'state'}).json()['groups']
+        ny = [g for g in groups if g['state'] == 'NY'][0]
+        self.assertEqual((ny['quotes'], ny['unrated'], ny['total']), (1, 1, {'sum': 0.0}))
+        self.assertEqual(sum(g['unrated'] for g in groups), 1)
+
+    def test_unrated_groups_read_no_other_buckets(self):
+        grouping = aggregates.Grouping(['state'])
+        nan = [np.nan] * 3
+        grouping.add({'state': ['CA', 'NY', 'NY', 'TX']},
+                     np.array([[10.0, 1.0, 11.0], nan, nan, [1e300, 1e300, 1e300]]))
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            summaries = grouping.summaries()
+        self.assertEqual([s['unrated'] for s in summaries], [0, 2, 0])
+        self.assertEqual(summaries[1]['total'], {'sum': 0.0})
+        self.assertEqual(summaries[0]['total']['p50'], 11.0)
+
+    def test_book_in_chunks(self):
+        # stored and stale costs alike, folded in a chunk at a time
+        generate(400, seed=5)
+        Quote.objects.filter(pk__in=Quote.objects.order_by('pk').values('pk')[:150]).refresh_costs()
+        costs = {q.pk: q.rate for q in Quote.objects.all()}
+        states = dict(Quote.objects.values_list('pk', 'state'))
+        overall, by_state = aggregates.aggregate_quotes(Quote.objects.all(), [(), ('state',)],
+                                                        chunk_size=64)
+        self.assertDescribes(overall.summaries()[0], list(costs.values()))
+        for summary in by_state.summaries():
+            self.assertDescribes(summary, [cost for pk, cost in costs.items()
+                                           if states[pk] == summary['state']])
+
+    def test_memory_is_bounded_by_buckets(self):
+        grouping = aggregates.Grouping()
+        costs = np.random.default_rng(1).uniform(100, 200, (20000, 3))
+        for start in range(0, len(costs), 5000):
+            grouping.add({}, costs[start:start + 5000])
+        # a bucket per factor of gamma between 100 and 200, whatever the
+        # number of quotes
+        buckets = math.ceil(math.log(2) / aggregates.LOG_GAMMA) + 1
+        self.assertLessEqual(max(len(b) for b in grouping.buckets), buckets)
+        summary, = grouping.summaries()
+        self.assertEqual(summary['quotes'], 20000)
+        self.assertAlmostEqual(summary['total']['p50'], np.percentile(costs[:, 2], 50, method='lower'),
+                               delta=200 * aggregates.PERCENTILE_ACCURACY)
+
+
+class LoadTestTests(TransactionTestCase):
+    # the clients run in other threads, which only see committed rows
+    fixtures = ["customers.json",
+                "policy_variables.json",
+                "quote_variables.json",
+                "quotes.json",
+                "variable_specifications.json"]
+
+    def setUp(self):
+        self.addCleanup(rate_table.invalidate)
+        response_cache().clear()
+
+    def test_plan(self):
+        mix = loadtest.parse_mix('list=1,detail=3,filtered')
+        self.assertEqual(mix, {'list': 1.0, 'detail': 3.0, 'filtered': 1.0})
+        plan = loadtest.request_plan(mix, [1, 2, 3, 4], 200, seed=4)
+        self.assertEqual(plan, loadtest.request_plan(mix, [1, 2, 3, 4], 200, seed=4))
+        self.assertNotEqual(plan, loadtest.request_plan(mix, [1, 2, 3, 4], 200, seed=5))
+        self.assertEqual({kind for kind, _, _ in plan}, set(mix))
+        self.assertIn(('detail', '/api/v1/quotes/3/', ''), plan)
+        for mix in ('list=1,bogus=2', 'detail=-1', 'list=0'):
+            with self.assertRaises(ValueError):
+                loadtest.parse_mix(mix)
+        with self.assertRaises(CommandError):
+            call_command('load_test', mix='nothing')
+
+    def check(self, target):
+        mix = loadtest.parse_mix('list=1,detail=2,async_detail=1')
+        plan = loadtest.request_plan(mix, [1, 2, 3, 4], 40)
+        with override_settings(ALLOWED_HOSTS=['testserver', 'localhost', '127.0.0.1']):
+            report = loadtest.run(target, plan, concurrency=4, warmup=8)
+        self.assertEqual(report['requests'], 32)
+        self.assertEqual(report['errors'], 0)
+        self.assertEqual(sum(k['requests'] for k in report['by_kind'].values()), 32)
+        self.assertLessEqual(report['latency_ms']['p50'], report['latency_ms']['p99'])
+        # from the Server-Timing header: a detail from the response cache
+        # reads only its ETag, a fresh one the quote and its variables too
+        detail = report['by_kind']['detail']['queries_per_request']
+        self.assertGreaterEqual(detail['mean'], 1)
+        self.assertLessEqual(detail['max'], 6)
+        json.dumps(report)
+
+    def test_wsgi(self):
+        from acme.wsgi import application
+        self.check(loadtest.WsgiTarget(application))
+
+    def test_asgi(self):
+        from acme.asgi import application
+        self.check(loadtest.AsgiTarget(application))
+
+    def test_server_timing_queries(self):
+        self.assertEqual(loadtest.server_timing_queries(
+            'db;dur=0.512;desc="3 queries", rating;dur=0.1;desc="1 quotes"'), 3)
+        self.assertIsNone(loadtest.server_timing_queries(None))
+
+    def test_errors_are_counted(self):
+        from acme.wsgi import application
+        plan = loadtest.request_plan({'detail': 1}, [99], 5)
+        with override_settings(ALLOWED_HOSTS=['testserver']):
+            report = loadtest.run(loadtest.WsgiTarget(application), plan, concurrency=2)
+        self.assertEqual(report['errors'], 5)
+
+
+class LoadTestServerTests(LiveServerTestCase):
+    fixtures = ["customers.json",
+                "policy_variables.json",
+                "quote_variables.json",
+                "quotes.json",
+                "variable_specifications.json"]
+
+    def test_http(self):
+        self.addCleanup(rate_table.invalidate)
+        plan = loadtest.request_plan(loadtest.parse_mix('list=1,detail=3'), [1, 2, 3, 4], 20)
+        report = loadtest.run(loadtest.HttpTarget(self.live_server_url), plan, concurrency=2)
+        self.assertEqual((report['requests'], report['errors']), (20, 0))
+        self.assertGreaterEqual(report['queries_per_request']['mean'], 1)
+        with self.assertRaises(ValueError):
+            loadtest.HttpTarget('localhost:8000')
@@ -1,4 +1,5 @@
-from .views import QuoteViewSet
+from .views import CustomerPortfolioView, QuoteViewSet, RateSimulationView
+from . import async_views
 from django.urls import path, include
 from rest_framework import routers
 
@@ -7,4 +8,8 @@ router.register(r'quotes', QuoteViewSet)
 
 urlpatterns = [
     path('', include(router.urls)),
+    path('customers/<int:pk>/portfolio/', CustomerPortfolioView.as_view()),
+    path('rates/simulate/', RateSimulationView.as_view()),
+    path('async/quotes/', async_views.quote_list),
+    path('async/quotes/<int:pk>/', async_views.quote_detail),
 ]
@@ -1,9 +1,256 @@
 from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.http import StreamingHttpResponse
 from django.shortcuts import get_object_or_404
-from rest_framework import viewsets
+from rest_framework import status, viewsets
+from rest_framework.decorators import action
 from rest_framework.response import Response
-from .models import Quote
-from .serializers import QuoteSerializer
+from rest_framework.views import APIView
+from .aggregates import aggregate_quotes
+from .bulk import MAX_BULK_QUOTES, create_quotes
+from .caching import cached_response, quote_validators
+from .export import export_queryset, text_export
+from .filters import filter_quotes
+from .lean import (QUOTE_COLUMNS, accepts_lean, chunked, json_response, quote_data, quote_rows,
+                   rate_rows, render, render_quotes)
+from .models import Customer, Quote, RATING_ERRORS, VariableSpecification
+from .pagination import KeysetPagination
+from .rate_table import rate_table
+from .rating import rate_unsaved
+from .serializers import (BulkQuoteSerializer, QuoteAggregateSerializer, QuoteSerializer,
+                          QuoteExportSerializer, QuoteFilterSerializer, RateRequestSerializer,
+                          RateSimulationSerializer)
+from .simulation import simulate, COST_COLUMNS
+
+STREAM_CHUNK_SIZE = 2000
+MAX_RATE_REQUESTS = 1000
+MAX_SIMULATION_DIFF = 10000
+FILTER_PARAMS = ("created_after", "created_before", "updated_after", "updated_before",
+                 "customer_name")
+FILTER_LIST_PARAMS = ("state", "coverage_type", "customer")
+EXPORT_CONTENT_TYPES = {"csv": "text/csv; charset=utf-8", "ndjson": "application/x-ndjson"}
+
+
 class QuoteViewSet(viewsets.ModelViewSet):
-    queryset=Quote.objects.all()
-    serializer_class=QuoteSerializer
\ No newline at end of file
+    # the materialized costs make the variables prefetch unnecessary, quotes
+    # with stale costs get their variables loaded and rated in one batch.
+    queryset=Quote.objects.prefetch_related(None).select_related("customer").with_rates()
+    serializer_class=QuoteSerializer
+    pagination_class=KeysetPagination
+
+    def filter_queryset(self, queryset):
+        # the list's filters (see api.filters), several states, coverage
+        # types or customers are given by repeating the parameter
+        if self.action != "list":
+            return queryset
+        params = QuoteFilterSerializer(data=filter_data(self.request.query_params))
+        params.is_valid(raise_exception=True)
+        return filter_quotes(queryset, **params.validated_data)
+
+    def list(self, request, *args, **kwargs):
+        if request.query_params.get("stream") in ("1", "true"):
+            return self.stream(request)
+        # the page's links depend on the url, so it is part of the ETag
+        page = self.paginator.page_queryset(self.filter_queryset(self.get_queryset()), request)
+        etag = quote_validators(page, request.build_absolute_uri())
+        if not accepts_lean(request):
+            respond = lambda: super(QuoteViewSet, self).list(request, *args, **kwargs)
+        else:
+            respond = lambda: self.lean_list(page)
+        if etag is None:
+            return respond()
+        return cached_response(request, etag, respond)
+
+    def lean_list(self, page):
+        rows = self.paginator.finish_page(quote_rows(page))
+        data = quote_data(rows, rate_rows(rows))
+        return json_response(render(self.paginator.get_paginated_data(data)))
+
+    def retrieve(self, request, *args, **kwargs):
+        try:
+            quote = Quote.objects.filter(pk=kwargs[self.lookup_field])
+            etag = quote_validators(quote)
+        except (TypeError, ValueError, ValidationError):
+            etag = None
+        if etag is None:
+            # not a quote, let the usual 404 happen
+            return super().retrieve(request, *args, **kwargs)
+        if not accepts_lean(request):
+            respond = lambda: super(QuoteViewSet, self).retrieve(request, *args, **kwargs)
+        else:
+            # render_quotes gives a one element array
+            respond = lambda: json_response(render_quotes(quote)[1:-1])
+        return cached_response(request, etag, respond)
+
+    def stream(self, request):
+        # The whole list as one JSON array, written out a chunk at a time
+        # from a server side cursor instead of being built in memory.
+        queryset = self.filter_queryset(self.get_queryset()).order_by(
+            *KeysetPagination.ordering).prefetch_related(None).values_list(*QUOTE_COLUMNS, named=True)
+
+        def render_chunks():
+            yield b"["
+            separator = b""
+            for chunk in chunked(queryset.iterator(chunk_size=STREAM_CHUNK_SIZE), STREAM_CHUNK_SIZE):
+                yield separator + render(quote_data(chunk, rate_rows(chunk)))[1:-1]
+                separator = b","
+            yield b"]"
+
+        return StreamingHttpResponse(render_chunks(), content_type="application/json")
+
+    @action(detail=False, methods=["get"], url_path="export")
+    def export(self, request):
+        # Every quote matching the filters with its costs, as CSV or NDJSON
+        # streamed out a chunk at a time. See the export_quotes command for
+        # the columnar format.
+        params = QuoteExportSerializer(data={
+            **{k: v for k, v in request.query_params.items()
+               if k in ("type", "created_after", "created_before")},
+            "state": request.query_params.getlist("state"),
+            "coverage_type": request.query_params.getlist("coverage_type")})
+        params.is_valid(raise_exception=True)
+        data = params.validated_data
+        queryset = export_queryset(data["state"], data["coverage_type"],
+                                   data.get("created_after"), data.get("created_before"))
+        export_type = data["type"]
+        response = StreamingHttpResponse(
+            (piece.encode() for piece in text_export(export_type, queryset)),
+            content_type=EXPORT_CONTENT_TYPES[export_type])
+        response["Content-Disposition"] = 'attachment; filename="quotes.{}"'.format(export_type)
+        return response
+
+    @action(detail=False, methods=["get"], url_path="aggregate")
+    def aggregate(self, request):
+        # Counts, sums and percentiles of the costs of the quotes matching
+        # the list's filters, in one group or grouped by any of group_by=state,
+        # coverage_type and customer. See api.aggregates.
+        params = QuoteAggregateSerializer(data=filter_data(request.query_params, "group_by"))
+        params.is_valid(raise_exception=True)
+        filters = dict(params.validated_data)
+        group_by = filters.pop("group_by")
+        table = rate_table.table()
+        grouping, = aggregate_quotes(filter_quotes(Quote.objects.all(), **filters), [group_by], table)
+        return Response({"version": table.version, "group_by": group_by,
+                         "groups": grouping.summaries()})
+
+    @action(detail=False, methods=["post"], url_path="rate")
+    def rate(self, request):
+        # Prices unsaved quotes against the current rate table without
+        # writing anything. Takes a list of quote descriptions (or
+        # {"quotes": [...]}) and answers with one entry per quote, in order:
+        # its cost or the errors that kept it from being rated.
+        items = quote_items(request, MAX_RATE_REQUESTS, "rated")
+        if isinstance(items, Response):
+            return items
+
+        descriptions = [RateRequestSerializer(data=item) for item in items]
+        valid = [d.validated_data for d in descriptions if d.is_valid()]
+        codes = {v["code"] for d in valid for v in d["variables"]}
+        specs = VariableSpecification.objects.in_bulk(codes)
+        table = rate_table.table()
+
+        results = []
+        for description in descriptions:
+            if description.errors:
+                results.append({"errors": description.errors})
+                continue
+            results.append(self.rate_description(description.validated_data, specs, table))
+        return Response({"results": results})
+
+    def rate_description(self, description, specs, table):
+        unknown = [v["code"] for v in description["variables"] if v["code"] not in specs]
+        if unknown:
+            return {"errors": {"variables": ["Unknown variable specification {}.".format(code)
+                                             for code in unknown]}}
+        try:
+            rate = rate_unsaved(description["state"], description["coverage_type"],
+                                [(specs[v["code"]], v["value"]) for v in description["variables"]],
+                                table)
+        except RATING_ERRORS as e:
+            return {"errors": {"non_field_errors": [str(e)]}}
+        return {"cost": rate._asdict()}
+
+    @action(detail=False, methods=["post"], url_path="bulk")
+    def bulk(self, request):
+        # Creates a list of quotes (or {"quotes": [...]}) with their
+        # variables, given by spec code, and answers with their ids and
+        # costs in order. Either all of them are created or, when any of
+        # them is invalid, none and the errors of each invalid one.
+        items = quote_items(request, MAX_BULK_QUOTES, "created")
+        if isinstance(items, Response):
+            return items
+        serializer = BulkQuoteSerializer(data=items, many=True)
+        if not serializer.is_valid():
+            return Response({"errors": [dict(index=i, errors=errors)
+                                        for i, errors in enumerate(serializer.errors) if errors]},
+                            status=status.HTTP_400_BAD_REQUEST)
+        created, errors = create_quotes(serializer.validated_data)
+        if errors:
+            return Response({"errors": [dict(index=i, errors=errors[i]) for i in sorted(errors)]},
+                            status=status.HTTP_400_BAD_REQUEST)
+        return Response({"results": [dict(id=quote.pk, cost=cost._asdict()) for quote, cost in created]},
+                        status=status.HTTP_201_CREATED)
+
+
+def filter_data(query, *lists: str) -> dict:
+    # the query parameters of the list's filters (and the given ones) for
+    # QuoteFilterSerializer, several states, coverage types or customers
+    # are given by repeating the parameter
+    return {**{k: v for k, v in query.items() if k in FILTER_PARAMS},
+            **{k: query.getlist(k) for k in FILTER_LIST_PARAMS + lists}}
+
+
+def quote_items(request, limit: int, verb: str):
+    # the list of quotes (or {"quotes": [...]}) posted to rate or bulk, or
+    # the Response saying what is wrong with it
+    items = request.data
+    if isinstance(items, dict):
+        items = items.get("quotes")
+    if not isinstance(items, list):
+        return Response({"detail": "Expected a list of quotes."},
+                        status=status.HTTP_400_BAD_REQUEST)
+    if len(items) > limit:
+        return Response({"detail": "At most {} quotes can be {} at once.".format(limit, verb)},
+                        status=status.HTTP_400_BAD_REQUEST)
+    return items
+
+
+class CustomerPortfolioView(APIView):
+    # Counts, sums and percentiles of the costs of all of a customer's
+    # quotes, also by state and coverage type, from one pass over them.
+    def get(self, request, pk):
+        customer = get_object_or_404(Customer, pk=pk)
+        table = rate_table.table()
+        overall, by_state, by_coverage_type = aggregate_quotes(
+            Quote.objects.filter(customer=customer), [(), ("state",), ("coverage_type",)], table)
+        summary, = overall.summaries()
+        return Response(dict(
+            customer=dict(id=customer.pk, name=customer.name),
+            version=table.version,
+            **summary,
+            by_state={s.pop("state"): s for s in by_state.summaries()},
+            by_coverage_type={s.pop("coverage_type"): s for s in by_coverage_type.summaries()}))
+
+
+class RateSimulationView(APIView):
+    # How quote costs would move if the given rate table values were
+    # published. Nothing is written. Only the quotes the overrides affect are
+    # rated unless "all" is set; "diff" adds the quotes whose costs change
+    # (up to MAX_SIMULATION_DIFF, see the simulate_rates command for all).
+    def post(self, request):
+        serializer = RateSimulationSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        overrides = {(o["scope"], o["key"]): o["value"] for o in data["overrides"]}
+        simulation = simulate(overrides, affected_only=not data["all"])
+        summary = simulation.summary()
+        if data["diff"]:
+            fields = ("quote", "state", "coverage_type", "current", "simulated")
+            summary["diff"] = []
+            for row in simulation.diff():
+                if len(summary["diff"]) == MAX_SIMULATION_DIFF:
+                    summary["diff_truncated"] = True
+                    break
+                costs = [dict(zip(COST_COLUMNS, row[i:i + 3])) for i in (3, 6)]
+                summary["diff"].append(dict(zip(fields, row[:3] + costs)))
+        return Response(summary)